@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apps.catalog.models import TaxonPath
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized paths of the taxonomic tree'
+
+    def handle(self, *args, **kwargs):
+        total = TaxonPath.rebuild()
+        self.stdout.write(self.style.SUCCESS('Successfully indexed {} taxa'.format(total)))
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-17 12:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0025_auto_20250813_1626'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='species',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['scientific_name_db'], name='catalog_species_name_trgm', opclasses=['gin_trgm_ops']
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='synonymy',
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=['scientific_name_db'], name='catalog_synonymy_name_trgm', opclasses=['gin_trgm_ops']
+            ),
+        ),
+    ]
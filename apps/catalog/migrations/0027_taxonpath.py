@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-17 12:00
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0026_species_synonymy_trigram_index'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxonPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('unique_taxon_id', models.BigIntegerField()),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('path', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('names', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=300, null=True), size=None)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['unique_taxon_id'], name='catalog_taxonpath_taxon_idx'),
+                    django.contrib.postgres.indexes.GinIndex(fields=['path'], name='catalog_taxonpath_path_gin'),
+                ],
+                'constraints': [
+                    models.UniqueConstraint(fields=('content_type', 'object_id'), name='unique_taxon_path'),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+from apps.catalog.models import build_taxon_paths
+
+
+def populate_taxon_paths(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TaxonPath = apps.get_model('catalog', 'TaxonPath')
+    ranks = list()
+    for model_name, parent_field in [
+        ('Kingdom', None), ('Division', 'kingdom'), ('ClassName', 'division'),
+        ('Order', 'classname'), ('Family', 'order'), ('Genus', 'family'),
+    ]:
+        model = apps.get_model('catalog', model_name)
+        if parent_field is None:
+            rows = [row + (None,) for row in model.objects.values_list('pk', 'unique_taxon_id', 'name')]
+        else:
+            rows = model.objects.values_list('pk', 'unique_taxon_id', 'name', f'{parent_field}__unique_taxon_id')
+        ranks.append((ContentType.objects.get_for_model(model).pk, rows))
+    Species = apps.get_model('catalog', 'Species')
+    nodes = build_taxon_paths(
+        ranks, ContentType.objects.get_for_model(Species).pk, Species.objects.values_list(
+            'pk', 'unique_taxon_id', 'scientific_name', 'parent_content_type_id', 'parent_taxon_id'
+        )
+    )
+    TaxonPath.objects.all().delete()
+    TaxonPath.objects.bulk_create([
+        TaxonPath(
+            content_type_id=content_type_id, object_id=pk, unique_taxon_id=unique_taxon_id,
+            depth=len(path), path=path, names=names
+        )
+        for content_type_id, pk, unique_taxon_id, path, names in nodes
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('catalog', '0027_taxonpath'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_taxon_paths, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import celery
 import logging
 import dwca.terms as dwc
 import dwca.classes as dwc_classes
@@ -7,23 +8,24 @@ from abc import abstractmethod, ABC
 from copy import deepcopy
 
 import pandas as pd
-from celery.app.task import Task
-from celery.result import AsyncResult
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db.models import GeometryField
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import TrigramSimilarity
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import connection
+from django.db import connection, transaction
 from django.db import models
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
 from django.utils.translation import gettext_lazy as _, pgettext_lazy, pgettext
 from time import time_ns, time
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterable, Iterator
 
-from intranet.utils import CatalogQuerySet
+from intranet.utils import CatalogQuerySet, ProgressReporter
 
 ATTRIBUTES = [
     "plant_habit", "env_habit",
@@ -56,6 +58,169 @@ CATALOG_DWC_FIELDS = [
 ]
 
 
+TAXONOMY_CHAIN = [
+    ("kingdom", None), ("division", "kingdom_id"), ("classname", "division_id"),
+    ("order", "classname_id"), ("family", "order_id"), ("genus", "family_id"),
+]
+
+RANK_DWC_SQL = """
+SELECT "{rank}".taxon_id, {parent_id}, "{rank}".taxon_id,
+       "{rank}".taxon_id, "{rank}".taxon_id, %(package_id)s,
+       'accepted', %(rank_name)s, '', "{rank}".name,
+       {higher_classification}, {classification},
+       NULL, NULL, NULL,
+       NULL, NULL,
+       NULL, NULL,
+       'ICBN', NULL,
+       "{rank}".updated_at, 'https://udec.cl', 'UDEC',
+       %(dataset_name)s
+FROM catalog_{rank} AS "{rank}"
+{joins}
+{where}
+ORDER BY "{rank}".name
+"""
+
+SCIENTIFIC_NAME_DWC_SQL = """
+SELECT "{table}".taxon_id, COALESCE(parent_genus.taxon_id, parent_species.taxon_id), "species".taxon_id,
+       "species".taxon_id, "{table}".taxon_id, %(package_id)s,
+       %(status)s, taxon_rank.name_en, {remarks}, {scientific_name},
+       {higher_classification}, {classification},
+       {generic_name}, NULL, "{table}".specific_epithet,
+       COALESCE("{table}".form, "{table}".variety, "{table}".subspecies),
+       COALESCE("{table}".form_authorship, "{table}".variety_authorship,
+                "{table}".ssp_authorship, "{table}".scientific_name_authorship),
+       NULL, NULL,
+       'ICBN', NULL,
+       "{table}".updated_at, 'https://udec.cl', 'UDEC',
+       %(dataset_name)s
+FROM catalog_{table} AS "{table}"
+{species_join}
+LEFT JOIN catalog_taxonrank AS taxon_rank ON taxon_rank.id = "{table}".taxon_rank_id
+LEFT JOIN catalog_genus AS parent_genus
+    ON "species".parent_content_type_id = %(genus_type)s AND parent_genus.unique_taxon_id = "species".parent_taxon_id
+LEFT JOIN catalog_species AS parent_species
+    ON "species".parent_content_type_id = %(species_type)s AND parent_species.unique_taxon_id = "species".parent_taxon_id
+LEFT JOIN catalog_genus AS "genus" ON "genus".id = "species".genus_id
+{joins}
+{where}
+ORDER BY "{table}".scientific_name
+"""
+
+
+def classification_sql(rank: str) -> Tuple[str, str, str]:
+    """
+    Builds the joins from the table of a taxonomic rank up to the kingdom,
+    each table aliased by its rank, and the columns with the names of the
+    ranks
+
+    Parameters
+    ----------
+    rank : str
+        Name of the rank, as in `TAXONOMY_CHAIN`
+
+    Returns
+    -------
+    Tuple[str, str, str]
+        Joins, array of the names of the ranks above `rank` and the six
+        classification columns, from kingdom to genus
+    """
+    ranks = [name for name, foreign_key in TAXONOMY_CHAIN]
+    depth = ranks.index(rank)
+    joins = list()
+    for (child, foreign_key), (parent, parent_key) in zip(
+            reversed(TAXONOMY_CHAIN[1:depth + 1]), reversed(TAXONOMY_CHAIN[:depth])
+    ):
+        joins.append(f'LEFT JOIN catalog_{parent} AS "{parent}" ON "{parent}".id = "{child}".{foreign_key}')
+    higher_classification = "array_remove(ARRAY[{}]::varchar[], NULL)".format(
+        ", ".join([f'"{name}".name' for name in ranks[:depth]])
+    )
+    classification = ", ".join(
+        [f'"{name}".name' for name in ranks[:depth + 1]] + ["NULL"] * (len(ranks) - depth - 1)
+    )
+    return "\n".join(joins), higher_classification, classification
+
+
+def range_sql(table: str, pk_range: Tuple[int, int] = None) -> str:
+    if pk_range is None:
+        return ""
+    return f'WHERE "{table}".id >= {int(pk_range[0])} AND "{table}".id < {int(pk_range[1])}'
+
+
+def scientific_name_dwc_sql(table: str, pk_range: Tuple[int, int] = None) -> str:
+    joins, _, classification = classification_sql("genus")
+    higher_classification = f"array_remove(ARRAY[{classification}, parent_species.scientific_name]::varchar[], NULL)"
+    generic_name = '"genus".name' if table == "species" else '"synonymy".genus'
+    scientific_name = (
+        "concat({genus}, ' ', \"{table}\".specific_epithet, CASE "
+        "WHEN \"{table}\".form IS NOT NULL THEN concat(' fma. ', \"{table}\".form) "
+        "WHEN \"{table}\".variety IS NOT NULL THEN concat(' var. ', \"{table}\".variety) "
+        "WHEN \"{table}\".subspecies IS NOT NULL THEN concat(' fma. ', \"{table}\".subspecies) "
+        "ELSE '' END)"
+    ).format(genus=generic_name, table=table)
+    return SCIENTIFIC_NAME_DWC_SQL.format(
+        table=table,
+        species_join="" if table == "species" else 'JOIN catalog_species AS "species" ON "species".id = "synonymy".species_id',
+        remarks='"species".notes' if table == "species" else "''",
+        scientific_name=scientific_name,
+        higher_classification=higher_classification,
+        classification=classification,
+        generic_name=generic_name,
+        joins=joins,
+        where=range_sql(table, pk_range),
+    )
+
+
+def stream_dwc_data(sql: str, params: Dict) -> Iterator[Tuple]:
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(settings.DWC_EXPORT_CHUNK_SIZE)
+            if len(rows) == 0:
+                break
+            yield from rows
+
+
+def read_dwc_data(sql: str, params: Dict, progress: ProgressReporter = None) -> pd.DataFrame:
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    if progress is not None:
+        progress.update(progress.extend(len(rows)) + len(rows))
+    return pd.DataFrame(rows, columns=[
+        field.name for field in CATALOG_DWC_FIELDS
+    ])
+
+
+def queue_relabel_vouchers(species: Q, vouchers: List[int] = None) -> None:
+    """
+    Queues a single regeneration of the public image of the digitalized
+    vouchers of the species matching a filter, once the current transaction commits
+
+    Parameters
+    ----------
+    species : Q
+        Filter of the species over the vouchers, as `scientific_name__genus=genus`
+    vouchers : List[int], optional
+        Vouchers to relabel, all the vouchers of the species by default
+
+    Returns
+    -------
+    None
+    """
+    def send_relabel():
+        from ..digitalization.models import VoucherImported
+        query = VoucherImported.objects.filter(species, biodata_code__voucher_state=7)
+        if vouchers is not None:
+            query = query.filter(pk__in=vouchers)
+        voucher_ids = list(query.values_list("pk", flat=True))
+        if len(voucher_ids) > 0:
+            logging.debug(f"Relabeling {len(voucher_ids)} vouchers")
+            celery.current_app.send_task('relabel_vouchers', (voucher_ids,))
+
+    transaction.on_commit(send_relabel)
+    return
+
+
 class VernacularName(dwc_classes.DataFile):
     URI = "http://rs.gbif.org/terms/1.0/VernacularName"
     def __init__(self, _id: int, files: str, fields: List[dwc.Field]):
@@ -572,6 +737,207 @@ class References(models.Model):
         return f"{authors_str} {self.title}. {self.journal}{issue_str}{page_str}{year_str}."
 
 
+TAXON_PATH_DESCENDANTS_SQL = """
+UPDATE catalog_taxonpath
+SET path = %s::bigint[] || path[%s:],
+    names = %s::varchar[] || names[%s:],
+    depth = depth + %s
+WHERE path @> %s::bigint[] AND path[%s] = %s AND id <> %s
+"""
+
+
+def build_taxon_paths(
+        ranks: List[Tuple[int, Iterable[Tuple[int, int, str, int]]]],
+        species_type: int, species: Iterable[Tuple[int, int, str, int, int]]
+) -> List[Tuple[int, int, int, List[int], List[str]]]:
+    """
+    Materialized paths of the whole taxonomic tree
+
+    Parameters
+    ----------
+    ranks : List[Tuple[int, Iterable[Tuple[int, int, str, int]]]]
+        Content type id and rows (pk, unique taxon id, name, unique taxon id of
+        the parent) of each rank above species, from the kingdom down
+    species_type : int
+        Content type id of the species
+    species : Iterable[Tuple[int, int, str, int, int]]
+        Rows (pk, unique taxon id, name, parent content type id, parent unique
+        taxon id) of the species, whose parent may be a genus or another species
+
+    Returns
+    -------
+    List[Tuple[int, int, int, List[int], List[str]]]
+        Content type id, object id, unique taxon id, path and names of each taxon
+    """
+    known = dict()
+    nodes = list()
+
+    def add_node(content_type_id: int, pk: int, unique_taxon_id: int, name: str, parent: Tuple[int, int]):
+        path, names = known.get(parent, (list(), list()))
+        path = path + [unique_taxon_id]
+        names = names + [name]
+        known[(content_type_id, unique_taxon_id)] = (path, names)
+        nodes.append((content_type_id, pk, unique_taxon_id, path, names))
+
+    parent_type = None
+    for content_type_id, rows in ranks:
+        for pk, unique_taxon_id, name, parent_id in rows:
+            add_node(content_type_id, pk, unique_taxon_id, name, (parent_type, parent_id))
+        parent_type = content_type_id
+    pending = list(species)
+    while len(pending) > 0:
+        waiting = list()
+        for pk, unique_taxon_id, name, parent_type, parent_id in pending:
+            if (parent_type, parent_id) in known:
+                add_node(species_type, pk, unique_taxon_id, name, (parent_type, parent_id))
+            else:
+                waiting.append((pk, unique_taxon_id, name, parent_type, parent_id))
+        if len(waiting) == len(pending):
+            break
+        pending = waiting
+    for pk, unique_taxon_id, name, parent_type, parent_id in pending:
+        logging.warning(f"Parent not found on {name} ({pk})")
+        add_node(species_type, pk, unique_taxon_id, name, (parent_type, parent_id))
+    return nodes
+
+
+class TaxonPathQuerySet(models.QuerySet):
+
+    def node(self, taxon: TaxonomicModel) -> TaxonPathQuerySet:
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(taxon),
+            object_id=taxon.pk
+        )
+
+    def ancestors(self, taxon: TaxonomicModel) -> TaxonPathQuerySet:
+        content_type = ContentType.objects.get_for_model(taxon)
+        return self.filter(
+            unique_taxon_id__in=RawSQL(
+                "SELECT unnest(path) FROM catalog_taxonpath WHERE content_type_id = %s AND object_id = %s",
+                (content_type.pk, taxon.pk)
+            )
+        ).exclude(content_type=content_type, object_id=taxon.pk).order_by("depth")
+
+    def descendants(self, taxon: TaxonomicModel) -> TaxonPathQuerySet:
+        return self.filter(
+            path__contains=[taxon.unique_taxon_id]
+        ).exclude(
+            content_type=ContentType.objects.get_for_model(taxon), object_id=taxon.pk
+        ).order_by("depth")
+
+
+class TaxonPath(models.Model):
+    """
+    Materialized path of a taxon on the taxonomic tree, from the kingdom
+    to the taxon itself
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    taxon = GenericForeignKey("content_type", "object_id")
+    unique_taxon_id = models.BigIntegerField()
+    depth = models.PositiveSmallIntegerField()
+    path = ArrayField(models.BigIntegerField())
+    names = ArrayField(models.CharField(max_length=300, null=True))
+
+    objects = TaxonPathQuerySet.as_manager()
+
+    def __str__(self):
+        return " > ".join([str(name) for name in self.names])
+
+    @classmethod
+    def index(cls, taxon: TaxonomicModel) -> TaxonPath:
+        """
+        Creates or updates the path of the taxon, rewriting the paths of
+        its descendants if the taxon was renamed or moved
+
+        Parameters
+        ----------
+        taxon : TaxonomicModel
+            Taxon saved on the database
+
+        Returns
+        -------
+        TaxonPath
+            Path of the taxon
+        """
+        path, names = list(), list()
+        parent = taxon.parent
+        if parent is not None:
+            parent_path = cls.objects.node(parent).first()
+            if parent_path is None:
+                parent_path = cls.index(parent)
+            path, names = list(parent_path.path), list(parent_path.names)
+        path.append(taxon.unique_taxon_id)
+        names.append(taxon.name)
+        node = cls.objects.node(taxon).first()
+        if node is None:
+            return cls.objects.create(
+                content_type=ContentType.objects.get_for_model(taxon),
+                object_id=taxon.pk,
+                unique_taxon_id=taxon.unique_taxon_id,
+                depth=len(path), path=path, names=names
+            )
+        if node.path == path and node.names == names:
+            return node
+        with connection.cursor() as cursor:
+            cursor.execute(TAXON_PATH_DESCENDANTS_SQL, [
+                path, node.depth + 1, names, node.depth + 1,
+                len(path) - node.depth, [node.unique_taxon_id],
+                node.depth, node.unique_taxon_id, node.pk
+            ])
+        node.unique_taxon_id = taxon.unique_taxon_id
+        node.depth = len(path)
+        node.path = path
+        node.names = names
+        node.save()
+        return node
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """
+        Rebuilds the paths of the whole taxonomic tree
+
+        Returns
+        -------
+        int
+            Number of indexed taxa
+        """
+        ranks = list()
+        for model, parent_field in [
+            (Kingdom, None), (Division, "kingdom"), (ClassName, "division"),
+            (Order, "classname"), (Family, "order"), (Genus, "family"),
+        ]:
+            if parent_field is None:
+                rows = [row + (None,) for row in model.objects.values_list("pk", "unique_taxon_id", "name")]
+            else:
+                rows = model.objects.values_list("pk", "unique_taxon_id", "name", f"{parent_field}__unique_taxon_id")
+            ranks.append((ContentType.objects.get_for_model(model).pk, rows))
+        nodes = [
+            cls(
+                content_type_id=content_type_id, object_id=pk, unique_taxon_id=unique_taxon_id,
+                depth=len(path), path=path, names=names
+            )
+            for content_type_id, pk, unique_taxon_id, path, names in build_taxon_paths(
+                ranks, ContentType.objects.get_for_model(Species).pk, Species.objects.values_list(
+                    "pk", "unique_taxon_id", "scientific_name", "parent_content_type_id", "parent_taxon_id"
+                )
+            )
+        ]
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(nodes, batch_size=1000)
+        return len(nodes)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["content_type", "object_id"], name="unique_taxon_path"),
+        ]
+        indexes = [
+            models.Index(fields=["unique_taxon_id"], name="catalog_taxonpath_taxon_idx"),
+            GinIndex(fields=["path"], name="catalog_taxonpath_path_gin"),
+        ]
+
+
 class TaxonomicModel(models.Model):
     unique_taxon_id = models.BigIntegerField()
     taxon_id = models.CharField()
@@ -579,6 +945,7 @@ class TaxonomicModel(models.Model):
     updated_at = models.DateTimeField(verbose_name=_("Updated at"), auto_now=True)
     created_by = models.ForeignKey(User, verbose_name=_("Created by"), on_delete=models.PROTECT, default=1, editable=False)
     references = models.ManyToManyField(References, verbose_name=_("References"), blank=True)
+    taxon_paths = GenericRelation(TaxonPath)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -617,66 +984,64 @@ class TaxonomicModel(models.Model):
         return None
 
     def get_higher_classification(self) -> List[str]:
-        if self.parent is None:
-            return list()
-        else:
-            return self.parent.get_higher_classification() + [self.parent.name]
+        names = TaxonPath.objects.node(self).values_list("names", flat=True).first()
+        if names is not None:
+            return names[:-1]
+        higher_classification = list()
+        parent = self.parent
+        while parent is not None:
+            higher_classification.insert(0, parent.name)
+            parent = parent.parent
+        return higher_classification
+
+    def update_taxon_path(self) -> None:
+        TaxonPath.index(self)
+        return
 
     @classmethod
-    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), task: Task = None):
+    def get_dwc_query(cls, pk_range: Tuple[int, int] = None) -> Tuple[str, Dict]:
         from ..metadata.models import EML
         eml = EML.objects.get(pk=1)
-        objects = cls.objects.all()
-        rank_name = objects.__rank_name__
-        if rank_name == "classname":
-            rank_name = "class"
-        rows = list()
-        logger.debug(f"Extracting data: {rank_name}")
-        current_total = 0
-        total = objects.count()
-        if task is not None:
-            async_result = AsyncResult(task.request.id)
-            current_total = async_result.info["total"]
-            total += current_total
-            task.update_state(state="PROGRESS", meta={"step": current_total, "total": total, "logs": logger[0].get_logs()})
-        for i, obj in enumerate(objects):
-            if task is not None:
-                task.update_state(state="PROGRESS", meta={"step": i + current_total, "total": total, "logs": logger[0].get_logs()})
-            higher_classification = obj.get_higher_classification()
-            complete_classification = higher_classification.copy()
-            complete_classification.append(obj.name)
-            while len(complete_classification) < 6:
-                complete_classification.append(None)
-            parent_id = None
-            if obj.parent is not None:
-                parent_id = obj.parent.taxon_id
-            rows.append(
-                [
-                    obj.taxon_id, parent_id, obj.taxon_id,
-                    obj.taxon_id, obj.taxon_id, eml.package_id,
-                    "accepted", rank_name, "", obj.name,
-                    obj.get_higher_classification()
-                ] + complete_classification + [
-                    None, None, None,
-                    None, None,
-                    None, None,
-                    "ICBN", None,
-                    obj.updated_at, "https://udec.cl", "UDEC",
-                    eml.dataset.title,
-                ]
-            )
-        return pd.DataFrame(rows, columns=[
-            field.name for field in CATALOG_DWC_FIELDS
-        ])
+        rank = cls.objects.all().__rank_name__
+        rank_name = "class" if rank == "classname" else rank
+        joins, higher_classification, classification = classification_sql(rank)
+        parent = TAXONOMY_CHAIN[[name for name, _ in TAXONOMY_CHAIN].index(rank) - 1][0]
+        sql = RANK_DWC_SQL.format(
+            rank=rank,
+            parent_id="NULL" if rank == "kingdom" else f'"{parent}".taxon_id',
+            higher_classification=higher_classification,
+            classification=classification,
+            joins=joins,
+            where=range_sql(rank, pk_range),
+        )
+        return sql, {
+            "package_id": eml.package_id,
+            "rank_name": rank_name,
+            "dataset_name": eml.dataset.title,
+        }
+
+    @classmethod
+    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), progress: ProgressReporter = None):
+        logger.debug(f"Extracting data: {cls.objects.all().__rank_name__}")
+        return read_dwc_data(*cls.get_dwc_query(), progress=progress)
+
+    @classmethod
+    def iter_dwc_data(
+            cls, logger: logging.Logger = logging.getLogger(__name__), pk_range: Tuple[int, int] = None
+    ) -> Iterator[Tuple]:
+        logger.debug(f"Streaming data: {cls.objects.all().__rank_name__}")
+        yield from stream_dwc_data(*cls.get_dwc_query(pk_range=pk_range))
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, **kwargs):
         if force_update:
-            return super().save(
+            result = super().save(
                 force_insert=force_insert,
                 force_update=force_update,
                 using=using,
                 update_fields=update_fields,
             )
+            self.update_taxon_path()
+            return result
         if self.pk is None:
             try:
                 if self.taxon_id is None or self.taxon_id == "":
@@ -695,6 +1060,7 @@ class TaxonomicModel(models.Model):
                     using=using,
                     update_fields=update_fields
                 )
+                self.update_taxon_path()
                 Binnacle.new_entry(self, kwargs["user"], notes=kwargs.get("notes", None))
             except Exception as e:
                 raise e
@@ -702,12 +1068,14 @@ class TaxonomicModel(models.Model):
             prev_entry = repr(self.__original__)
             self.__original__ = deepcopy(self)
             Binnacle.update_entry(prev_entry, self, kwargs["user"], notes=kwargs.get("notes", None))
-            return super().save(
+            result = super().save(
                 force_insert=force_insert,
                 force_update=force_update,
                 using=using,
                 update_fields=update_fields
             )
+            self.update_taxon_path()
+            return result
         else:
             logging.warning("Same value not saving")
             return
@@ -957,25 +1325,21 @@ class Family(TaxonomicModel):
         return self.order
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, **kwargs):
-        if self.__original__ is not None and self.__original__.name != self.name:
+        relabel = self.__original__ is not None and self.__original__.name != self.name
+        if relabel:
             logging.debug("Name from {} to {}. Change etiquettes".format(
                 self.__original__.name, self.name
             ))
-            for genus in self.genus_set.all():
-                for species in genus.species_set.all():
-                    vouchers = species.voucherimported_set.all()
-                    logging.debug("Vouchers on {} ({}): {}".format(
-                        species.scientific_name_full, species.id, vouchers.count()
-                    ))
-                    for voucher in vouchers:
-                        voucher.generate_etiquette()
-        return super().save(
+        result = super().save(
             force_insert=force_insert,
             force_update=force_update,
             using=using,
             update_fields=update_fields,
             **kwargs
         )
+        if relabel:
+            queue_relabel_vouchers(Q(scientific_name__genus__family=self))
+        return result
 
     class Meta:
         verbose_name = _("Family")
@@ -1027,12 +1391,13 @@ class Genus(TaxonomicModel):
         return self.family
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, **kwargs):
+        relabel = False
         if self.__original__ is not None and self.__original__ != self:
             logging.debug("Genus from {} to {}. Changing species...".format(
                 repr(self.__original__), repr(self)
             ))
-            for species in self.species_set.all():
-                if self.__original__.name != self.name:
+            if self.__original__.name != self.name:
+                for species in self.species_set.all():
                     species.save(
                         force_insert=force_insert,
                         force_update=force_update,
@@ -1040,20 +1405,18 @@ class Genus(TaxonomicModel):
                         update_fields=update_fields,
                         **kwargs
                     )
-                else:
-                    vouchers = species.voucherimported_set.all()
-                    logging.debug("Vouchers on {} ({}): {}".format(
-                        species.scientific_name_full, species.id, vouchers.count()
-                    ))
-                    for voucher in vouchers:
-                        voucher.generate_etiquette()
-        return super().save(
+            else:
+                relabel = True
+        result = super().save(
             force_insert=force_insert,
             force_update=force_update,
             using=using,
             update_fields=update_fields,
             **kwargs
         )
+        if relabel:
+            queue_relabel_vouchers(Q(scientific_name__genus=self))
+        return result
 
     class Meta:
         verbose_name = _("Genus")
@@ -1353,55 +1716,40 @@ class Species(ScientificName):
         except ObjectDoesNotExist:
             return None
 
-    def get_higher_classification(self) -> List[str]:
-        higher_classification = list()
-        parent = self.parent
-        while parent is not None:
-            higher_classification.insert(0, parent.name)
-            parent = parent.parent
-        return higher_classification
-
     @classmethod
-    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), task: Task = None):
+    def get_dwc_query(cls, pk_range: Tuple[int, int] = None) -> Tuple[str, Dict]:
         from ..metadata.models import EML
         eml = EML.objects.get(pk=1)
-        objects = cls.objects.all()
-        rows = list()
-        logger.debug(f"Extracting data: species")
-        current_total = 0
-        total = objects.count()
-        if task is not None:
-            async_result = AsyncResult(task.request.id)
-            current_total = async_result.info["total"]
-            total += current_total
-            task.update_state(state="PROGRESS", meta={"step": current_total, "total": total, "logs": logger[0].get_logs()})
+        return scientific_name_dwc_sql("species", pk_range=pk_range), {
+            "package_id": eml.package_id,
+            "status": "accepted",
+            "dataset_name": eml.dataset.title,
+            "genus_type": ContentType.objects.get_for_model(Genus).pk,
+            "species_type": ContentType.objects.get_for_model(Species).pk,
+        }
+
+    @classmethod
+    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), progress: ProgressReporter = None):
+        logger.debug("Extracting data: species")
+        data = read_dwc_data(*cls.get_dwc_query(), progress=progress)
+        errors = data[data[CATALOG_DWC_FIELDS[1].name].isna()]
+        if len(errors) > 0:
+            raise AttributeError("Parent not found on:\n" + "\n".join(errors[CATALOG_DWC_FIELDS[9].name]))
+        return data
+
+    @classmethod
+    def iter_dwc_data(
+            cls, logger: logging.Logger = logging.getLogger(__name__), pk_range: Tuple[int, int] = None
+    ) -> Iterator[Tuple]:
+        logger.debug("Streaming data: species")
         errors = list()
-        for i, obj in enumerate(objects):
-            if task is not None:
-                task.update_state(state="PROGRESS", meta={"step": i + current_total, "total": total, "logs": logger[0].get_logs()})
-            if obj.parent is None:
-                errors.append(obj.name)
+        for row in stream_dwc_data(*cls.get_dwc_query(pk_range=pk_range)):
+            if row[1] is None:
+                errors.append(row[9])
             else:
-                rows.append(
-                    [
-                        obj.taxon_id, obj.parent.taxon_id, obj.taxon_id,
-                        obj.taxon_id, obj.taxon_id, eml.package_id,
-                        "accepted", obj.taxon_rank.name_en, obj.notes, obj.dwc_scientific_name,
-                        obj.get_higher_classification()
-                    ] + obj.get_higher_classification()[0:6] + [
-                        obj.genus.name, None, obj.specific_epithet,
-                        obj.infraspecific_epithet, obj.authorship,
-                        None, None,
-                        "ICBN", None,
-                        obj.updated_at, "https://udec.cl", "UDEC",
-                        eml.dataset.title,
-                    ]
-                )
+                yield row
         if len(errors) > 0:
             raise AttributeError("Parent not found on:\n" + "\n".join(errors))
-        return pd.DataFrame(rows, columns=[
-            field.name for field in CATALOG_DWC_FIELDS
-        ])
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, **kwargs):
         if force_update:
@@ -1413,6 +1761,7 @@ class Species(ScientificName):
                 **kwargs
             )
         self.__update_scientific_name__()
+        relabel = False
         if self.__prev__ is not None:
             logging.debug(f"{self.__prev__} ({self.__prev__.pk})")
             if self.__original__ != self:
@@ -1420,13 +1769,7 @@ class Species(ScientificName):
                         self.__original__.scientific_name_full != self.scientific_name_full:
                     if self.__original__.scientific_name_full != self.scientific_name_full:
                         logging.debug(f"Name changed on taxa {self.pk}")
-                        logging.debug("Listing specimen:")
-                        logging.debug("\n".join([
-                            specimen.biodata_code.code
-                            for specimen in self.voucherimported_set.all()
-                        ]))
-                        for specimen in self.voucherimported_set.all():
-                            specimen.generate_etiquette()
+                        relabel = True
                         with connection.cursor() as cursor:
                             cursor.execute("SELECT get_taxon_id()")
                             result = cursor.fetchone()
@@ -1447,18 +1790,42 @@ class Species(ScientificName):
         if self.parent is None:
             self.parent_content_type = ContentType.objects.get_for_model(Genus)
             self.parent_taxon_id = self.genus.unique_taxon_id
-        return super().save(
+        result = super().save(
             force_insert=force_insert,
             force_update=force_update,
             using=using,
             update_fields=update_fields,
             **kwargs
         )
+        if relabel:
+            self.relabel_vouchers()
+        return result
+
+    def relabel_vouchers(self, vouchers: List[int] = None) -> None:
+        """
+        Queues the regeneration of the public image of the digitalized
+        vouchers of the species, once the current transaction commits
+
+        Parameters
+        ----------
+        vouchers : List[int], optional
+            Vouchers to relabel, all the vouchers of the species by default
+
+        Returns
+        -------
+        None
+        """
+        logging.debug(f"Relabeling vouchers of {self.pk}")
+        queue_relabel_vouchers(Q(scientific_name_id=self.pk), vouchers=vouchers)
+        return
 
     class Meta:
         verbose_name = _("Species")
         verbose_name_plural = pgettext_lazy("plural", "Species")
         ordering = ['scientific_name']
+        indexes = [
+            GinIndex(fields=['scientific_name_db'], name='catalog_species_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
 
 class SynonymyQuerySet(AttributeQuerySet):
@@ -1507,46 +1874,39 @@ class Synonymy(ScientificName):
     def get_higher_classification(self) -> List[str]:
         return self.species.get_higher_classification()
 
+    def update_taxon_path(self) -> None:
+        return
+
     @classmethod
-    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), task: Task = None):
+    def get_dwc_query(cls, pk_range: Tuple[int, int] = None) -> Tuple[str, Dict]:
         from ..metadata.models import EML
         eml = EML.objects.get(pk=1)
-        objects = cls.objects.all()
-        rows = list()
-        logger.debug(f"Extracting data: synonyms")
-        current_total = 0
-        total = objects.count()
-        if task is not None:
-            async_result = AsyncResult(task.request.id)
-            current_total = async_result.info["total"]
-            total += current_total
-            task.update_state(state="PROGRESS",
-                              meta={"step": current_total, "total": total, "logs": logger[0].get_logs()})
-        for i, obj in enumerate(objects):
-            if task is not None:
-                task.update_state(state="PROGRESS",
-                                  meta={"step": i + current_total, "total": total, "logs": logger[0].get_logs()})
-            if obj.species is None:
-                logger.warning(f"Species not found on synonym {obj.name}")
-            else:
-                rows.append(
-                    [
-                        obj.taxon_id, obj.parent.taxon_id, obj.species.taxon_id,
-                        obj.species.taxon_id, obj.taxon_id, eml.package_id,
-                        "synonym", obj.taxon_rank.name_en, "", obj.dwc_scientific_name,
-                        obj.get_higher_classification()
-                    ] + obj.get_higher_classification()[0:6] + [
-                        obj.genus, None, obj.specific_epithet,
-                        obj.infraspecific_epithet, obj.authorship,
-                        None, None,
-                        "ICBN", None,
-                        obj.updated_at, "https://udec.cl", "UDEC",
-                        eml.dataset.title,
-                    ]
-                )
-        return pd.DataFrame(rows, columns=[
-            field.name for field in CATALOG_DWC_FIELDS
-        ])
+        return scientific_name_dwc_sql("synonymy", pk_range=pk_range), {
+            "package_id": eml.package_id,
+            "status": "synonym",
+            "dataset_name": eml.dataset.title,
+            "genus_type": ContentType.objects.get_for_model(Genus).pk,
+            "species_type": ContentType.objects.get_for_model(Species).pk,
+        }
+
+    @classmethod
+    def get_dwc_data(cls, logger: logging.Logger = logging.getLogger(__name__), progress: ProgressReporter = None):
+        logger.debug("Extracting data: synonyms")
+        for name in cls.objects.filter(species__isnull=True).values_list("scientific_name", flat=True):
+            logger.warning(f"Species not found on synonym {name}")
+        return read_dwc_data(*cls.get_dwc_query(), progress=progress)
+
+    @classmethod
+    def iter_dwc_data(
+            cls, logger: logging.Logger = logging.getLogger(__name__), pk_range: Tuple[int, int] = None
+    ) -> Iterator[Tuple]:
+        logger.debug("Streaming data: synonyms")
+        orphans = cls.objects.filter(species__isnull=True)
+        if pk_range is not None:
+            orphans = orphans.filter(pk__gte=pk_range[0], pk__lt=pk_range[1])
+        for name in orphans.values_list("scientific_name", flat=True):
+            logger.warning(f"Species not found on synonym {name}")
+        yield from stream_dwc_data(*cls.get_dwc_query(pk_range=pk_range))
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None, **kwargs):
         if force_update:
@@ -1571,6 +1931,9 @@ class Synonymy(ScientificName):
         verbose_name = _("Synonym")
         verbose_name_plural = _("Synonyms")
         ordering = ['scientific_name']
+        indexes = [
+            GinIndex(fields=['scientific_name_db'], name='catalog_synonymy_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
 
 class Binnacle(models.Model):
@@ -1,3 +1,37 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from apps.catalog.models import build_taxon_paths
+
+KINGDOM, GENUS, SPECIES = 1, 6, 7
+
+
+class BuildTaxonPathsTest(SimpleTestCase):
+    def build(self, species):
+        return build_taxon_paths(
+            [(KINGDOM, [(1, 10, "Plantae", None)]), (GENUS, [(1, 60, "Nothofagus", 10)])],
+            SPECIES, species
+        )
+
+    def test_infraspecific_chain(self):
+        nodes = self.build([
+            (1, 70, "Nothofagus obliqua", GENUS, 60),
+            (2, 71, "Nothofagus obliqua subsp. andina", SPECIES, 70),
+            (3, 72, "Nothofagus obliqua subsp. andina var. macrocarpa", SPECIES, 71),
+        ])
+        keys = [(content_type_id, pk) for content_type_id, pk, _, _, _ in nodes]
+        self.assertEqual(len(keys), len(set(keys)))
+        paths = {pk: path for content_type_id, pk, _, path, _ in nodes if content_type_id == SPECIES}
+        self.assertEqual(paths, {1: [10, 60, 70], 2: [10, 60, 70, 71], 3: [10, 60, 70, 71, 72]})
+
+    def test_child_before_parent(self):
+        nodes = self.build([
+            (2, 71, "Nothofagus obliqua subsp. andina", SPECIES, 70),
+            (1, 70, "Nothofagus obliqua", GENUS, 60),
+        ])
+        names = {pk: names for content_type_id, pk, _, _, names in nodes if content_type_id == SPECIES}
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[2], ["Plantae", "Nothofagus", "Nothofagus obliqua", "Nothofagus obliqua subsp. andina"])
+
+    def test_missing_parent(self):
+        nodes = self.build([(1, 70, "Nothofagus obliqua", GENUS, 99)])
+        self.assertEqual(nodes[-1], (SPECIES, 1, 70, [70], ["Nothofagus obliqua"]))
@@ -1,12 +1,11 @@
 import logging
 
-from copy import deepcopy
-
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q, QuerySet
 from django.utils.translation import gettext_lazy as _
 from typing import List
 
-from apps.catalog.models import Species, Habit
+from apps.catalog.models import Species, Habit, TaxonPath
 
 
 def get_habit(species: Species) -> str:
@@ -30,19 +29,10 @@ def get_conservation_status(species: Species) -> List[str]:
     return [f"{state.name} ({state.key})" for state in species.conservation_status.all()]
 
 
-def get_children(species: Species) -> List[Species]:
-    children = [species]
-    new_children = Species.objects.filter(
-        parent_content_type=ContentType.objects.get_for_model(Species),
-        parent_taxon_id=species.unique_taxon_id
+def get_children(species: Species) -> QuerySet:
+    descendants = TaxonPath.objects.descendants(species).filter(
+        content_type=ContentType.objects.get_for_model(Species)
+    )
+    return Species.objects.filter(
+        Q(pk=species.pk) | Q(pk__in=descendants.values("object_id"))
     )
-    while len(new_children) > 0:
-        children += new_children.all()
-        grand_children = list()
-        for new_child in new_children.all():
-            grand_children += Species.objects.filter(
-                parent_content_type=ContentType.objects.get_for_model(Species),
-                parent_taxon_id=new_child.unique_taxon_id
-            ).all()
-        new_children = deepcopy(grand_children)
-    return children
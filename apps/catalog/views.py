@@ -16,6 +16,7 @@ from django.db.models import Q
 from django.http import HttpResponse, JsonResponse, HttpRequest, HttpResponseServerError, HttpResponseRedirect
 from django.shortcuts import render, redirect
 from django.urls import reverse, resolve
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from rest_framework.serializers import SerializerMetaclass
 
@@ -609,11 +610,10 @@ def merge_taxa(request, taxa_1: int, taxa_2: int) -> HttpResponse:
             new_synonymy.save(user=request.user)
             species_2.synonyms.add(new_synonymy)
             logging.info(f"Assigning voucher for {species_1}")
-            for voucher in species_1.voucherimported_set.all():
-                voucher.scientific_name = species_2
-                voucher.save()
-                logging.info(f"Re-generating etiquette for {voucher.biodata_code.code}")
-                voucher.generate_etiquette()
+            vouchers = list(species_1.voucherimported_set.values_list("pk", flat=True))
+            species_1.voucherimported_set.update(scientific_name=species_2, updated_at=timezone.now())
+            logging.info(f"Re-generating etiquette for {len(vouchers)} vouchers")
+            species_2.relabel_vouchers(vouchers)
             Binnacle.delete_entry(species_1, request.user)
             CatalogView.refresh_view()
             FinderView.refresh_view()
@@ -0,0 +1,333 @@
+import logging
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Set, Union
+
+from apps.digitalization.utils import cr3_to_dng, rawtherapee_batch
+
+
+@contextmanager
+def timed(timings: Dict[str, float], name: str) -> Iterator[None]:
+    """
+    Adds the time spent inside the block to `timings[name]`
+
+    Parameters
+    ----------
+    timings : Dict[str, float]
+        Timings to update, if None nothing is recorded
+    name : str
+        Name of the step
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.monotonic() - start
+
+
+def __materialize_profile__(herbarium: str, color_profile: str, folder: str) -> str:
+    origin_profile = "assets/processing_profiles/herbarium_cdp_{}.pp3".format(herbarium)
+    profile = os.path.join(folder, "herbarium_cdp_{}.pp3".format(herbarium))
+    with open(origin_profile, "r") as file:
+        content = file.read()
+    with open(profile, "w") as file:
+        file.write(content.format(color_profile))
+    return profile
+
+
+def __jpeg_path__(raw_path: str, folder_out: str) -> str:
+    return os.path.join(folder_out, os.path.splitext(os.path.basename(raw_path))[0] + ".jpg")
+
+
+class RawConverter(ABC):
+    """
+    Converts RAW images (.CR3) to JPEG, first with the processing profile
+    of the herbarium and then with the color profile of the voucher.
+    Images are converted in batches, with a single rawtherapee invocation
+    and a single profile for all the images of a batch.
+    """
+    name = None
+
+    @abstractmethod
+    def prepare(
+            self, raw_path: str, folder_out: str, logger: logging.Logger,
+            log_cache: Set[str] = None, timings: Dict[str, float] = None
+    ) -> str:
+        """
+        Prepares the file given to rawtherapee for a RAW image
+
+        Parameters
+        ----------
+        raw_path : str
+            Path of the RAW image
+        folder_out : str
+            Folder where to put intermediate files
+        logger : Logger
+            Object Logger
+        log_cache : Set[str]
+            Current log
+        timings : Dict[str, float], optional
+            Time spent on every step of the conversion, updated in place
+
+        Returns
+        -------
+        str
+            Path of the file to give to rawtherapee
+        """
+        pass
+
+    def convert(
+            self, raw_path: str, folder_out: str, herbarium: str,
+            logger: logging.Logger, log_cache: Set[str] = None,
+            timings: Dict[str, float] = None
+    ) -> str:
+        """
+        Converts a RAW image to JPEG with the processing profile of the herbarium
+
+        Parameters
+        ----------
+        raw_path : str
+            Path of the RAW image
+        folder_out : str
+            Folder where to put converted files
+        herbarium : str
+            Herbarium code for retrieve format files
+        logger : Logger
+            Object Logger
+        log_cache : Set[str]
+            Current log
+        timings : Dict[str, float], optional
+            Time spent on every step of the conversion, updated in place
+
+        Returns
+        -------
+        str
+            Path of the JPEG image
+        """
+        output = self.convert_batch([raw_path], [folder_out], herbarium, logger, [log_cache], [timings])[0]
+        if output is None:
+            raise FileNotFoundError(f"File {raw_path} cannot be converted to .jpg")
+        return output
+
+    def convert_color_profile(
+            self, raw_path: str, folder_out: str, herbarium: str,
+            color_profile: str, logger: logging.Logger,
+            log_cache: Set[str] = None, timings: Dict[str, float] = None
+    ) -> str:
+        """
+        Converts again a RAW image to JPEG, replacing the previous one,
+        with the color profile given. The previous JPEG is kept if this conversion fails
+
+        Parameters
+        ----------
+        raw_path : str
+            Path of the RAW image
+        folder_out : str
+            Folder where the image was converted
+        herbarium : str
+            Herbarium code for retrieve format files
+        color_profile : str
+            Url of the color profile
+        logger : Logger
+            Object Logger
+        log_cache : Set[str]
+            Current log
+        timings : Dict[str, float], optional
+            Time spent on every step of the conversion, updated in place
+
+        Returns
+        -------
+        str
+            Path of the JPEG image
+        """
+        return self.convert_color_profile_batch(
+            [raw_path], [folder_out], herbarium, [color_profile], logger, [log_cache], [timings]
+        )[0]
+
+    def convert_batch(
+            self, raw_paths: List[str], folders_out: List[str], herbarium: str,
+            logger: logging.Logger, log_caches: List[Set[str]] = None,
+            timings: List[Dict[str, float]] = None
+    ) -> List[Union[str, None]]:
+        """
+        Converts RAW images to JPEG with the processing profile of the herbarium
+
+        Parameters
+        ----------
+        raw_paths : List[str]
+            Paths of the RAW images
+        folders_out : List[str]
+            Folder where to put converted files of every image
+        herbarium : str
+            Herbarium code for retrieve format files
+        logger : Logger
+            Object Logger
+        log_caches : List[Set[str]], optional
+            Current log of every image
+        timings : List[Dict[str, float]], optional
+            Time spent on every step of the conversion of every image, updated in place
+
+        Returns
+        -------
+        List[Union[str, None]]
+            Path of the JPEG of every image, None if its conversion failed
+        """
+        log_caches = log_caches if log_caches is not None else [None] * len(raw_paths)
+        timings = timings if timings is not None else [None] * len(raw_paths)
+        sources = self.__prepare_batch__(raw_paths, folders_out, logger, log_caches, timings)
+        profile = "assets/processing_profiles/herbarium_{}.pp3".format(herbarium)
+        return self.__develop__(sources, folders_out, profile, "jpeg", logger, log_caches, timings)
+
+    def convert_color_profile_batch(
+            self, raw_paths: List[str], folders_out: List[str], herbarium: str,
+            color_profiles: List[str], logger: logging.Logger,
+            log_caches: List[Set[str]] = None, timings: List[Dict[str, float]] = None
+    ) -> List[Union[str, None]]:
+        """
+        Converts again RAW images to JPEG with their color profile, the profile
+        is written once for all the images sharing it. The previous JPEG of an image
+        is kept if its conversion fails
+
+        Parameters
+        ----------
+        raw_paths : List[str]
+            Paths of the RAW images
+        folders_out : List[str]
+            Folder where every image was converted
+        herbarium : str
+            Herbarium code for retrieve format files
+        color_profiles : List[str]
+            Url of the color profile of every image
+        logger : Logger
+            Object Logger
+        log_caches : List[Set[str]], optional
+            Current log of every image
+        timings : List[Dict[str, float]], optional
+            Time spent on every step of the conversion of every image, updated in place
+
+        Returns
+        -------
+        List[Union[str, None]]
+            Path of the JPEG of every image, None if there is no JPEG for it
+        """
+        log_caches = log_caches if log_caches is not None else [None] * len(raw_paths)
+        timings = timings if timings is not None else [None] * len(raw_paths)
+        sources = self.__prepare_batch__(raw_paths, folders_out, logger, log_caches, timings)
+        outputs = [None] * len(raw_paths)
+        for color_profile in sorted(set(color_profiles)):
+            indexes = [i for i, profile in enumerate(color_profiles) if profile == color_profile]
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(folders_out[indexes[0]])) as profile_folder:
+                profile = __materialize_profile__(herbarium, color_profile, profile_folder)
+                converted = self.__develop__(
+                    [sources[i] for i in indexes], [folders_out[i] for i in indexes],
+                    profile, "color_profile", logger,
+                    [log_caches[i] for i in indexes], [timings[i] for i in indexes]
+                )
+            for i, output in zip(indexes, converted):
+                if output is None:
+                    previous = __jpeg_path__(raw_paths[i], folders_out[i])
+                    logger.warning("Error converting {} with color profile".format(previous))
+                    output = previous if os.path.exists(previous) else None
+                outputs[i] = output
+        return outputs
+
+    def __prepare_batch__(
+            self, raw_paths: List[str], folders_out: List[str], logger: logging.Logger,
+            log_caches: List[Set[str]], timings: List[Dict[str, float]]
+    ) -> List[Union[str, None]]:
+        sources = list()
+        for raw_path, folder_out, log_cache, timing in zip(raw_paths, folders_out, log_caches, timings):
+            os.makedirs(folder_out, exist_ok=True)
+            try:
+                sources.append(self.prepare(raw_path, folder_out, logger, log_cache, timing))
+            except Exception as e:
+                logger.error("Error preparing {}".format(raw_path))
+                logger.error(e, exc_info=True)
+                sources.append(None)
+        return sources
+
+    def __develop__(
+            self, sources: List[Union[str, None]], folders_out: List[str], profile: str,
+            step: str, logger: logging.Logger, log_caches: List[Set[str]],
+            timings: List[Dict[str, float]]
+    ) -> List[Union[str, None]]:
+        outputs = [None] * len(sources)
+        indexes = [i for i, source in enumerate(sources) if source is not None]
+        if len(indexes) == 0:
+            return outputs
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(folders_out[indexes[0]])) as batch_folder:
+            log_cache = set()
+            start = time.monotonic()
+            converted = rawtherapee_batch([sources[i] for i in indexes], batch_folder, profile, logger, log_cache)
+            elapsed = (time.monotonic() - start) / len(indexes)
+            for i in indexes:
+                if log_caches[i] is not None:
+                    log_caches[i].update(log_cache)
+                if timings[i] is not None:
+                    name = "{}.{}".format(self.name, step)
+                    timings[i][name] = timings[i].get(name, 0.0) + elapsed
+                if converted[sources[i]] is not None:
+                    outputs[i] = os.path.join(folders_out[i], os.path.basename(converted[sources[i]]))
+                    os.replace(converted[sources[i]], outputs[i])
+        return outputs
+
+
+class CLIConverter(RawConverter):
+    """
+    Converts the RAW image to DNG with dnglab and the DNG to JPEG with rawtherapee-cli
+    """
+    name = "cli"
+
+    def prepare(
+            self, raw_path: str, folder_out: str, logger: logging.Logger,
+            log_cache: Set[str] = None, timings: Dict[str, float] = None
+    ) -> str:
+        dng_path = os.path.join(folder_out, os.path.splitext(os.path.basename(raw_path))[0] + ".dng")
+        if not os.path.exists(dng_path):
+            with timed(timings, "cli.dng"):
+                cr3_to_dng(os.path.dirname(raw_path), folder_out, logger, log_cache)
+        if not os.path.exists(dng_path):
+            raise FileNotFoundError(f"File {raw_path} cannot be converted to .dng")
+        return dng_path
+
+
+class RawTherapeeConverter(RawConverter):
+    """
+    Converts the RAW image to JPEG with rawtherapee-cli directly, without a DNG intermediate
+    """
+    name = "rawtherapee"
+
+    def prepare(
+            self, raw_path: str, folder_out: str, logger: logging.Logger,
+            log_cache: Set[str] = None, timings: Dict[str, float] = None
+    ) -> str:
+        return raw_path
+
+
+CONVERTERS = {
+    CLIConverter.name: CLIConverter,
+    RawTherapeeConverter.name: RawTherapeeConverter,
+}
+
+
+def get_converter(name: str) -> RawConverter:
+    """
+    Converter by name
+
+    Parameters
+    ----------
+    name : str
+        Name of the converter (`cli` or `rawtherapee`)
+
+    Returns
+    -------
+    RawConverter
+        Converter instance
+    """
+    if name not in CONVERTERS:
+        raise ValueError("Unknown RAW converter `{}`, options are: {}".format(name, ", ".join(CONVERTERS)))
+    return CONVERTERS[name]()
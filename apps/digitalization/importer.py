@@ -0,0 +1,346 @@
+import datetime as dt
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+import pandas as pd
+import pytz
+from django.db import connection, transaction
+
+from apps.catalog.models import Species
+from apps.digitalization.models import BiodataCode, PriorityVouchersFile, VoucherImported
+
+IMPORT_CHUNK_SIZE = 1000
+OCCUPIED_STATES = [0, 1, 7, 8]
+SIMILARITY_THRESHOLD = 0.55
+
+
+SPECIES_SIMILARITY_SQL = """
+SELECT query.name, candidate.scientific_name, candidate.similarity
+FROM unnest(%s::text[]) AS query(name)
+CROSS JOIN LATERAL (
+    SELECT species.scientific_name,
+           similarity(species.scientific_name_db, query.name) AS similarity
+    FROM catalog_species AS species
+    WHERE species.scientific_name_db %% query.name
+    ORDER BY similarity DESC
+    LIMIT 1
+) AS candidate
+WHERE candidate.similarity >= %s
+"""
+
+SYNONYMY_SIMILARITY_SQL = """
+SELECT query.name, candidate.species_name, candidate.scientific_name, candidate.similarity
+FROM unnest(%s::text[]) AS query(name)
+CROSS JOIN LATERAL (
+    SELECT species.scientific_name AS species_name,
+           synonymy.scientific_name,
+           similarity(synonymy.scientific_name_db, query.name) AS similarity
+    FROM catalog_synonymy AS synonymy
+    LEFT JOIN catalog_species AS species ON species.id = synonymy.species_id
+    WHERE synonymy.scientific_name_db %% query.name
+    ORDER BY similarity DESC
+    LIMIT 1
+) AS candidate
+WHERE candidate.similarity >= %s
+"""
+
+
+class SpeciesResolver:
+    def __init__(self, logger: logging.Logger, chunk_size: int = IMPORT_CHUNK_SIZE) -> None:
+        """
+        Resolves scientific names to species in batches, keeping every
+        name already resolved so repeated names do not query the database.
+        Names not found are compared by trigram similarity with species
+        and then with synonyms, to report the closest one
+
+        Parameters
+        ----------
+        logger : Logger
+            Object to manage logs
+        chunk_size : int
+            Number of names per query
+        """
+        self.__logger__ = logger
+        self.__chunk_size__ = chunk_size
+        self.__memo__: Dict[str, Tuple[Union[Species, None], Dict[str, Any]]] = dict()
+        return
+
+    def resolve(self, names: Iterable[str]) -> None:
+        """
+        Resolves all the names not resolved yet, with one exact query
+        and up to two similarity queries per chunk of names
+
+        Parameters
+        ----------
+        names : Iterable[str]
+            Scientific names
+
+        Returns
+        -------
+        None
+        """
+        pending = sorted(set([name.strip() for name in names]) - set(self.__memo__.keys()))
+        for chunk in __chunks__(pending, self.__chunk_size__):
+            for species in Species.objects.filter(scientific_name_db__in=chunk):
+                self.__memo__[species.scientific_name_db] = (species, dict())
+            missing = [name for name in chunk if name not in self.__memo__]
+            if len(missing) == 0:
+                continue
+            self.__logger__.warning("Searching {} names using trigram similarity".format(len(missing)))
+            for name, info in self.__similar__(missing).items():
+                self.__memo__[name] = (None, info)
+        return
+
+    def __similar__(self, names: List[str]) -> Dict[str, Dict[str, Any]]:
+        queries = dict()
+        for name in names:
+            queries.setdefault(name.upper(), list()).append(name)
+        similar = dict()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                [str(SIMILARITY_THRESHOLD)]
+            )
+            cursor.execute(SPECIES_SIMILARITY_SQL, [list(queries.keys()), SIMILARITY_THRESHOLD])
+            for query, scientific_name, similarity in cursor.fetchall():
+                self.__logger__.debug("Similarity found on accepted species")
+                if similarity < 1:
+                    info = {
+                        'similarity': similarity,
+                        'scientific_name_similarity': scientific_name,
+                        'synonymy_similarity': '',
+                    }
+                else:
+                    self.__logger__.warning("Error on similarity found")
+                    info = dict()
+                for name in queries[query]:
+                    similar[name] = info
+            remaining = [query for query, query_names in queries.items() if query_names[0] not in similar]
+            if len(remaining) > 0:
+                cursor.execute(SYNONYMY_SIMILARITY_SQL, [remaining, SIMILARITY_THRESHOLD])
+                for query, species_name, scientific_name, similarity in cursor.fetchall():
+                    self.__logger__.debug("Similarity found on synonym")
+                    for name in queries[query]:
+                        similar[name] = {
+                            'similarity': similarity,
+                            'scientific_name_similarity': species_name,
+                            'synonymy_similarity': scientific_name,
+                        }
+        for name in names:
+            if name not in similar:
+                self.__logger__.warning("No similarity found for {}".format(name))
+                similar[name] = {
+                    'similarity': 0,
+                    'scientific_name_similarity': '',
+                    'synonymy_similarity': '',
+                }
+        return similar
+
+    def get_species(self, data_candid: pd.Series) -> Tuple[Species, pd.Series]:
+        """
+        Species of a row of an import file
+
+        Parameters
+        ----------
+        data_candid : Series
+            Row with a `scientific_name` column
+
+        Returns
+        -------
+        Tuple[Species, Series]
+            Species, None if not found, and the row with the closest names
+            found by similarity when the species was not found
+        """
+        name = data_candid["scientific_name"].strip()
+        if name not in self.__memo__:
+            self.resolve([name])
+        species, similarity = self.__memo__[name]
+        info = data_candid.copy(deep=True)
+        for key, value in similarity.items():
+            info[key] = value
+        if species is not None:
+            self.__logger__.debug(f"Species {name} found")
+        return species, info
+
+
+def get_species(data_candid: pd.Series, logger: logging.Logger) -> Tuple[Species, pd.Series]:
+    return SpeciesResolver(logger).get_species(data_candid)
+
+
+def __chunks__(values: List, size: int) -> List[List]:
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+class PriorityVouchersImporter:
+    def __init__(
+            self, priorities: PriorityVouchersFile,
+            logger: logging.Logger, chunk_size: int = IMPORT_CHUNK_SIZE
+    ) -> None:
+        """
+        Imports the rows of a priority vouchers file with a fixed number of
+        queries: codes and species are looked up with one query per chunk
+        and new rows are written with `bulk_create`
+
+        Parameters
+        ----------
+        priorities : PriorityVouchersFile
+            File being imported
+        logger : Logger
+            Object to manage logs
+        chunk_size : int
+            Number of rows per query
+        """
+        self.__priorities__ = priorities
+        self.__logger__ = logger
+        self.__chunk_size__ = chunk_size
+        self.__species__ = SpeciesResolver(logger, chunk_size=chunk_size)
+        self.database_errors: List[pd.Series] = list()
+        self.species_errors: List[pd.Series] = list()
+        self.voucher_errors: List[pd.Series] = list()
+        self.errors: List[pd.Series] = list()
+        return
+
+    def __code__(self, catalog_number: int) -> Union[str, None]:
+        try:
+            return "{}:{}:{:07d}".format(
+                self.__priorities__.herbarium.institution_code,
+                self.__priorities__.herbarium.collection_code,
+                catalog_number
+            )
+        except Exception as e:
+            self.__logger__.error(e, exc_info=True)
+            return None
+
+    def __existing_codes__(self, codes: List[str]) -> Dict[str, BiodataCode]:
+        existing = dict()
+        for chunk in __chunks__(codes, self.__chunk_size__):
+            for biodata_code in BiodataCode.objects.filter(code__in=chunk):
+                existing[biodata_code.code] = biodata_code
+        return existing
+
+    def run(self, data: pd.DataFrame, progress: Callable[[int, int], None] = None) -> None:
+        """
+        Imports the rows of the file, rows with errors are kept on
+        `database_errors`, `species_errors`, `voucher_errors` and `errors`
+
+        Parameters
+        ----------
+        data : DataFrame
+            Rows of the file, with the columns renamed to database names
+        progress : Callable[[int, int], None], optional
+            Called with the current step and total of steps
+
+        Returns
+        -------
+        None
+        """
+        total = len(data)
+        if progress is None:
+            progress = lambda step, steps: None
+        codes = data["catalog_number"].map(self.__code__)
+        for index in codes[codes.isnull()].index:
+            self.errors.append(data.loc[index])
+        valid_codes = [code for code in codes if code is not None]
+        existing = self.__existing_codes__(valid_codes)
+        to_delete = list()
+        rows: List[Tuple[pd.Series, str]] = list()
+        for (index, row), code in zip(data.iterrows(), codes):
+            if code is None:
+                continue
+            if code in existing:
+                self.__logger__.warning(f"Code {code} already on database")
+                biodata_code = existing[code]
+                if biodata_code.voucher_state in OCCUPIED_STATES:
+                    self.__logger__.error(
+                        f"{code} is assigned to a '{biodata_code.get_voucher_state_display()}' voucher"
+                    )
+                    self.database_errors.append(row)
+                    continue
+                self.__logger__.debug(f"Overwriting code '{code}'")
+                to_delete.append(biodata_code.pk)
+            rows.append((row, code))
+        progress(total // 4, total)
+        names = set([str(row["scientific_name"]) for row, _ in rows])
+        self.__species__.resolve(names)
+        self.__logger__.debug(f"{len(names)} different names resolved")
+        candidates: List[Tuple[pd.Series, str, Species]] = list()
+        for row, code in rows:
+            try:
+                row_species, info = self.__species__.get_species(row)
+            except Exception as e:
+                self.__logger__.error(e, exc_info=True)
+                self.errors.append(row)
+                continue
+            if row_species is None:
+                self.species_errors.append(info)
+                continue
+            candidates.append((row, code, row_species))
+        progress(total // 2, total)
+        biodata_codes = list()
+        vouchers = list()
+        created_at = dt.datetime.now(tz=pytz.timezone('America/Santiago'))
+        for row, code, row_species in candidates:
+            biodata_code = BiodataCode(
+                herbarium=self.__priorities__.herbarium,
+                code=code,
+                catalog_number=row["catalog_number"],
+                created_by=self.__priorities__.created_by,
+                created_at=created_at,
+                qr_generated=False
+            )
+            try:
+                voucher_imported = VoucherImported.from_pandas_row(
+                    row, self.__priorities__, species=row_species, biodata_code=biodata_code, logger=self.__logger__
+                )
+            except AssertionError as e:
+                row["assertion"] = str(e)
+                self.voucher_errors.append(row)
+                continue
+            except Exception as e:
+                self.__logger__.error(e, exc_info=True)
+                self.errors.append(row)
+                continue
+            biodata_codes.append((row, biodata_code))
+            vouchers.append(voucher_imported)
+        if self.has_errors():
+            self.__logger__.info("Errors found, nothing written on database")
+            return
+        self.__write__(to_delete, biodata_codes, vouchers, progress, total)
+        return
+
+    def __write__(
+            self, to_delete: List[int], biodata_codes: List[Tuple[pd.Series, BiodataCode]],
+            vouchers: List[VoucherImported], progress: Callable[[int, int], None], total: int
+    ) -> None:
+        try:
+            for chunk in __chunks__(to_delete, self.__chunk_size__):
+                BiodataCode.objects.filter(pk__in=chunk).delete()
+        except Exception as e:
+            self.__logger__.error(e, exc_info=True)
+            self.errors += [row for row, _ in biodata_codes]
+            return
+        written = 0
+        chunks = list(zip(
+            __chunks__(biodata_codes, self.__chunk_size__),
+            __chunks__(vouchers, self.__chunk_size__)
+        ))
+        for biodata_chunk, voucher_chunk in chunks:
+            try:
+                BiodataCode.objects.bulk_create([biodata_code for _, biodata_code in biodata_chunk])
+                for (_, biodata_code), voucher_imported in zip(biodata_chunk, voucher_chunk):
+                    voucher_imported.biodata_code = biodata_code
+                VoucherImported.objects.bulk_create(voucher_chunk)
+            except Exception as e:
+                self.__logger__.error(e, exc_info=True)
+                self.errors += [row for row, _ in biodata_chunk]
+                return
+            written += len(biodata_chunk)
+            self.__logger__.debug(f"{written} new occurrences added")
+            progress(total // 2 + (total - total // 2) * written // max(len(biodata_codes), 1), total)
+        return
+
+    def has_errors(self) -> bool:
+        return (
+            len(self.database_errors) > 0 or len(self.species_errors) > 0 or
+            len(self.voucher_errors) > 0 or len(self.errors) > 0
+        )
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from apps.digitalization.utils import change_image_resolution, derivative_scales, image_derivatives
+
+
+def __memory__(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+def __legacy__(image_path: str, scales: dict) -> None:
+    with open(image_path, "rb") as file:
+        image = Image.open(file)
+        for scale_percent in scales.values():
+            change_image_resolution(image, scale_percent)
+
+
+def __derivatives__(image_path: str, scales: dict) -> None:
+    image_derivatives(image_path, scales)
+
+
+def __measure__(function, image_path: str, scales: dict, repeat: int, results: multiprocessing.Queue) -> None:
+    baseline = __memory__("VmRSS")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(image_path, scales)
+    elapsed = (time.perf_counter() - start) / repeat
+    results.put((elapsed, __memory__("VmHWM") - baseline))
+
+
+class Command(BaseCommand):
+    help = "Compares wall time and peak memory of generating the scaled copies of a voucher image"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--image', type=str, default=None, help='JPEG image, a 6000x4000 sample by default')
+        parser.add_argument('--herbarium', type=str, default=None, help='Collection code to get scales from')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each implementation')
+
+    def handle(self, *args, **kwargs):
+        scales = derivative_scales(kwargs['herbarium'])
+        with tempfile.TemporaryDirectory() as folder:
+            image_path = kwargs['image']
+            if image_path is None:
+                image_path = os.path.join(folder, "sample.jpg")
+                gradient = np.linspace(0, 223, 6000, dtype=np.uint8)
+                noise = np.random.default_rng(0).integers(0, 32, (4000, 6000, 3), dtype=np.uint8)
+                sample = np.broadcast_to(np.dstack([gradient] * 3), (4000, 6000, 3)) + noise
+                Image.fromarray(sample, "RGB").save(image_path, format="JPEG", quality=95)
+            self.stdout.write("Scales: {}".format(scales))
+            context = multiprocessing.get_context("fork")
+            for name, function in [("legacy", __legacy__), ("single decode", __derivatives__)]:
+                results = context.Queue()
+                process = context.Process(
+                    target=__measure__, args=(function, image_path, scales, kwargs['repeat'], results)
+                )
+                process.start()
+                elapsed, peak = results.get()
+                process.join()
+                self.stdout.write("{}: {:.1f} ms per image, {:.1f} MB peak RSS over baseline".format(
+                    name, 1000 * elapsed, peak / 1024
+                ))
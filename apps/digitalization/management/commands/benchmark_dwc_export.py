@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from apps.digitalization.models import VoucherImported
+
+
+class Command(BaseCommand):
+    help = "Compares time and queries of the occurrence DwC exporters over a sample of vouchers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100000, help='Vouchers on the sample')
+        parser.add_argument('--herbarium', type=int, default=None, help='Herbarium of the vouchers')
+        parser.add_argument('--skip-legacy', action='store_true', help='Only run the current exporter')
+
+    def handle(self, *args, **kwargs):
+        sample = VoucherImported.objects.all()
+        if kwargs['herbarium'] is not None:
+            sample = sample.filter(herbarium_id=kwargs['herbarium'])
+        vouchers = VoucherImported.objects.filter(
+            pk__in=sample.order_by("pk").values("pk")[:kwargs['limit']]
+        ).order_by("pk")
+        exporters = [("values", lambda: vouchers.get_dwc_data())]
+        if not kwargs['skip_legacy']:
+            exporters.append(("legacy", lambda: vouchers.get_dwc_data_legacy()))
+        results = dict()
+        for name, exporter in exporters:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                results[name] = exporter()
+                elapsed = time.perf_counter() - start
+            self.stdout.write("{}: {} rows, {} queries, {:.2f} s".format(
+                name, len(results[name]), len(queries), elapsed
+            ))
+        if len(results) == 2:
+            legacy = results["legacy"].astype(str)
+            current = results["values"].astype(str)
+            for column in legacy.columns:
+                different = (legacy[column] != current[column]).sum()
+                if different > 0:
+                    self.stdout.write("Column {} differs on {} rows".format(column, different))
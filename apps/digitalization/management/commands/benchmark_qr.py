@@ -0,0 +1,52 @@
+import glob
+import logging
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.digitalization.models import Herbarium
+from apps.digitalization.utils import LabelPositionPrior, read_qr, read_qr_legacy
+
+
+class Command(BaseCommand):
+    help = "Compares decode rate and time per image of QR readers over a folder of images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('folder', type=str, help='Folder with .jpg images')
+        parser.add_argument('--herbarium', type=str, default=None, help='Herbarium of the images')
+
+    def handle(self, *args, **kwargs):
+        folder = kwargs['folder']
+        herbarium = Herbarium.objects.filter(collection_code=kwargs['herbarium']).first()
+        positions = LabelPositionPrior(herbarium.id, persist=False) if herbarium is not None else None
+        logger = logging.getLogger(__name__)
+        images = sorted(
+            glob.glob(os.path.join(folder, "*.jpg")) + glob.glob(os.path.join(folder, "*.JPG"))
+        )
+        if len(images) == 0:
+            self.stderr.write("No images found on {}".format(folder))
+            return
+        results = dict()
+        for name, reader in [
+            ("legacy", lambda filename: read_qr_legacy(filename, logger)),
+            ("single pass", lambda filename: read_qr(filename, logger, positions=positions)),
+        ]:
+            decoded = dict()
+            start = time.perf_counter()
+            for image in images:
+                decoded[image] = reader(image)
+            elapsed = time.perf_counter() - start
+            results[name] = decoded
+            found = sum([code is not None for code in decoded.values()])
+            self.stdout.write("{}: {}/{} decoded ({:.1f}%), {:.1f} ms per image".format(
+                name, found, len(images), 100 * found / len(images), 1000 * elapsed / len(images)
+            ))
+        mismatches = [
+            image for image in images
+            if results["legacy"][image] is not None
+            and results["single pass"][image] is not None
+            and results["legacy"][image] != results["single pass"][image]
+        ]
+        for image in mismatches:
+            self.stdout.write("Different code on {}".format(image))
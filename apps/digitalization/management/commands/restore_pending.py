@@ -1,49 +1,23 @@
-import time
-
-import boto3
 from django.core.management.base import BaseCommand
 
-from apps.digitalization.models import VoucherImported
+from apps.digitalization.models import RawRestore
+from apps.digitalization.tasks import restore_pending_vouchers
 from intranet.utils import send_mail
 
 
 class Command(BaseCommand):
+    help = "Checks once the restore of pending raw images, restored vouchers are queued to be processed"
+
     def add_arguments(self, parser):
-        parser.add_argument('mail', type=str, help='Mail address to notified')
+        parser.add_argument('mail', type=str, nargs='?', default=None, help='Mail address to notified')
 
     def handle(self, *args, **kwargs):
-        mail_to_notify = kwargs['mail']
-        s3 = boto3.client('s3')
-        objects = VoucherImported.objects.filter(biodata_code__voucher_state=8)
-        total = objects.count()
-        obj_to_restore = [(obj, 0) for obj in objects]
-        restored = sum([state == 2 for _, state in obj_to_restore])
-        while restored < total:
-            for i, (obj, state) in enumerate(obj_to_restore):
-                bucket_name = obj.image_raw.storage.bucket_name
-                image_key = obj.image_raw.storage.location + "/" + obj.image_raw.name
-                if state == 2:
-                    continue
-                response = s3.head_object(Bucket=bucket_name, Key=image_key)
-                if response["StorageClass"] == 'DEEP_ARCHIVE':
-                    if 'Restore' in response:
-                        if 'ongoing-request="true"' in response['Restore']:
-                            obj_to_restore[i] = (obj, 1)
-                        else:
-                            obj_to_restore[i] = (obj, 2)
-                    else:
-                        s3.restore_object(
-                            Bucket=bucket_name,
-                            Key=image_key,
-                            RestoreRequest={
-                                'Days': 7,
-                                'GlacierJobParameters': {
-                                    'Tier': 'Standard',
-                                }
-                            }
-                        )
-            restored = sum([state == 2 for _, state in obj_to_restore])
-            print("Object restored: {}/{}".format(restored, total), end="\t")
-            print("Object in progress: {}/{}".format(sum([state == 1 for _, state in obj_to_restore]), total))
-            time.sleep(10 * 60)
-        send_mail("Everything restored", mail_to_notify,"Pending images")
+        self.stdout.write(restore_pending_vouchers())
+        unresolved = RawRestore.objects.filter(state__in=[RawRestore.PENDING, RawRestore.REQUESTED]).count()
+        self.stdout.write("Object in progress: {}".format(unresolved))
+        for restore in RawRestore.objects.filter(state=RawRestore.FAILED):
+            self.stdout.write("Failed {}, next retry at {}: {}".format(
+                restore.voucher_id, restore.next_check, restore.error
+            ))
+        if kwargs['mail'] is not None and unresolved == 0:
+            send_mail("Everything restored", kwargs['mail'], "Pending images")
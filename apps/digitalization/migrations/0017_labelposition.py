@@ -0,0 +1,36 @@
+# Generated by Django 5.1.6 on 2026-10-17 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digitalization', '0016_remove_herbarium_name_en_remove_herbarium_name_es'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelPosition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('row', models.PositiveSmallIntegerField(verbose_name='Row')),
+                ('column', models.PositiveSmallIntegerField(verbose_name='Column')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('center_x', models.FloatField(default=0, verbose_name='Center X')),
+                ('center_y', models.FloatField(default=0, verbose_name='Center Y')),
+                ('width', models.FloatField(default=0, verbose_name='Width')),
+                ('height', models.FloatField(default=0, verbose_name='Height')),
+                ('herbarium', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='label_positions', to='digitalization.herbarium', verbose_name='Herbarium')),
+            ],
+            options={
+                'verbose_name': 'Label Position',
+                'verbose_name_plural': 'Label Positions',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='labelposition',
+            constraint=models.UniqueConstraint(fields=('herbarium', 'row', 'column'), name='unique label position'),
+        ),
+    ]
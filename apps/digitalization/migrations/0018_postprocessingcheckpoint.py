@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-17 11:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digitalization', '0017_labelposition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostprocessingCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('institution', models.CharField(max_length=50, verbose_name='Institution')),
+                ('session', models.CharField(max_length=300, verbose_name='Session')),
+                ('filename', models.CharField(max_length=300, verbose_name='File Name')),
+                ('state', models.IntegerField(choices=[(0, 'Pending'), (1, 'Downloaded'), (2, 'Converted'), (3, 'QR Decoded'), (4, 'Color Profiled'), (5, 'Uploaded')], default=0, verbose_name='State')),
+                ('qr_code', models.TextField(blank=True, null=True, verbose_name='QR Code')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated at')),
+                ('voucher', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='digitalization.voucherimported', verbose_name='Voucher')),
+            ],
+            options={
+                'verbose_name': 'Postprocessing Checkpoint',
+                'verbose_name_plural': 'Postprocessing Checkpoints',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='postprocessingcheckpoint',
+            constraint=models.UniqueConstraint(fields=('institution', 'session', 'filename'), name='unique checkpoint'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-17 14:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digitalization', '0018_postprocessingcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawRestore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.IntegerField(choices=[(0, 'Pending'), (1, 'Requested'), (2, 'Restored'), (3, 'Queued'), (4, 'Failed')], default=0, verbose_name='State')),
+                ('checks', models.IntegerField(default=0, verbose_name='Checks')),
+                ('next_check', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next check')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Error')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated at')),
+                ('voucher', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='raw_restore', to='digitalization.voucherimported', verbose_name='Voucher')),
+            ],
+            options={
+                'verbose_name': 'Raw Restore',
+                'verbose_name_plural': 'Raw Restores',
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digitalization', '0019_rawrestore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voucherimported',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Updated at'),
+            preserve_default=False,
+        ),
+    ]
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import celery
 import logging
@@ -10,7 +11,6 @@ import math
 import numpy as np
 import pandas as pd
 import pytz
-from celery.app.task import Task
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -18,20 +18,22 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db import models
 from django.contrib.gis.db.models import GeometryField
 from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.postgres.expressions import ArraySubquery
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile, File
-from django.db import connection
-from django.db.models import Q
-from django.db.models.signals import post_delete, pre_save
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Q
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.forms import CharField
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from typing import BinaryIO, Union, Any, Tuple, Callable, Dict, List
+from typing import BinaryIO, Union, Any, Tuple, Callable, Dict, List, Iterator
 
 from apps.catalog.models import Species, TAXONOMIC_RANK, RANK_MODELS, get_fuzzy_taxa, TaxonomicModel
 from apps.metadata.models import EML, Licence
 import dwca.terms as dwc
-from intranet.utils import CatalogQuerySet
+from intranet.utils import CatalogQuerySet, ProgressReporter
 from .storage_backends import PublicMediaStorage, PrivateMediaStorage, GlacierPrivateMediaStorage, IAPrivateMediaStorage
 from .validators import validate_file_size
 
@@ -105,6 +107,13 @@ HERBARIUM_DWC_FIELDS = [
 ]
 
 
+def first_not_none(*values: Any) -> Any:
+    for value in values:
+        if value is not None:
+            return value
+    return None
+
+
 class Herbarium(models.Model):
     name = models.CharField(verbose_name=_("Name"), max_length=300, blank=False, null=False)
     collection_code = models.CharField(verbose_name=_("Collection Code"), max_length=6, blank=False, null=False,
@@ -314,25 +323,107 @@ class VoucherImportedQuerySet(CatalogQuerySet):
     def search(self, text: str) -> CatalogQuerySet:
         return self.filter(scientific_name__scientific_name__icontains=text)
 
-    def get_dwc_data(self, logger: logging.Logger = logging.getLogger(__name__), task: Task = None) -> pd.DataFrame:
-        vouchers = self.all()
-        if task is not None:
-            task.update_state(
-                state='PROGRESS',
-                meta={
-                    'step': 0,
-                    'total': self.count(),
-                    'logs': logger[0].get_logs()
-                }
+    def get_dwc_data(
+            self, logger: logging.Logger = logging.getLogger(__name__), progress: ProgressReporter = None
+    ) -> pd.DataFrame:
+        species = "scientific_name__"
+        rows = list(self.annotate(
+            type_statuses=ArraySubquery(TypeStatus.objects.filter(specimen=OuterRef("pk")).values("type"))
+        ).values_list(
+            "pk", "biodata_code__created_at", "herbarium_id",
+            "catalog_number", "record_number", "recorded_by", "organism_remarks",
+            "other_catalog_numbers", "identified_by", "verbatim_elevation",
+            "decimal_latitude_public", "decimal_longitude_public",
+            "georeferenced_date", "date_identified", "type_statuses",
+            species + "scientific_name_full",
+            species + "genus__family__order__classname__division__kingdom__name",
+            species + "genus__family__name", species + "genus__name",
+            species + "specific_epithet", species + "form", species + "variety", species + "subspecies",
+            species + "taxon_rank__name_en",
+            species + "form_authorship", species + "variety_authorship",
+            species + "ssp_authorship", species + "scientific_name_authorship",
+        ))
+        logger.debug(f"Extracting data: {len(rows)} vouchers")
+        if progress is not None:
+            progress.update(progress.extend(len(rows)) + len(rows))
+        if len(rows) == 0:
+            return pd.DataFrame(columns=[field.name for field in HERBARIUM_DWC_FIELDS])
+        (
+            pk, created_at, herbarium_id,
+            catalog_number, record_number, recorded_by, organism_remarks,
+            other_catalog_numbers, identified_by, verbatim_elevation,
+            latitude, longitude,
+            georeferenced_date, date_identified, type_statuses,
+            scientific_name_full, kingdom, family, genus,
+            specific_epithet, form, variety, subspecies,
+            taxon_rank,
+            form_authorship, variety_authorship,
+            ssp_authorship, scientific_name_authorship,
+        ) = zip(*rows)
+        herbaria = dict()
+        for herbarium in Herbarium.objects.filter(pk__in=set(herbarium_id)).select_related("metadata__dataset"):
+            herbaria[herbarium.pk] = (herbarium, herbarium.metadata.dataset.licensed.first().link)
+        typification = dict(TYPIFICATION)
+        columns = [
+            [f"{settings.HERBARIUM_FRONTEND}/images/zoom/{voucher_id}/" for voucher_id in pk],
+            created_at,
+            [herbaria[key][1] for key in herbarium_id],
+            [herbaria[key][0].name for key in herbarium_id],
+            [herbaria[key][0].institution_code for key in herbarium_id],
+            [herbaria[key][0].collection_code for key in herbarium_id],
+            [herbaria[key][0].name for key in herbarium_id],
+            ["PreservedSpecimen"] * len(rows),
+            [str(value) for value in catalog_number],
+            record_number,
+            [[value] for value in recorded_by],
+            organism_remarks,
+            [[value] for value in other_catalog_numbers],
+            [[value] for value in identified_by],
+            [str(value) for value in verbatim_elevation],
+            latitude,
+            longitude,
+            [None if value is None else datetime.combine(value, datetime.min.time()) for value in georeferenced_date],
+            [None if value is None else datetime(year=value, month=1, day=1) for value in date_identified],
+            [[str(typification.get(value, value)) for value in values] for values in type_statuses],
+            scientific_name_full,
+            kingdom,
+            family,
+            genus,
+            specific_epithet,
+            [first_not_none(*values) for values in zip(form, variety, subspecies)],
+            taxon_rank,
+            [first_not_none(*values) for values in zip(
+                form_authorship, variety_authorship, ssp_authorship, scientific_name_authorship
+            )],
+        ]
+        return pd.DataFrame({
+            field.name: list(column) for field, column in zip(HERBARIUM_DWC_FIELDS, columns)
+        })
+
+    def iter_dwc_data(self, logger: logging.Logger = logging.getLogger(__name__)) -> Iterator[Tuple]:
+        chunk_size = settings.DWC_EXPORT_CHUNK_SIZE
+        last_id = 0
+        while True:
+            voucher_ids = list(
+                self.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:chunk_size]
             )
+            if len(voucher_ids) == 0:
+                break
+            data = VoucherImported.objects.filter(pk__in=voucher_ids).order_by("pk").get_dwc_data(logger=logger)
+            yield from data.itertuples(index=False, name=None)
+            last_id = voucher_ids[-1]
+
+    def get_dwc_data_legacy(
+            self, logger: logging.Logger = logging.getLogger(__name__), progress: ProgressReporter = None
+    ) -> pd.DataFrame:
+        vouchers = self.all()
+        current_total = 0
+        if progress is not None:
+            current_total = progress.extend(self.count())
         rows = list()
         for i, obj in enumerate(vouchers):
-            if task is not None:
-                task.update_state(state='PROGRESS', meta={
-                    'step': i,
-                    'total': self.count(),
-                    'logs': logger[0].get_logs()
-                })
+            if progress is not None:
+                progress.update(i + current_total)
             rows.append(
                 [
                     f"{settings.HERBARIUM_FRONTEND}/images/zoom/{obj.pk}/",
@@ -368,6 +459,12 @@ class VoucherImportedQuerySet(CatalogQuerySet):
         return pd.DataFrame(rows, columns=[field.name for field in HERBARIUM_DWC_FIELDS])
 
 
+IMAGE_FIELDS = [
+    "image", "image_resized_10", "image_resized_60",
+    "image_public", "image_public_resized_10", "image_public_resized_60",
+    "image_raw",
+]
+
 
 class VoucherImported(models.Model):
     vouchers_file = models.ForeignKey(PriorityVouchersFile, verbose_name=_("Priority Vouchers File"),
@@ -407,6 +504,7 @@ class VoucherImported(models.Model):
     decimal_longitude_public = models.FloatField(verbose_name=_("Public Longitude"), blank=True, null=True)
     point_public = models.PointField(verbose_name=_("Public Point"), null=True, blank=True, )
     priority = models.IntegerField(verbose_name=_("Priority"), blank=True, null=True, default=3)
+    updated_at = models.DateTimeField(verbose_name=_("Updated at"), auto_now=True)
 
     objects = VoucherImportedQuerySet.as_manager()
 
@@ -414,17 +512,32 @@ class VoucherImported(models.Model):
         verbose_name = _("Voucher")
         verbose_name_plural = _("Vouchers")
 
-    def generate_etiquette(self):
-        if self.biodata_code.voucher_state == 7:
-            logging.debug("Regenerating public image ({})".format(self.pk))
-            self.biodata_code.voucher_state = 8
-            self.biodata_code.save()
-            self.save()
-            celery.current_app.send_task('etiquette_picture', (self.pk,))
-            return
-        else:
-            logging.debug("Voucher not digitalized, skipping ({})".format(self.pk))
-            return
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_images__ = self.image_names()
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self.__original_images__.update({
+            field: name for field, name in self.image_names().items()
+            if fields is None or field in fields
+        })
+
+    def image_names(self) -> Dict[str, str]:
+        """
+        Names of the image files loaded on the instance, deferred fields are not included
+
+        Returns
+        -------
+        Dict[str, str]
+            Name of the file of every image field
+        """
+        names = dict()
+        for field in IMAGE_FIELDS:
+            if field in self.__dict__:
+                value = self.__dict__[field]
+                names[field] = value.name if hasattr(value, "name") else value
+        return names
 
     def image_voucher_thumb_url(self):
         if self.image_resized_10:
@@ -475,6 +588,45 @@ class VoucherImported(models.Model):
         self.save()
         return
 
+    def upload_derivatives(
+            self, image: Union[File, BinaryIO] = None, scaled: Dict[int, Union[File, BinaryIO]] = None,
+            public_image: Union[File, BinaryIO] = None, public_scaled: Dict[int, Union[File, BinaryIO]] = None
+    ) -> None:
+        """
+        Uploads the given variants of the voucher image concurrently and
+        saves all of them with a single update
+
+        Parameters
+        ----------
+        image : Union[File, BinaryIO], optional
+            Private JPEG image
+        scaled : Dict[int, Union[File, BinaryIO]], optional
+            Private scaled images, by scale
+        public_image : Union[File, BinaryIO], optional
+            Public JPEG image (with label)
+        public_scaled : Dict[int, Union[File, BinaryIO]], optional
+            Public scaled images, by scale
+
+        Returns
+        -------
+        None
+        """
+        uploads = list()
+        for add_public, original, scaled_images in [("", image, scaled), ("_public", public_image, public_scaled)]:
+            if original is not None:
+                uploads.append((original, f"{add_public}.jpg", f"image{add_public}"))
+            for scale, scaled_image in (scaled_images or dict()).items():
+                uploads.append((scaled_image, f"{add_public}_resized_{scale}.jpg", f"image{add_public}_resized_{scale}"))
+        if len(uploads) == 0:
+            return
+        _ = self.herbarium
+        with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            futures = [executor.submit(self.__upload_image__, *upload) for upload in uploads]
+        for future in futures:
+            future.result()
+        self.save(update_fields=[image_variable for _, _, image_variable in uploads])
+        return
+
     def __upload_image__(self, image: Union[File, BinaryIO], file_info: str, image_variable: str, temporal_tier: bool = False):
         image_content = ContentFile(image.read())
         image_name = "{}_{}_{:07}{}".format(
@@ -685,6 +837,217 @@ class PostprocessingLog(models.Model):
         verbose_name_plural = _("Postprocessing Logs")
 
 
+CHECKPOINT_STATE = (
+    (0, _('Pending')),
+    (1, _('Downloaded')),
+    (2, _('Converted')),
+    (3, _('QR Decoded')),
+    (4, _('Color Profiled')),
+    (5, _('Uploaded')),
+)
+
+
+class PostprocessingCheckpoint(models.Model):
+    PENDING = 0
+    DOWNLOADED = 1
+    CONVERTED = 2
+    DECODED = 3
+    COLOR_PROFILED = 4
+    UPLOADED = 5
+
+    institution = models.CharField(verbose_name=_("Institution"), max_length=50, blank=False, null=False)
+    session = models.CharField(verbose_name=_("Session"), max_length=300, blank=False, null=False)
+    filename = models.CharField(verbose_name=_("File Name"), max_length=300, blank=False, null=False)
+    state = models.IntegerField(verbose_name=_("State"), choices=CHECKPOINT_STATE, default=0, blank=False, null=False)
+    qr_code = models.TextField(verbose_name=_("QR Code"), blank=True, null=True)
+    voucher = models.ForeignKey(
+        "VoucherImported", verbose_name=_("Voucher"), on_delete=models.SET_NULL, blank=True, null=True
+    )
+    updated_at = models.DateTimeField(verbose_name=_("Updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Postprocessing Checkpoint")
+        verbose_name_plural = _("Postprocessing Checkpoints")
+        constraints = [
+            models.UniqueConstraint(fields=['institution', 'session', 'filename'], name='unique checkpoint')
+        ]
+
+    def __str__(self):
+        return "{}/{}/{}: {}".format(self.institution, self.session, self.filename, self.get_state_display())
+
+    @staticmethod
+    def for_session(institution: str, session: str, filenames: List[str]) -> Dict[str, PostprocessingCheckpoint]:
+        """
+        Checkpoints of the files of a session, created if they do not exist
+
+        Parameters
+        ----------
+        institution : str
+            Institution of the session
+        session : str
+            Name of the session
+        filenames : List[str]
+            Files of the session
+
+        Returns
+        -------
+        Dict[str, PostprocessingCheckpoint]
+            Checkpoint of every file
+        """
+        checkpoints = {
+            checkpoint.filename: checkpoint
+            for checkpoint in PostprocessingCheckpoint.objects.filter(institution=institution, session=session)
+        }
+        missing = [
+            PostprocessingCheckpoint(institution=institution, session=session, filename=filename)
+            for filename in filenames if filename not in checkpoints
+        ]
+        PostprocessingCheckpoint.objects.bulk_create(missing, ignore_conflicts=True)
+        if len(missing) > 0:
+            checkpoints = {
+                checkpoint.filename: checkpoint
+                for checkpoint in PostprocessingCheckpoint.objects.filter(institution=institution, session=session)
+            }
+        return checkpoints
+
+    def advance(self, state: int, **fields) -> None:
+        """
+        Saves the state reached by the file, with the fields given
+
+        Parameters
+        ----------
+        state : int
+            State reached
+        fields
+            Other fields to update (`qr_code`, `voucher_id`)
+
+        Returns
+        -------
+        None
+        """
+        self.state = max(self.state, state)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self.save(update_fields=["state", "updated_at"] + list(fields.keys()))
+        return
+
+
+LABEL_GRID = 8
+
+
+class LabelPosition(models.Model):
+    herbarium = models.ForeignKey(
+        Herbarium, verbose_name=_("Herbarium"), on_delete=models.CASCADE,
+        related_name="label_positions", blank=False, null=False
+    )
+    row = models.PositiveSmallIntegerField(verbose_name=_("Row"), blank=False, null=False)
+    column = models.PositiveSmallIntegerField(verbose_name=_("Column"), blank=False, null=False)
+    count = models.PositiveIntegerField(verbose_name=_("Count"), default=0, blank=False, null=False)
+    center_x = models.FloatField(verbose_name=_("Center X"), default=0, blank=False, null=False)
+    center_y = models.FloatField(verbose_name=_("Center Y"), default=0, blank=False, null=False)
+    width = models.FloatField(verbose_name=_("Width"), default=0, blank=False, null=False)
+    height = models.FloatField(verbose_name=_("Height"), default=0, blank=False, null=False)
+
+    class Meta:
+        verbose_name = _("Label Position")
+        verbose_name_plural = _("Label Positions")
+        constraints = [
+            models.UniqueConstraint(fields=['herbarium', 'row', 'column'], name='unique label position')
+        ]
+
+    def __str__(self):
+        return "{} ({}, {}): {}".format(self.herbarium, self.row, self.column, self.count)
+
+    @staticmethod
+    def record(herbarium_id: int, center_x: float, center_y: float, width: float, height: float) -> None:
+        """
+        Adds a QR found on an image to the histogram of positions of the herbarium,
+        keeping the running mean of the center and size of the QR on each cell
+
+        Parameters
+        ----------
+        herbarium_id : int
+            Herbarium of the image
+        center_x : float
+            Horizontal center of the QR, as fraction of image width
+        center_y : float
+            Vertical center of the QR, as fraction of image height
+        width : float
+            Width of the QR, as fraction of image width
+        height : float
+            Height of the QR, as fraction of image height
+
+        Returns
+        -------
+        None
+        """
+        row = min(int(center_y * LABEL_GRID), LABEL_GRID - 1)
+        column = min(int(center_x * LABEL_GRID), LABEL_GRID - 1)
+        position, _ = LabelPosition.objects.get_or_create(herbarium_id=herbarium_id, row=row, column=column)
+        count = F("count")
+        LabelPosition.objects.filter(pk=position.pk).update(
+            center_x=(F("center_x") * count + center_x) / (count + 1),
+            center_y=(F("center_y") * count + center_y) / (count + 1),
+            width=(F("width") * count + width) / (count + 1),
+            height=(F("height") * count + height) / (count + 1),
+            count=count + 1,
+        )
+        return
+
+
+RESTORE_STATE = (
+    (0, _('Pending')),
+    (1, _('Requested')),
+    (2, _('Restored')),
+    (3, _('Queued')),
+    (4, _('Failed')),
+)
+
+
+class RawRestore(models.Model):
+    PENDING = 0
+    REQUESTED = 1
+    RESTORED = 2
+    QUEUED = 3
+    FAILED = 4
+
+    voucher = models.OneToOneField(
+        VoucherImported, verbose_name=_("Voucher"), on_delete=models.CASCADE,
+        related_name="raw_restore", blank=False, null=False
+    )
+    state = models.IntegerField(verbose_name=_("State"), choices=RESTORE_STATE, default=0, blank=False, null=False)
+    checks = models.IntegerField(verbose_name=_("Checks"), default=0, blank=False, null=False)
+    next_check = models.DateTimeField(verbose_name=_("Next check"), default=timezone.now)
+    error = models.TextField(verbose_name=_("Error"), blank=True, null=True)
+    updated_at = models.DateTimeField(verbose_name=_("Updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Raw Restore")
+        verbose_name_plural = _("Raw Restores")
+
+    def __str__(self):
+        return "{}: {}".format(self.voucher_id, self.get_state_display())
+
+    def backoff(self, now: datetime) -> None:
+        """
+        Schedules the next check of an unresolved restore, doubling the
+        wait after every check up to `RESTORE_MAX_BACKOFF` seconds
+
+        Parameters
+        ----------
+        now : datetime
+            Time of the current check
+
+        Returns
+        -------
+        None
+        """
+        delay = min(settings.RESTORE_BASE_BACKOFF * 2 ** self.checks, settings.RESTORE_MAX_BACKOFF)
+        self.checks += 1
+        self.next_check = now + timedelta(seconds=delay)
+        return
+
+
 @receiver(post_delete, sender=PriorityVouchersFile)
 def auto_delete_file_on_delete_PriorityVouchersFile(sender, instance, **kwargs):
     if instance.file:
@@ -697,57 +1060,23 @@ def auto_delete_file_on_delete_ColorProfileFile(sender, instance, **kwargs):
         instance.file.delete(save=False)
 
 
-@receiver(pre_save, sender=VoucherImported)
-def pre_save_image(sender, instance, *args, **kwargs):
-    """ instance old image file will delete from os """
-    try:
-        old_image = instance.__class__.objects.get().image.path
-        old_image_resized_10 = instance.__class__.objects.get().image_resized_10.path
-        old_image_resized_60 = instance.__class__.objects.get().image_resized_60.path
-        old_image_public = instance.__class__.objects.get().image_public.path
-        old_image_public_resized_10 = instance.__class__.objects.get().image_public_resized_10.path
-        old_image_public_resized_60 = instance.__class__.objects.get().image_public_resized_60.path
-        old_image_raw = instance.__class__.objects.get().image_raw.path
-        try:
-            new_image = instance.image.path
-            new_image_resized_10 = instance.image_resized_10.path
-            new_image_resized_60 = instance.image_resized_60.path
-            new_image_public = instance.image_public.path
-            new_image_public_resized_10 = instance.image_public_resized_10.path
-            new_image_public_resized_60 = instance.image_public_resized_60.path
-            new_image_raw = instance.image_raw.path
-        except:
-            new_image = None
-        if new_image != old_image:
-            import os
-            if os.path.exists(old_image):
-                os.remove(old_image)
-        if new_image_resized_10 != old_image_resized_10:
-            import os
-            if os.path.exists(old_image_resized_10):
-                os.remove(old_image_resized_10)
-        if new_image_resized_60 != old_image_resized_60:
-            import os
-            if os.path.exists(old_image_resized_60):
-                os.remove(old_image_resized_60)
-        if new_image_public != old_image_public:
-            import os
-            if os.path.exists(old_image_public):
-                os.remove(old_image_public)
-        if new_image_public_resized_10 != old_image_public_resized_10:
-            import os
-            if os.path.exists(old_image_public_resized_10):
-                os.remove(old_image_public_resized_10)
-        if new_image_public_resized_60 != old_image_public_resized_60:
-            import os
-            if os.path.exists(old_image_public_resized_60):
-                os.remove(old_image_public_resized_60)
-        if new_image_raw != old_image_raw:
-            import os
-            if os.path.exists(old_image_raw):
-                os.remove(old_image_raw)
-    except:
-        pass
+@receiver(post_save, sender=VoucherImported)
+def post_save_image(sender, instance, update_fields=None, **kwargs):
+    """ Old image files replaced on the instance are deleted once the transaction commits """
+    current = instance.image_names()
+    orphans = list()
+    for field, old_name in instance.__original_images__.items():
+        if update_fields is not None and field not in update_fields:
+            continue
+        if old_name and current.get(field) != old_name:
+            orphans.append((field, old_name))
+    instance.__original_images__.update({
+        field: name for field, name in current.items()
+        if update_fields is None or field in update_fields
+    })
+    if len(orphans) > 0:
+        logging.debug("Voucher {}: deleting replaced files {}".format(instance.pk, orphans))
+        transaction.on_commit(lambda: celery.current_app.send_task('delete_voucher_files', (orphans,)))
 
 
 class VouchersView(models.Model):
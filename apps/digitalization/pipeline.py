@@ -0,0 +1,218 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from django.db import connection
+
+__STOP__ = object()
+
+
+class PipelineItem:
+    """
+    Unit of work flowing through a pipeline, keeps track
+    of errors and time spent on every stage
+    """
+
+    def __init__(self) -> None:
+        self.error: str | None = None
+        self.timings: Dict[str, float] = dict()
+        return
+
+
+class Stage:
+    def __init__(
+            self, name: str, function: Callable,
+            workers: int = 1, queue_size: int = None, batch_size: int = 1
+    ) -> None:
+        """
+        Step of a pipeline
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, used on logs and timings
+        function : Callable
+            Function to apply on every item, it must return `True`
+            if the item continues to the next stage. If `batch_size` is
+            greater than one, it receives a list of items and returns
+            a list with a boolean for every item
+        workers : int
+            Number of workers consuming the input queue of this stage
+        queue_size : int, optional
+            Maximum number of items waiting for this stage, defaults to the
+            queue size of the pipeline. On the stage after a download it sets
+            how many files are prefetched ahead of the processing
+        batch_size : int
+            Maximum number of items given at once to the function, a batch
+            takes the items already waiting and never waits to be filled
+        """
+        assert workers > 0, f"Stage `{name}` must have at least one worker"
+        assert batch_size > 0, f"Stage `{name}` must have a positive batch size"
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        return
+
+    def __str__(self) -> str:
+        if self.batch_size > 1:
+            return f"{self.name} (x{self.workers}, batches of {self.batch_size})"
+        return f"{self.name} (x{self.workers})"
+
+
+class Pipeline:
+    def __init__(
+            self, stages: List[Stage], queue_size: int = 4,
+            logger: logging.Logger = None,
+            on_finish: Callable[[PipelineItem], None] = None
+    ) -> None:
+        """
+        Runs items through a sequence of stages, every stage has its own
+        workers and a bounded input queue, so stages work concurrently and
+        the throughput is set by the slowest stage instead of the sum of them.
+
+        Parameters
+        ----------
+        stages : List[Stage]
+            Stages to apply in order
+        queue_size : int
+            Maximum number of items waiting between two stages
+        logger : Logger
+            Object to manage logs
+        on_finish : Callable[[PipelineItem], None], optional
+            Function called when an item leaves the pipeline, either
+            because all stages were applied or because one of them stopped it
+        """
+        assert len(stages) > 0, "Pipeline must have at least one stage"
+        self.__stages__ = stages
+        self.__queue_size__ = queue_size
+        self.__logger__ = logger if logger is not None else logging.getLogger(__name__)
+        self.__on_finish__ = on_finish
+        self.__busy__: Dict[str, float] = {stage.name: 0.0 for stage in stages}
+        self.__lock__ = threading.Lock()
+        return
+
+    def run(self, items: Iterable[PipelineItem]) -> List[PipelineItem]:
+        """
+        Process items through all stages, blocking until every item leaves the pipeline
+
+        Parameters
+        ----------
+        items : Iterable[PipelineItem]
+            Items to process
+
+        Returns
+        -------
+        List[PipelineItem]
+            Processed items, in order of completion
+        """
+        queues = [
+            queue.Queue(maxsize=stage.queue_size if stage.queue_size is not None else self.__queue_size__)
+            for stage in self.__stages__
+        ]
+        results = list()
+        remaining = [stage.workers for stage in self.__stages__]
+        threads = list()
+        start = time.monotonic()
+        for index, stage in enumerate(self.__stages__):
+            for worker in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.__worker__,
+                    args=(index, queues, results, remaining),
+                    name=f"{stage.name}-{worker}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.__stages__[0].workers):
+            queues[0].put(__STOP__)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        self.__logger__.info("Pipeline processed {} items in {:.2f} s".format(len(results), elapsed))
+        for stage in self.__stages__:
+            self.__logger__.info("Stage {}: {:.2f} s of work".format(stage, self.__busy__[stage.name]))
+        steps: Dict[str, float] = dict()
+        for item in results:
+            for name, elapsed in item.timings.items():
+                if name not in self.__busy__:
+                    steps[name] = steps.get(name, 0.0) + elapsed
+        for name, elapsed in sorted(steps.items()):
+            self.__logger__.info("Step {}: {:.2f} s of work".format(name, elapsed))
+        return results
+
+    def __finish__(self, item: PipelineItem, results: List[PipelineItem]) -> None:
+        if self.__on_finish__ is not None:
+            try:
+                self.__on_finish__(item)
+            except Exception as e:
+                self.__logger__.error(e, exc_info=True)
+        with self.__lock__:
+            results.append(item)
+        return
+
+    @staticmethod
+    def __next_batch__(input_queue: queue.Queue, batch_size: int) -> Tuple[List[PipelineItem], bool]:
+        batch = list()
+        item = input_queue.get()
+        while item is not __STOP__:
+            batch.append(item)
+            if len(batch) == batch_size:
+                return batch, False
+            try:
+                item = input_queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def __worker__(
+            self, index: int, queues: List[queue.Queue],
+            results: List[PipelineItem], remaining: List[int]
+    ) -> None:
+        stage = self.__stages__[index]
+        is_last = index + 1 == len(self.__stages__)
+        try:
+            stopped = False
+            while not stopped:
+                batch, stopped = self.__next_batch__(queues[index], stage.batch_size)
+                if len(batch) == 0:
+                    continue
+                start = time.monotonic()
+                try:
+                    if stage.batch_size > 1:
+                        keep_going = stage.function(batch)
+                    else:
+                        keep_going = [stage.function(batch[0])]
+                    if len(keep_going) != len(batch):
+                        raise ValueError("Stage `{}` returned {} results for {} items".format(
+                            stage.name, len(keep_going), len(batch)
+                        ))
+                except Exception as e:
+                    self.__logger__.error("Stage `{}` failed on {}".format(stage.name, ", ".join(map(str, batch))))
+                    self.__logger__.error(e, exc_info=True)
+                    for item in batch:
+                        item.error = str(e)
+                    keep_going = [False] * len(batch)
+                elapsed = (time.monotonic() - start) / len(batch)
+                with self.__lock__:
+                    self.__busy__[stage.name] += elapsed * len(batch)
+                for item, item_keep_going in zip(batch, keep_going):
+                    item.timings[stage.name] = elapsed
+                    if item_keep_going and not is_last:
+                        queues[index + 1].put(item)
+                    else:
+                        self.__finish__(item, results)
+        finally:
+            connection.close()
+            with self.__lock__:
+                remaining[index] -= 1
+                stage_done = remaining[index] == 0
+            if stage_done and not is_last:
+                for _ in range(self.__stages__[index + 1].workers):
+                    queues[index + 1].put(__STOP__)
+        return
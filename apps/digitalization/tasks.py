@@ -1,41 +1,47 @@
 import datetime as dt
-import glob
 import json
 import logging
 import math
 import os
 import shutil
+import tempfile
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
-from typing import List, Tuple, Type
+from typing import Dict, List, Set, Tuple, Type, Union
 
 import boto3
 import cv2
-import numpy as np
 import pandas as pd
 import pytesseract
-import pytz
-from PIL import Image, ImageDraw, ImageFont
-from celery import shared_task
+from PIL import Image
+from boto3.s3.transfer import TransferConfig
+from celery import chord, shared_task
 from celery.exceptions import Ignore
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.search import TrigramSimilarity
-from django.core.files.base import ContentFile
-from django.db import transaction
-from django.db.models import Model
+from django.core.files.base import ContentFile, File
+from django.db import connection, transaction
+from django.db.models import F, Model
+from django.utils import timezone
 
-from apps.catalog.models import Species, Synonymy
 from apps.digitalization.models import DCW_SQL, PostprocessingLog
 from apps.digitalization.models import GalleryImage, BannerImage
 from apps.digitalization.models import VoucherImported, BiodataCode, ColorProfileFile, PriorityVouchersFile
+from apps.digitalization.models import Herbarium, PostprocessingCheckpoint, RawRestore
 from apps.digitalization.storage_backends import PrivateMediaStorage, PublicMediaStorage, IAPrivateMediaStorage
-from apps.digitalization.utils import SessionFolder
-from apps.digitalization.utils import cr3_to_dng, dng_to_jpeg, dng_to_jpeg_color_profile
-from apps.digitalization.utils import read_qr, change_image_resolution, empty_folder
-from intranet.utils import TaskProcessLogger, HtmlLogger, GroupLogger, close_process
+from apps.digitalization.converters import RawConverter, get_converter
+from apps.digitalization.importer import PriorityVouchersImporter
+from apps.digitalization.pipeline import Pipeline, PipelineItem, Stage
+from apps.digitalization.utils import SessionFolder, S3File, ByteBudget, LabelPositionPrior, transfer_config
+from apps.digitalization.utils import cr3_to_dng, dng_to_jpeg_color_profile
+from apps.digitalization.utils import read_qr, change_image_resolution, image_derivatives, derivative_scales
+from apps.digitalization.utils import local_copy, stream_to_file, storage_key, label_font, render_label
+from apps.home.models import DarwinCoreArchiveFile, DarwinCoreArchiveSegment
+from intranet.utils import TaskProcessLogger, HtmlLogger, GroupLogger, ProgressReporter, close_process
 
-N_BATCH = 1
 WIDTH_CROP = 550
 HEIGHT_CROP = 550
 MARGIN = 100
@@ -129,84 +135,78 @@ PARAMETERS = {
 }
 
 
+def voucher_label(voucher: VoucherImported) -> Tuple[Image.Image, Tuple[int, int]]:
+    parameters = PARAMETERS[voucher.herbarium.collection_code]
+    title_font = label_font('assets/font/arial.ttf', 70)
+    number_font = label_font('assets/font/arial.ttf', 55)
+    scientific_name_font = label_font('assets/font/arial_italic.ttf', 48)
+    normal_font = label_font('assets/font/arial_italic.ttf', 48)
+    texts = [
+        (
+            parameters["TITLE_POS"], voucher.herbarium.name.upper(),
+            {"anchor": "ms", "font": title_font, "stroke_width": 2, "stroke_fill": "black"}
+        ),
+        (
+            parameters["NUMBER_POS"], voucher.herbarium.collection_code + ' ' + str(voucher.catalog_number),
+            {"font": number_font, "stroke_width": 2, "stroke_fill": "black"}
+        ),
+        (
+            parameters["NAME_POS"], voucher.scientific_name.scientific_name_full + ' ',
+            {"anchor": "ms", "font": scientific_name_font}
+        ),
+        (
+            parameters["FAMILY_POS"], voucher.scientific_name.genus.family.name,
+            {"anchor": "ms", "font": normal_font}
+        ),
+    ]
+    if voucher.locality is not None and voucher.locality != "":
+        texts.append((parameters["LOCALITY_POS"], voucher.locality, {"font": normal_font}))
+    if voucher.georeferenced_date:
+        georeferenced_date = voucher.georeferenced_date.strftime('%d-%m-%Y')
+    else:
+        georeferenced_date = ""
+    texts.append((parameters["GEO_DATE_POS"], 'Fecha Col. ' + georeferenced_date, {"font": normal_font}))
+    texts.append((
+        parameters["RECORD_POS"], 'Leg. ' + voucher.recorded_by + ' ' + voucher.record_number, {"font": normal_font}
+    ))
+    if voucher.date_identified is not None and voucher.date_identified != "":
+        texts.append((
+            parameters["RECORD_DATE_POS"], 'Fecha Det. ' + str(voucher.date_identified), {"font": normal_font}
+        ))
+    if voucher.identified_by is not None and voucher.identified_by != "":
+        texts.append((parameters["IDENTIFY_POS"], 'Det. ' + str(voucher.identified_by), {"font": normal_font}))
+    if voucher.organism_remarks is not None and voucher.organism_remarks not in ["", "nan"]:
+        observation = textwrap.fill(str(voucher.organism_remarks), width=60, break_long_words=False)
+        texts.append((parameters["OBS_POS"], 'Obs.: ' + observation, {"font": normal_font}))
+    return render_label(parameters["RECTANGLE"], texts)
+
+
+def __etiquette__(voucher: VoucherImported, logger: logging.Logger, s3: boto3.client = None) -> None:
+    logger.info("Working with {}".format(voucher.id))
+    tile, position = voucher_label(voucher)
+    with local_copy(IAPrivateMediaStorage(), voucher.image.name, s3=s3) as image_path:
+        voucher_image = Image.open(image_path)
+        voucher_image.load()
+    voucher_image.paste(tile, position, tile)
+    edited_image_content = BytesIO()
+    voucher_image.save(edited_image_content, format='JPEG')
+    edited_image_content.seek(0)
+    # Resize the image to a different size and save
+    derivatives = image_derivatives(voucher_image, derivative_scales(voucher.herbarium.collection_code))
+    voucher.upload_derivatives(public_image=edited_image_content, public_scaled=derivatives)
+    voucher.biodata_code.voucher_state = 7
+    voucher.biodata_code.save()
+    logger.info("Image saved!")
+    return
+
+
 @shared_task(name='etiquette_picture')
 def etiquette_picture(voucher_id, logger: logging.Logger = None):
     if logger is None:
         logger = logging.getLogger(__name__)
     try:
         voucher = VoucherImported.objects.get(pk=voucher_id)
-        logger.info("Working with {}".format(voucher.id))
-        parameters = PARAMETERS[voucher.herbarium.collection_code]
-        logger.debug(parameters)
-        image_file = IAPrivateMediaStorage().open(voucher.image.name, "rb")
-        voucher_image = Image.open(image_file)
-        voucher_image_editable = ImageDraw.Draw(voucher_image)
-        voucher_image_editable.rectangle(parameters["RECTANGLE"], fill='#d7d6e0', outline="black", width=4)
-        title_font = ImageFont.truetype('assets/font/arial.ttf', 70)
-        voucher_image_editable.text(
-            parameters["TITLE_POS"], voucher.herbarium.name.upper(),
-            (0, 0, 0), anchor="ms", font=title_font, stroke_width=2, stroke_fill="black"
-        )
-        number_font = ImageFont.truetype('assets/font/arial.ttf', 55)
-        voucher_image_editable.text(
-            parameters["NUMBER_POS"], voucher.herbarium.collection_code + ' ' + str(voucher.catalog_number),
-            (0, 0, 0), font=number_font, stroke_width=2, stroke_fill="black"
-        )
-        scientific_name_font = ImageFont.truetype('assets/font/arial_italic.ttf', 48)
-        voucher_image_editable.text(
-            parameters["NAME_POS"], voucher.scientific_name.scientific_name_full + ' ',
-            (0, 0, 0), anchor="ms", font=scientific_name_font
-        )
-        normal_font = ImageFont.truetype('assets/font/arial_italic.ttf', 48)
-        voucher_image_editable.text(
-            parameters["FAMILY_POS"], voucher.scientific_name.genus.family.name,
-            (0, 0, 0), anchor="ms", font=normal_font
-        )
-        if voucher.locality is not None and voucher.locality != "":
-            voucher_image_editable.text(
-                parameters["LOCALITY_POS"], voucher.locality,
-                (0, 0, 0), font=normal_font
-            )
-        if voucher.georeferenced_date:
-            georeferenced_date = voucher.georeferenced_date.strftime('%d-%m-%Y')
-        else:
-            georeferenced_date = ""
-        voucher_image_editable.text(
-            parameters["GEO_DATE_POS"], 'Fecha Col. ' + georeferenced_date,
-            (0, 0, 0), font=normal_font
-        )
-        voucher_image_editable.text(
-            parameters["RECORD_POS"], 'Leg. ' + voucher.recorded_by + ' ' + voucher.record_number,
-            (0, 0, 0), font=normal_font
-        )
-        if voucher.date_identified is not None and voucher.date_identified != "":
-            voucher_image_editable.text(
-                parameters["RECORD_DATE_POS"], 'Fecha Det. ' + str(voucher.date_identified),
-                (0, 0, 0), font=normal_font
-            )
-        if voucher.identified_by is not None and voucher.identified_by != "":
-            voucher_image_editable.text(
-                parameters["IDENTIFY_POS"], 'Det. ' + str(voucher.identified_by),
-                (0, 0, 0), font=normal_font
-            )
-        if voucher.organism_remarks is not None and voucher.organism_remarks not in ["", "nan"]:
-            observation = textwrap.fill(str(voucher.organism_remarks), width=60, break_long_words=False)
-            voucher_image_editable.text(
-                parameters["OBS_POS"], 'Obs.: ' + observation,
-                (0, 0, 0), font=normal_font
-            )
-        edited_image_content = BytesIO()
-        voucher_image.save(edited_image_content, format='JPEG')
-        edited_image_content.seek(0)
-        voucher.upload_image(edited_image_content, public=True)
-        # Resize the image to a different size and save
-        for scale_percent in [10, 60]:
-            resized_image = change_image_resolution(voucher_image, scale_percent)
-            voucher.upload_scaled_image(resized_image, scale_percent, public=True)
-        voucher.biodata_code.voucher_state = 7
-        voucher.biodata_code.save()
-        voucher.save()
-        logger.info("Image saved!")
+        __etiquette__(voucher, logger)
         return True
     except Exception as e:
         logger.error("Error on saving")
@@ -214,13 +214,240 @@ def etiquette_picture(voucher_id, logger: logging.Logger = None):
         return False
 
 
+def __label_chunk__(voucher_ids: List[int], s3: boto3.client, logger: logging.Logger) -> int:
+    labeled = 0
+    try:
+        vouchers = VoucherImported.objects.filter(pk__in=voucher_ids).select_related(
+            "herbarium", "biodata_code", "scientific_name__genus__family"
+        )
+        for voucher in vouchers:
+            try:
+                __etiquette__(voucher, logger, s3=s3)
+                labeled += 1
+            except Exception as e:
+                logger.error("Error on saving {}".format(voucher.id))
+                logger.error(e, exc_info=True)
+    finally:
+        connection.close()
+    return labeled
+
+
+def label_vouchers(voucher_ids: List[int], logger: logging.Logger) -> int:
+    s3 = boto3.client('s3')
+    chunk_size = settings.RELABEL_CHUNK_SIZE
+    chunks = [voucher_ids[i:i + chunk_size] for i in range(0, len(voucher_ids), chunk_size)]
+    with ThreadPoolExecutor(max_workers=settings.RELABEL_WORKERS) as executor:
+        labeled = sum(executor.map(partial(__label_chunk__, s3=s3, logger=logger), chunks))
+    s3.close()
+    return labeled
+
+
+@shared_task(name='relabel_vouchers')
+def relabel_vouchers(voucher_ids: List[int]) -> str:
+    voucher_ids = list(VoucherImported.objects.filter(
+        pk__in=voucher_ids, biodata_code__voucher_state=7
+    ).values_list("pk", flat=True))
+    labeled = label_vouchers(voucher_ids, logging.getLogger(__name__))
+    logging.info("Relabeled {} of {} vouchers".format(labeled, len(voucher_ids)))
+    return "Labeled {} of {}".format(labeled, len(voucher_ids))
+
+
+class PostprocessingItem(PipelineItem):
+    def __init__(
+            self, s3_file: S3File, input_folder: str, temp_folder: str,
+            checkpoint: PostprocessingCheckpoint
+    ) -> None:
+        super().__init__()
+        self.file = s3_file
+        self.checkpoint = checkpoint
+        self.input_folder = os.path.join(input_folder, s3_file.stem)
+        self.temp_folder = os.path.join(temp_folder, s3_file.stem)
+        self.log_cache = set()
+        self.image_path = None
+        self.color_profile = None
+        self.voucher_id = None
+        self.found = False
+        self.processed = False
+        return
+
+    @property
+    def raw_path(self) -> str:
+        return os.path.join(self.input_folder, self.file.filename)
+
+    @property
+    def jpeg_path(self) -> str:
+        return os.path.join(self.temp_folder, self.file.stem + ".jpg")
+
+    def reached(self, state: int) -> bool:
+        return self.checkpoint.state >= state
+
+    def clean(self) -> None:
+        shutil.rmtree(self.input_folder, ignore_errors=True)
+        shutil.rmtree(self.temp_folder, ignore_errors=True)
+        return
+
+    def __str__(self) -> str:
+        return self.file.filename
+
+
+def __download_stage__(
+        item: PostprocessingItem, s3: boto3.client, bucket_name: str,
+        config: TransferConfig, budget: ByteBudget, logger: logging.Logger
+) -> bool:
+    os.makedirs(item.input_folder, exist_ok=True)
+    os.makedirs(item.temp_folder, exist_ok=True)
+    if item.reached(PostprocessingCheckpoint.DOWNLOADED) and os.path.exists(item.raw_path) and (
+            item.file.size == 0 or os.path.getsize(item.raw_path) == item.file.size
+    ):
+        logger.info("{} already downloaded, skipping".format(item))
+        return True
+    item.file.download(
+        s3, bucket_name, logger=logger, input_folder=item.input_folder,
+        config=config, budget=budget
+    )
+    item.checkpoint.advance(PostprocessingCheckpoint.DOWNLOADED)
+    return True
+
+
+def __convert_stage__(
+        items: List[PostprocessingItem], converter: RawConverter,
+        institution: str, logger: logging.Logger
+) -> List[bool]:
+    to_convert = list()
+    for item in items:
+        if item.reached(PostprocessingCheckpoint.CONVERTED) and os.path.exists(item.jpeg_path):
+            logger.info("{} already converted, skipping".format(item))
+            item.image_path = item.jpeg_path
+        else:
+            to_convert.append(item)
+    outputs = converter.convert_batch(
+        [item.raw_path for item in to_convert], [item.temp_folder for item in to_convert],
+        institution, logger, [item.log_cache for item in to_convert],
+        timings=[item.timings for item in to_convert]
+    ) if len(to_convert) > 0 else list()
+    for item, output in zip(to_convert, outputs):
+        item.image_path = output
+        if output is None:
+            item.error = f"File {item.file.filename} cannot be converted to .jpg"
+            logger.error(item.error)
+        else:
+            item.checkpoint.advance(PostprocessingCheckpoint.CONVERTED)
+    return [item.image_path is not None for item in items]
+
+
+def __qr_stage__(
+        item: PostprocessingItem, positions: LabelPositionPrior, logger: logging.Logger
+) -> bool:
+    item.found = True
+    if item.reached(PostprocessingCheckpoint.DECODED) and item.checkpoint.qr_code is not None:
+        logger.info("QR of {} already decoded, skipping".format(item))
+        qr = item.checkpoint.qr_code
+    else:
+        qr = read_qr(item.image_path, logger, positions=positions)
+    if qr is None:
+        logger.error("QR not found for file {}".format(item.image_path))
+        return False
+    code_voucher = json.loads(qr)['code']
+    biodata_code = BiodataCode.objects.filter(code=code_voucher).select_related("page__color_profile").first()
+    if biodata_code is None:
+        logger.error("Error retrieving data on qr for file {} and code {}".format(
+            item.image_path, code_voucher
+        ))
+        return False
+    vouchers = VoucherImported.objects.filter(biodata_code__id=biodata_code.id)
+    if vouchers.count() != 1:
+        logger.error("No voucher, or more than one, associated with ocurrence {}".format(
+            biodata_code.id
+        ))
+        return False
+    item.voucher_id = vouchers[0].id
+    item.color_profile = biodata_code.page.color_profile.file.url
+    item.checkpoint.advance(PostprocessingCheckpoint.DECODED, qr_code=qr, voucher_id=item.voucher_id)
+    return True
+
+
+def __profile_stage__(
+        items: List[PostprocessingItem], converter: RawConverter,
+        institution: str, logger: logging.Logger
+) -> List[bool]:
+    to_convert = list()
+    for item in items:
+        if item.reached(PostprocessingCheckpoint.COLOR_PROFILED) and os.path.exists(item.jpeg_path):
+            logger.info("{} already converted with color profile, skipping".format(item))
+            item.image_path = item.jpeg_path
+        else:
+            to_convert.append(item)
+    outputs = converter.convert_color_profile_batch(
+        [item.raw_path for item in to_convert], [item.temp_folder for item in to_convert],
+        institution, [item.color_profile for item in to_convert], logger,
+        [item.log_cache for item in to_convert], timings=[item.timings for item in to_convert]
+    ) if len(to_convert) > 0 else list()
+    for item, output in zip(to_convert, outputs):
+        if output is None:
+            item.error = f"File {item.file.filename} has no .jpg"
+            item.image_path = None
+            logger.error(item.error)
+        else:
+            item.image_path = output
+            item.checkpoint.advance(PostprocessingCheckpoint.COLOR_PROFILED)
+    return [item.image_path is not None for item in items]
+
+
+def __upload_stage__(item: PostprocessingItem, logger: logging.Logger) -> bool:
+    voucher: VoucherImported = VoucherImported.objects.get(pk=item.voucher_id)
+    with open(item.raw_path, "rb") as file:
+        voucher.upload_raw_image(file)
+    derivatives = image_derivatives(item.image_path, derivative_scales(voucher.herbarium.collection_code))
+    with open(item.image_path, "rb") as file:
+        voucher.upload_derivatives(image=file, scaled=derivatives)
+    item.processed = etiquette_picture(voucher.id, logger=logger)
+    if item.processed:
+        item.checkpoint.advance(PostprocessingCheckpoint.UPLOADED)
+    return item.processed
+
+
+def postprocessing_pipeline(
+        s3: boto3.client, bucket_name: str,
+        institution: str, logger: logging.Logger
+) -> Pipeline:
+    workers = settings.POSTPROCESSING_WORKERS
+    budget = ByteBudget(settings.POSTPROCESSING_MAX_BYTES_IN_FLIGHT)
+    herbarium = Herbarium.objects.filter(collection_code=institution).first()
+    positions = LabelPositionPrior(herbarium.id) if herbarium is not None else None
+    converter = get_converter(settings.POSTPROCESSING_CONVERTER)
+    return Pipeline(
+        [
+            Stage("download", partial(
+                __download_stage__, s3=s3, bucket_name=bucket_name,
+                config=transfer_config(), budget=budget, logger=logger
+            ), workers["download"]),
+            Stage(
+                "convert", partial(
+                    __convert_stage__, converter=converter, institution=institution, logger=logger
+                ), workers["convert"],
+                queue_size=settings.POSTPROCESSING_PREFETCH,
+                batch_size=settings.POSTPROCESSING_BATCH_SIZE
+            ),
+            Stage("qr", partial(
+                __qr_stage__, positions=positions, logger=logger
+            ), workers["qr"]),
+            Stage(
+                "profile", partial(
+                    __profile_stage__, converter=converter, institution=institution, logger=logger
+                ), workers["profile"],
+                batch_size=settings.POSTPROCESSING_BATCH_SIZE
+            ),
+            Stage("upload", partial(__upload_stage__, logger=logger), workers["upload"]),
+        ],
+        queue_size=settings.POSTPROCESSING_QUEUE_SIZE,
+        logger=logger,
+        on_finish=lambda item: item.clean() if item.processed else None
+    )
+
+
 @shared_task(name='scheduled_postprocessing')
 def scheduled_postprocess(input_folder: str, temp_folder: str, log_folder: str):
     bucket_name = settings.AWS_STORAGE_BUCKET_NAME
-
-    def batch_files_function(files: List, x: int) -> List[List]:
-        return [files[i:i + x] for i in range(0, len(files), x)]
-
     s3 = boto3.client('s3')
     os.makedirs(temp_folder, exist_ok=True)
     os.makedirs(log_folder, exist_ok=True)
@@ -234,75 +461,40 @@ def scheduled_postprocess(input_folder: str, temp_folder: str, log_folder: str):
     process_logger.debug(sessions)
     logging.info("Enter in sessions")
     os.makedirs(input_folder, exist_ok=True)
+    pending = 0
     for session_folder in sessions:
         try:
             process_logger.debug(session_folder)
-            batch_files = batch_files_function(list(session_folder.__files__), N_BATCH)
-            logging.info("Processing batches...")
-            for batch in batch_files:
-                log_cache = set()
-                session_folder.create_folder()
-                for file in batch:
-                    file.download(s3, bucket_name, process_logger)
-                logging.info("Converting file")
-                cr3_to_dng(input_folder, temp_folder, process_logger)
-                dng_to_jpeg(temp_folder, temp_folder, session_folder.get_institution(), process_logger, log_cache)
-                for filename in glob.glob(temp_folder + '/*.jpg', recursive=False):
-                    done = False
+            pipeline = postprocessing_pipeline(s3, bucket_name, session_folder.get_institution(), process_logger)
+            files = session_folder.get_files()
+            checkpoints = PostprocessingCheckpoint.for_session(
+                session_folder.get_institution(), session_folder.get_session(),
+                [file.filename for file in files]
+            )
+            items = list()
+            for file in files:
+                if checkpoints[file.filename].state >= PostprocessingCheckpoint.UPLOADED:
+                    process_logger.info("{} already processed on a previous run, skipping".format(file.filename))
+                    continue
+                items.append(PostprocessingItem(file, input_folder, temp_folder, checkpoints[file.filename]))
+            logging.info("Processing {} files...".format(len(items)))
+            for item in pipeline.run(items):
+                if item.found:
                     log_object.found_images += 1
-                    logging.info("Reading QR...")
-                    qr = read_qr(filename, process_logger)
-                    if qr is not None:
-                        json_qr = json.loads(qr)
-                        code_voucher = json_qr['code']
-                        logging.info("Retrieving info...")
-                        biodata_codes = BiodataCode.objects.filter(code=code_voucher)
-                        if biodata_codes.count() == 0:
-                            process_logger.error("Error retrieving data on qr for file {} and code {}".format(
-                                filename, code_voucher
-                            ))
-                        else:
-                            biodata_code: BiodataCode = biodata_codes[0]
-                            dng_to_jpeg_color_profile(
-                                temp_folder, temp_folder,
-                                session_folder.get_institution(),
-                                biodata_code.page.color_profile.file.url,
-                                process_logger, log_cache
-                            )
-                            vouchers = VoucherImported.objects.filter(biodata_code__id=biodata_code.id)
-                            if vouchers.count() == 1:
-                                voucher: VoucherImported = vouchers[0]
-                                raw_image_path = filename.replace(temp_folder, input_folder).replace(".jpg", ".CR3")
-                                with open(raw_image_path, "rb") as file:
-                                    voucher.upload_raw_image(file)
-                                    voucher.save()
-                                with open(filename, "rb") as file:
-                                    voucher.upload_image(file)
-                                    image = Image.open(file)
-                                    for scale_percent in [10, 60]:
-                                        resized_image = change_image_resolution(image, scale_percent)
-                                        voucher.upload_scaled_image(resized_image, scale_percent)
-                                voucher.save()
-                                done = etiquette_picture(voucher.id, logger=process_logger)
-                            else:
-                                process_logger.error(
-                                    "No voucher, or more than one, associated with ocurrence {}".format(
-                                        biodata_code.id
-                                    )
-                                )
-                        if done:
-                            log_object.processed_images += 1
-                    else:
-                        process_logger.error("QR not found for file {}".format(filename))
-                empty_folder(input_folder)
-                empty_folder(temp_folder)
+                if item.processed:
+                    log_object.processed_images += 1
+                else:
+                    pending += 1
             session_folder.close_session(s3, bucket_name, process_logger)
         except Exception as e:
             process_logger.error(e, exc_info=True)
     s3.close()
     try:
-        shutil.rmtree(input_folder)
-        shutil.rmtree(temp_folder)
+        if pending == 0:
+            shutil.rmtree(input_folder)
+            shutil.rmtree(temp_folder)
+        else:
+            process_logger.info("Keeping local files of {} unprocessed files to resume them".format(pending))
         process_logger.close()
         log_object.failed_images = log_object.found_images - log_object.processed_images
         with open(process_logger.file_path, "rb") as log_file:
@@ -340,95 +532,114 @@ def get_pending_sessions(s3: boto3.client, input_folder: str, logger: logging.Lo
         sessions_candidates = [prefix.get("Prefix") for prefix in response.get('CommonPrefixes', [])]
         for session_folder in sessions_candidates:
             session_name = session_folder.replace(institution_path, "").strip("/")
-            response = s3.list_objects_v2(
-                Bucket=bucket_name,
-                Prefix=session_folder,
-            )
-            content = [obj['Key'] for obj in response.get('Contents', [])]
+            sizes = dict()
+            paginator = s3.get_paginator("list_objects_v2")
+            for response in paginator.paginate(Bucket=bucket_name, Prefix=session_folder):
+                for obj in response.get('Contents', []):
+                    sizes[obj['Key']] = obj.get('Size', 0)
+            content = list(sizes.keys())
             if f"{session_folder}processed" in content:
                 logger.debug("Session folder `{}` already processed".format(session_name))
             else:
                 logger.debug("Session folder `{}` to be processed".format(session_name))
                 out.append(SessionFolder(institution, session_name, input_folder, input_path))
-                out[-1].add_files(content)
+                out[-1].add_files(content, sizes=sizes)
     return out
 
 
+PUBLIC_STORAGE_FIELDS = [
+    (GalleryImage, "image"),
+    (GalleryImage, "thumbnail"),
+    (BannerImage, "banner"),
+    (VoucherImported, "image_public_resized_10"),
+    (VoucherImported, "image_public_resized_60"),
+    (VoucherImported, "image_public"),
+]
+
+PRIVATE_STORAGE_FIELDS = [
+    (ColorProfileFile, "file"),
+    (PriorityVouchersFile, "file"),
+    (PostprocessingLog, "file"),
+    (VoucherImported, "image_raw"),
+    (VoucherImported, "image_resized_10"),
+    (VoucherImported, "image_resized_60"),
+    (VoucherImported, "image"),
+    (DarwinCoreArchiveFile, "file"),
+    (DarwinCoreArchiveSegment, "file"),
+]
+
+DELETE_BATCH_SIZE = 1000
+
+
+def referenced_files(fields: List[Tuple[Type[Model], str]]) -> Set[str]:
+    files = set()
+    for model, field in fields:
+        files.update(
+            model.objects.exclude(**{f"{field}__isnull": True}).exclude(**{field: ""}).values_list(
+                field, flat=True
+            ).iterator(chunk_size=10000)
+        )
+    return files
+
+
+def delete_keys(s3, bucket: str, keys: List[Tuple[str, int]], logger: logging.Logger) -> int:
+    response = s3.delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key, _ in keys], "Quiet": True}
+    )
+    failed = set()
+    for error in response.get("Errors", list()):
+        failed.add(error["Key"])
+        logger.error("Error deleting `{}`: {}".format(error["Key"], error.get("Message", error.get("Code"))))
+    return sum([size for key, size in keys if key not in failed])
+
+
 @shared_task(name='clean_storage')
-def clean_storage(log_folder: str):
+def clean_storage(log_folder: str, dry_run: bool = False):
     os.makedirs(log_folder, exist_ok=True)
     process_logger = TaskProcessLogger("Clean Storage", log_folder)
     try:
         s3 = boto3.client('s3')
         bucket = settings.AWS_STORAGE_BUCKET_NAME
-        process_logger.info("Cleaning Public Storage...")
-        public_location = PublicMediaStorage().location
         paginator = s3.get_paginator("list_objects_v2")
-        page_response = paginator.paginate(Bucket=bucket, Prefix=public_location)
-        to_delete = list()
-        public_files_to_delete = 0
-        for i, response in enumerate(page_response):
-            process_logger.debug(f"Page: {i + 1}")
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    file_name = obj['Key'].replace(public_location + "/", "")
-                    found = False
-                    for model, field, contains, extension in [
-                        (GalleryImage, "image", "", ".jpg"),
-                        (GalleryImage, "thumbnail", "_thumbnail", ".jpg"),
-                        (BannerImage, "banner", "", ".png"),
-                        (VoucherImported, "image_public_resized_10", "_public_resized_10", ".jpg"),
-                        (VoucherImported, "image_public_resized_60", "_public_resized_60", ".jpg"),
-                        (VoucherImported, "image_public", "_public", ".jpg"),
-                    ]:
-                        found = found or check_on_model(file_name, model, field, contains, extension, process_logger)
-                        if found:
-                            break
-                    if not found:
-                        process_logger.error(f"{file_name} not found on database")
-                        to_delete.append((obj['Key'], obj['Size']))
-                        public_files_to_delete += 1
-        process_logger.info(f"Public files to delete {public_files_to_delete}")
-        process_logger.info("Cleaning Private Storage...")
-        private_location = PrivateMediaStorage().location
-        page_response = paginator.paginate(Bucket=bucket, Prefix=private_location)
-        private_files_to_delete = 0
-        for i, response in enumerate(page_response):
-            process_logger.debug(f"Page: {i + 1}")
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    file_name = obj['Key'].replace(private_location + "/", "")
-                    found = False
-                    for model, field, contains, extension in [
-                        (ColorProfileFile, "file", "", ".dcp"),
-                        (PriorityVouchersFile, "file", "", ".xls"),
-                        (PriorityVouchersFile, "file", "", ".xlsx"),
-                        (PostprocessingLog, "file", "", ".log"),
-                        (VoucherImported, "image_raw", "", ".CR3"),
-                        (VoucherImported, "image_resized_10", "_resized_10", ".jpg"),
-                        (VoucherImported, "image_resized_60", "_resized_60", ".jpg"),
-                        (VoucherImported, "image", "", ".jpg"),
-                    ]:
-                        found = found or check_on_model(file_name, model, field, contains, extension, process_logger)
-                        if found:
-                            break
-                    if not found:
-                        process_logger.error(f"{file_name} not found on database")
-                        to_delete.append((obj['Key'], obj['Size']))
-                        private_files_to_delete += 1
-        process_logger.info(f"Private files to delete {private_files_to_delete}")
-        assert len(to_delete) == public_files_to_delete + private_files_to_delete, "Error on number of files to delete"
-        process_logger.info(f"Files to delete {len(to_delete)}")
         total_size_save = 0
-        for file_name, file_size in to_delete:
-            try:
-                process_logger.info(f"Deleting `{file_name}` ({show_storage(file_size)})")
-                s3.delete_object(Bucket=bucket, Key=file_name)
-                total_size_save += file_size
-                process_logger.debug(f"Total size saved: {show_storage(total_size_save)}")
-            except Exception as e:
-                process_logger.error(e, exc_info=True)
-        process_logger.info(f"Total size saved: {show_storage(total_size_save)}")
+        by_storage_class = dict()
+        for name, location, fields in [
+            ("Public", PublicMediaStorage().location, PUBLIC_STORAGE_FIELDS),
+            ("Private", PrivateMediaStorage().location, PRIVATE_STORAGE_FIELDS),
+        ]:
+            process_logger.info(f"Cleaning {name} Storage...")
+            files = referenced_files(fields)
+            process_logger.info(f"{len(files)} files referenced on database")
+            to_delete = list()
+            files_to_delete = 0
+            for i, response in enumerate(paginator.paginate(Bucket=bucket, Prefix=location + "/")):
+                process_logger.debug(f"Page: {i + 1}")
+                for obj in response.get('Contents', list()):
+                    file_name = obj['Key'][len(location) + 1:]
+                    if file_name in files:
+                        continue
+                    process_logger.error(f"{file_name} not found on database")
+                    files_to_delete += 1
+                    storage_class = obj.get('StorageClass', 'STANDARD')
+                    count, size = by_storage_class.get(storage_class, (0, 0))
+                    by_storage_class[storage_class] = (count + 1, size + obj['Size'])
+                    if dry_run:
+                        continue
+                    to_delete.append((obj['Key'], obj['Size']))
+                    if len(to_delete) == DELETE_BATCH_SIZE:
+                        total_size_save += delete_keys(s3, bucket, to_delete, process_logger)
+                        process_logger.debug(f"Total size saved: {show_storage(total_size_save)}")
+                        to_delete = list()
+            if len(to_delete) > 0:
+                total_size_save += delete_keys(s3, bucket, to_delete, process_logger)
+            process_logger.info(f"{name} files to delete {files_to_delete}")
+        for storage_class, (count, size) in sorted(by_storage_class.items()):
+            process_logger.info(f"{storage_class}: {count} files, {show_storage(size)}")
+        if dry_run:
+            process_logger.info("Dry run, nothing deleted")
+        else:
+            process_logger.info(f"Total size saved: {show_storage(total_size_save)}")
         s3.close()
     except Exception as e:
         process_logger.error(e, exc_info=True)
@@ -436,26 +647,8 @@ def clean_storage(log_folder: str):
     return "Cleaned"
 
 
-def check_on_model(
-        file_name: str, model: Type[Model],
-        field: str, contains: str, extension: str,
-        logger: logging.Logger
-) -> bool:
-    prefix = model._meta.get_field(field).upload_to
-    if prefix != "":
-        prefix = prefix if prefix.endswith("/") else prefix + "/"
-    if file_name.startswith(prefix) and contains in file_name and file_name.endswith(extension):
-        if model.objects.filter(**{field: file_name}).exists():
-            return True
-        else:
-            logger.warning(f"{model.__name__}.{field} does not include `{file_name}` file")
-            return False
-    else:
-        return False
-
-
 def show_storage(storage: int):
-    order = int(math.log(storage) / math.log(1024))
+    order = int(math.log(storage) / math.log(1024)) if storage > 0 else 0
     suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
     if order >= len(suffixes):
         order = len(suffixes) - 1
@@ -463,101 +656,237 @@ def show_storage(storage: int):
     return f"{human_readable:.2f} {suffixes[order]}"
 
 
+def __process_pending_voucher__(voucher: str, temp_folder: str, s3, logger: logging.Logger) -> None:
+    voucher_imported: VoucherImported = VoucherImported.objects.get(pk=int(voucher))
+    raw_file = voucher_imported.image_raw.name
+    image_raw_key = storage_key(voucher_imported.image_raw.storage, raw_file)
+    bucket_name = getattr(voucher_imported.image_raw.storage, "bucket_name", None)
+    logger.info(f"Saving file as {raw_file}...")
+    if bucket_name is not None:
+        s3.download_file(bucket_name, image_raw_key, os.path.join(temp_folder, raw_file), Config=transfer_config())
+    else:
+        stream_to_file(voucher_imported.image_raw.storage, raw_file, os.path.join(temp_folder, raw_file))
+    cr3_to_dng(temp_folder, temp_folder, logger)
+    if not os.path.exists(os.path.join(temp_folder, raw_file.replace(".CR3", ".dng"))):
+        raise FileNotFoundError(f"File {raw_file} cannot be converted to .dng")
+    dng_to_jpeg_color_profile(
+        temp_folder, temp_folder, voucher_imported.herbarium.collection_code,
+        voucher_imported.biodata_code.page.color_profile.file.url, logger
+    )
+    if not os.path.exists(os.path.join(temp_folder, raw_file.replace(".CR3", ".jpg"))):
+        raise FileNotFoundError(f"File {raw_file} cannot be converted to .jpg")
+    with open(os.path.join(temp_folder, raw_file.replace(".CR3", ".jpg")), "rb") as image_file:
+        derivatives = image_derivatives(
+            image_file, derivative_scales(voucher_imported.herbarium.collection_code)
+        )
+        image_file.seek(0)
+        voucher_imported.upload_derivatives(image=image_file, scaled=derivatives)
+        etiquette_picture(int(voucher), logger=logger)
+        voucher_imported.refresh_from_db()
+    logger.info("Deep Archive image raw")
+    s3.copy_object(
+        Bucket=bucket_name,
+        CopySource={'Bucket': bucket_name, 'Key': image_raw_key},
+        Key=image_raw_key,
+        StorageClass=voucher_imported.image_raw.storage.object_parameters["StorageClass"]
+    )
+    voucher_imported.save()
+    return
+
+
 @shared_task(name='process_pending_vouchers', bind=True)
 def process_pending_vouchers(self, pending_vouchers: List[str], user: int) -> str:
-    html_logger = HtmlLogger("Pending Logger")
-    temp_folder = self.request.id
     logging.info("Pending vouchers: {}".format(", ".join(pending_vouchers)))
     total = len(pending_vouchers)
-    os.makedirs(temp_folder, exist_ok=True)
-    log_object = PostprocessingLog(
+    log_object = PostprocessingLog.objects.create(
         date=dt.datetime.now(),
         found_images=total,
         created_by=User.objects.get(pk=user),
         scheduled=False
     )
-    process_logger = TaskProcessLogger("Pending Logger", temp_folder)
-    logger = GroupLogger("Pending Logger", html_logger, process_logger)
-    for i, voucher in enumerate(pending_vouchers):
+    self.update_state(state='PROGRESS', meta={"step": 0, "total": total})
+    chunk_size = settings.PENDING_CHUNK_SIZE
+    chunks = [pending_vouchers[i:i + chunk_size] for i in range(0, total, chunk_size)]
+    chord(
+        process_pending_chunk.s(chunk, log_object.pk, self.request.id, total) for chunk in chunks
+    )(finish_pending_vouchers.s(log_object.pk, self.request.id, total).on_error(
+        fail_pending_vouchers.s(log_object.pk, self.request.id, total)
+    ))
+    raise Ignore()
+
+
+@shared_task(name='process_pending_chunk', bind=True)
+def process_pending_chunk(self, pending_vouchers: List[str], log_id: int, parent_id: str, total: int) -> Dict:
+    temp_folder = self.request.id
+    os.makedirs(temp_folder, exist_ok=True)
+    logger = TaskProcessLogger("Pending Logger", temp_folder)
+    progress = ProgressReporter(self, total=total, task_id=parent_id)
+    s3 = boto3.client('s3')
+    processed, failed = 0, 0
+    for voucher in pending_vouchers:
         try:
-            voucher_imported: VoucherImported = VoucherImported.objects.get(pk=int(voucher))
-            raw_file = voucher_imported.image_raw.name
-            logger.info(f"Saving file as {raw_file}...")
-            with PrivateMediaStorage().open(raw_file) as raw_image_file:
-                with open(os.path.join(temp_folder, raw_file), "wb") as local_file:
-                    local_file.write(raw_image_file.read())
-            cr3_to_dng(temp_folder, temp_folder, logger)
-            self.update_state(state='PROGRESS', meta={
-                "step": i, "total": total, "logs": logger[0].get_logs()
-            })
-            if not os.path.exists(os.path.join(temp_folder, raw_file.replace(".CR3", ".dng"))):
-                raise FileNotFoundError(f"File {raw_file} cannot be converted to .dng")
-            dng_to_jpeg_color_profile(
-                temp_folder, temp_folder, voucher_imported.herbarium.collection_code,
-                voucher_imported.biodata_code.page.color_profile.file.url, logger
-            )
-            if not os.path.exists(os.path.join(temp_folder, raw_file.replace(".CR3", ".jpg"))):
-                raise FileNotFoundError(f"File {raw_file} cannot be converted to .jpg")
-            self.update_state(state='PROGRESS', meta={
-                "step": i, "total": total, "logs": logger[0].get_logs()
-            })
-            with open(os.path.join(temp_folder, raw_file.replace(".CR3", ".jpg")), "rb") as image_file:
-                voucher_imported.upload_image(image_file)
-                image = Image.open(image_file)
-                for scale_percent in [10, 60]:
-                    resized_image = change_image_resolution(image, scale_percent)
-                    voucher_imported.upload_scaled_image(resized_image, scale_percent)
-                voucher_imported.save()
-                self.update_state(state='PROGRESS', meta={
-                    "step": i, "total": total, "logs": logger[0].get_logs()
-                })
-                etiquette_picture(int(voucher), logger=logger)
-                voucher_imported.refresh_from_db()
-            log_object.processed_images += 1
-            logger.info("Deep Archive image raw")
-            image_raw_key = voucher_imported.image_raw.storage.location + "/" + voucher_imported.image_raw.name
-            bucket_name = voucher_imported.image_raw.storage.bucket_name
-            s3 = boto3.client('s3')
-            s3.copy_object(
-                Bucket=bucket_name,
-                CopySource={'Bucket': bucket_name, 'Key': image_raw_key},
-                Key=image_raw_key,
-                StorageClass=voucher_imported.image_raw.storage.object_parameters["StorageClass"]
-            )
-            voucher_imported.save()
+            __process_pending_voucher__(voucher, temp_folder, s3, logger)
+            processed += 1
+            PostprocessingLog.objects.filter(pk=log_id).update(processed_images=F("processed_images") + 1)
+            RawRestore.objects.filter(voucher_id=int(voucher)).delete()
         except Exception as e:
             logger.error(e, exc_info=True)
-            log_object.failed_images += 1
+            failed += 1
+            PostprocessingLog.objects.filter(pk=log_id).update(failed_images=F("failed_images") + 1)
+            restore = RawRestore.objects.filter(voucher_id=int(voucher)).first()
+            if restore is not None:
+                restore.state = RawRestore.FAILED
+                restore.error = str(e)
+                restore.backoff(timezone.now())
+                restore.save()
         finally:
-            self.update_state(
-                state='PROGRESS',
-                meta={
-                    "step": i + 1,
-                    "total": total,
-                    "logs": logger[0].get_logs()
-                }
-            )
+            done = PostprocessingLog.objects.filter(pk=log_id).values_list(
+                F("processed_images") + F("failed_images"), flat=True
+            ).first()
+            progress.update(done)
             logger.debug("Cleaning folder")
             for tmp_file in os.listdir(temp_folder):
                 if os.path.splitext(tmp_file)[1] in [".jpg", ".CR3", ".dng"]:
                     os.remove(os.path.join(temp_folder, tmp_file))
+    s3.close()
+    logger.close()
+    log_file = None
     try:
-        logger[1].close()
-        with open(logger[1].file_path, "rb") as log_file:
-            log_object.file.save(
-                f"manually/{self.request.id}.log",
-                ContentFile(log_file.read()),
-                save=True
-            )
-        log_object.save()
-        close_process(logger[0], self, {"step": total, "total": total, })
+        with open(logger.file_path, "rb") as file:
+            log_file = PrivateMediaStorage().save(f"manually/{parent_id}/{self.request.id}.log", file)
         shutil.rmtree(temp_folder)
+    except Exception as e:
+        logging.error(e, exc_info=True)
+    return {"processed": processed, "failed": failed, "log": log_file}
+
+
+@shared_task(name='finish_pending_vouchers', bind=True)
+def finish_pending_vouchers(self, results: List[Dict], log_id: int, parent_id: str, total: int) -> str:
+    html_logger = HtmlLogger("Pending Logger")
+    log_object = PostprocessingLog.objects.get(pk=log_id)
+    storage = PrivateMediaStorage()
+    try:
+        with tempfile.TemporaryFile() as log_file:
+            for result in results:
+                if result["log"] is None:
+                    continue
+                with storage.open(result["log"]) as chunk_log:
+                    shutil.copyfileobj(chunk_log, log_file)
+                storage.delete(result["log"])
+            log_file.seek(0)
+            log_object.file.save(f"manually/{parent_id}.log", File(log_file, name=f"{parent_id}.log"), save=True)
+        html_logger.info("Processed {} of {} vouchers, {} failed".format(
+            log_object.processed_images, total, log_object.failed_images
+        ))
+        close_process(html_logger, self, {"step": total, "total": total, }, task_id=parent_id)
         return "Processed"
     except Exception as e:
         logging.error(e, exc_info=True)
+        html_logger.error(e)
+        close_process(html_logger, self, {"step": total, "total": total, }, error={
+            "type": str(type(e)),
+            "msg": str(e),
+        }, task_id=parent_id)
         return str(e)
 
 
+@shared_task(name='fail_pending_vouchers', bind=True)
+def fail_pending_vouchers(self, request, exc: Exception, traceback, log_id: int, parent_id: str, total: int) -> str:
+    html_logger = HtmlLogger("Pending Logger")
+    logging.error("Chunk {} of pending vouchers {} failed: {}".format(request.id, parent_id, exc))
+    html_logger.error(exc)
+    done = PostprocessingLog.objects.filter(pk=log_id).values_list(
+        F("processed_images") + F("failed_images"), flat=True
+    ).first()
+    close_process(html_logger, self, {"step": done, "total": total, }, error={
+        "type": str(type(exc)),
+        "msg": str(exc),
+    }, task_id=parent_id)
+    return str(exc)
+
+
+def __check_restore__(s3, restore: RawRestore) -> Tuple[int, Union[str, None]]:
+    image_raw = restore.voucher.image_raw
+    key = storage_key(image_raw.storage, image_raw.name)
+    try:
+        response = s3.head_object(Bucket=image_raw.storage.bucket_name, Key=key)
+        if response.get("StorageClass", "STANDARD") not in ["DEEP_ARCHIVE", "GLACIER"]:
+            if restore.state == RawRestore.PENDING:
+                return RawRestore.PENDING, "Raw image is not archived, no restore needed"
+            return RawRestore.RESTORED, None
+        if "Restore" in response:
+            if 'ongoing-request="true"' in response["Restore"]:
+                return RawRestore.REQUESTED, None
+            return RawRestore.RESTORED, None
+        s3.restore_object(
+            Bucket=image_raw.storage.bucket_name,
+            Key=key,
+            RestoreRequest={
+                'Days': settings.RESTORE_DAYS,
+                'GlacierJobParameters': {
+                    'Tier': settings.RESTORE_TIER,
+                }
+            }
+        )
+        return RawRestore.REQUESTED, None
+    except Exception as e:
+        return restore.state, str(e)
+
+
+@shared_task(name='restore_pending_vouchers')
+def restore_pending_vouchers() -> str:
+    now = timezone.now()
+    RawRestore.objects.exclude(voucher__biodata_code__voucher_state=8).delete()
+    missing = VoucherImported.objects.filter(
+        biodata_code__voucher_state=8, raw_restore__isnull=True,
+        updated_at__lte=now - dt.timedelta(seconds=settings.RESTORE_GRACE_PERIOD)
+    ).values_list("pk", flat=True)
+    RawRestore.objects.bulk_create([
+        RawRestore(voucher_id=voucher_id, next_check=now) for voucher_id in missing
+    ], ignore_conflicts=True)
+    due = list(RawRestore.objects.filter(
+        state__in=[RawRestore.PENDING, RawRestore.REQUESTED, RawRestore.QUEUED, RawRestore.FAILED],
+        next_check__lte=now
+    ).select_related("voucher", "voucher__biodata_code").order_by("next_check")[:settings.RESTORE_BATCH_SIZE])
+    if len(due) == 0:
+        return "Nothing to check"
+    logging.info("Checking restore of {} raw images".format(len(due)))
+    for restore in due:
+        if restore.state == RawRestore.QUEUED:
+            logging.warning("Voucher {} queued but not processed in time, checking again".format(restore.voucher_id))
+            restore.state = RawRestore.REQUESTED
+        elif restore.state == RawRestore.FAILED:
+            logging.warning("Retrying voucher {} after failure: {}".format(restore.voucher_id, restore.error))
+            restore.state = RawRestore.REQUESTED
+    s3 = boto3.client('s3')
+    with ThreadPoolExecutor(max_workers=settings.RESTORE_WORKERS) as executor:
+        results = list(executor.map(partial(__check_restore__, s3), due))
+    s3.close()
+    to_process = dict()
+    for restore, (state, error) in zip(due, results):
+        restore.error = error
+        restore.updated_at = now
+        if error is not None:
+            logging.warning("Error checking restore of voucher {}: {}".format(restore.voucher_id, error))
+        if state == RawRestore.RESTORED:
+            restore.state = RawRestore.QUEUED
+            restore.next_check = now + dt.timedelta(seconds=settings.RESTORE_QUEUED_TIMEOUT)
+            user = restore.voucher.biodata_code.created_by_id
+            to_process.setdefault(user, list()).append(str(restore.voucher_id))
+        else:
+            restore.state = state
+            restore.backoff(now)
+    RawRestore.objects.bulk_update(due, ["state", "checks", "next_check", "error", "updated_at"])
+    for user, vouchers in to_process.items():
+        logging.info("Queueing {} restored vouchers".format(len(vouchers)))
+        process_pending_vouchers.delay(vouchers, user)
+    return "Restored: {}, in progress: {}, failed: {}".format(
+        sum([len(vouchers) for vouchers in to_process.values()]),
+        sum([state == RawRestore.REQUESTED for state, _ in results]),
+        RawRestore.objects.filter(state=RawRestore.FAILED).count()
+    )
+
+
 @shared_task(name="upload_priority_vouchers", bind=True)
 def upload_priority_vouchers(self, priority_voucher: int):
     html_logger = HtmlLogger("Priority Logger")
@@ -565,31 +894,17 @@ def upload_priority_vouchers(self, priority_voucher: int):
     os.makedirs(temp_folder, exist_ok=True)
     process_logger = TaskProcessLogger("Priority Logger", temp_folder)
     logger = GroupLogger("Priority Logger", html_logger, process_logger)
+    progress = ProgressReporter(self, html_logger)
     priorities = PriorityVouchersFile.objects.get(pk=priority_voucher)
     logger.info("Reading priorities...")
     logger.debug(f"Reading excel file {priorities.file.name}")
-    self.update_state(
-        state='PROGRESS',
-        meta={
-            "step": 0,
-            "total": 1,
-            "logs": logger[0].get_logs()
-        }
-    )
+    progress.flush()
     total = 1
     error = dict()
-    on_database = False
-    missing_species = False
-    code_error = False
-    voucher_assertion = False
     try:
         data = pd.read_excel(priorities.file, header=0)
         data.rename(columns=DCW_SQL, inplace=True)
         sql_dcw = {v: k for k, v in DCW_SQL.items()}
-        database_errors = list()
-        species_errors = list()
-        errors = list()
-        voucher_errors = list()
         logger.info("Checking duplications in file")
         duplicated = data[data.duplicated(["catalog_number"], keep=False)]
         logger.debug(f"Found {len(duplicated)} row duplicated")
@@ -600,65 +915,16 @@ def upload_priority_vouchers(self, priority_voucher: int):
         with transaction.atomic():
             logger.info("Checking rows")
             total = len(data)
-            for i, (index, row) in enumerate(data.iterrows()):
-                try:
-                    code = "{}:{}:{:07d}".format(
-                        priorities.herbarium.institution_code,
-                        priorities.herbarium.collection_code,
-                        row["catalog_number"]
-                    )
-                    biodata_codes = BiodataCode.objects.filter(code=code).all()
-                    if len(biodata_codes) != 0:
-                        logger.warning(f"Code {code} already on database")
-                        biodata_code = biodata_codes[0]
-                        if biodata_code.voucher_state in [0, 1, 7, 8]:
-                            logger.error(
-                                f"{code} is assigned to a '{biodata_code.get_voucher_state_display()}' voucher"
-                            )
-                            database_errors.append(row)
-                            on_database = True
-                            continue
-                        else:
-                            logger.debug(f"Overwriting code '{code}'")
-                            biodata_code.delete()
-                    biodata_code = BiodataCode(
-                        herbarium=priorities.herbarium,
-                        code=code,
-                        catalog_number=row["catalog_number"],
-                        created_by=priorities.created_by,
-                        created_at=dt.datetime.now(tz=pytz.timezone('America/Santiago')),
-                        qr_generated=False
-                    )
-                    biodata_code.save()
-                    logger.debug(f"New occurrence ({biodata_code.id}) added with code {code}")
-                    species, info = get_species(row, logger)
-                    if species is None:
-                        species_errors.append(info)
-                        missing_species = True
-                        continue
-                    try:
-                        voucher_imported = VoucherImported.from_pandas_row(
-                            row, priorities, species=species, biodata_code=biodata_code, logger=logger
-                        )
-                    except AssertionError as e:
-                        voucher_assertion = True
-                        row["assertion"] = str(e)
-                        voucher_errors.append(row)
-                        continue
-                    voucher_imported.save()
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-                    errors.append(row)
-                    code_error = True
-                finally:
-                    self.update_state(
-                        state='PROGRESS',
-                        meta={
-                            "step": i,
-                            "total": total,
-                            "logs": logger[0].get_logs(),
-                        }
-                    )
+            importer = PriorityVouchersImporter(priorities, logger)
+            importer.run(data, progress=lambda step, steps: progress.update(step, total=steps))
+            database_errors = importer.database_errors
+            species_errors = importer.species_errors
+            voucher_errors = importer.voucher_errors
+            errors = importer.errors
+            on_database = len(database_errors) > 0
+            missing_species = len(species_errors) > 0
+            code_error = len(errors) > 0
+            voucher_assertion = len(voucher_errors) > 0
             if on_database:
                 error["type"] = "duplicates in database"
                 error["data"] = pd.DataFrame(database_errors).rename(columns=sql_dcw).to_json()
@@ -697,65 +963,15 @@ def upload_priority_vouchers(self, priority_voucher: int):
         raise Ignore()
 
 
-def get_species(data_candid: pd.Series, logger: logging.Logger) -> Tuple[Species, pd.Series]:
-    info = data_candid.copy(deep=True)
-    species = Species.objects.filter(scientific_name_db=data_candid["scientific_name"].strip()).first()
-    if species is None:
-        logger.warning("Searching using trigram similarity")
-        similarity_values = Species.objects.annotate(
-            similarity=TrigramSimilarity(
-                'scientific_name_db',
-                data_candid['scientific_name'].strip().upper()
-            ),
-        ).filter(
-            similarity__gte=0.55
-        ).order_by('-similarity')
-        if len(similarity_values) > 0:
-            logger.debug("Similarity found on accepted species")
-            if similarity_values[0].similarity < 1:
-                info['similarity'] = similarity_values[0].similarity
-                info['scientific_name_similarity'] = similarity_values[0].scientific_name
-                info['synonymy_similarity'] = ''
-            else:
-                logger.warning("Error on similarity found")
-        else:
-            similarity_values = Synonymy.objects.annotate(
-                similarity=TrigramSimilarity(
-                    'scientific_name_db',
-                    data_candid['scientific_name'].strip().upper()
-                ),
-            ).filter(
-                similarity__gte=0.55
-            ).order_by('-similarity')
-            if len(similarity_values) > 0:
-                logger.debug("Similarity found on synonym")
-                info['similarity'] = similarity_values[0].similarity
-                species_synonymy = Species.objects.filter(synonyms=similarity_values[0].id)
-                info['scientific_name_similarity'] = species_synonymy[0].scientific_name
-                info['synonymy_similarity'] = similarity_values[0].scientific_name
-            else:
-                logger.warning("No similarity found")
-                info['similarity'] = 0
-                info['scientific_name_similarity'] = ''
-                info['synonymy_similarity'] = ''
-    else:
-        logger.debug(f"Species {data_candid['scientific_name'].strip()} found")
-    return species, info
-
-
-
-
-
 @shared_task(name="extract_taken_by", bind=True)
 def get_taken_by(self, image_path: str, logger: logging.Logger = None) -> Tuple[str, str]:
     if logger is None:
         logger = logging.getLogger(__name__)
     logger.info(f"Image to process: {image_path}")
     try:
-        image = PrivateMediaStorage().open(image_path)
-        self.update_state(state="PROGRESS", meta={"on": "Image loaded"})
-        arr = np.asarray(bytearray(image.read()), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
+        with local_copy(PrivateMediaStorage(), image_path) as local_path:
+            self.update_state(state="PROGRESS", meta={"on": "Image loaded"})
+            img = cv2.imread(local_path, cv2.IMREAD_UNCHANGED)
         self.update_state(state="PROGRESS", meta={"on": "Image converted"})
         text = pytesseract.image_to_string(img)
         self.update_state(state="PROGRESS", meta={"on": "Text found"})
@@ -774,11 +990,28 @@ def get_taken_by(self, image_path: str, logger: logging.Logger = None) -> Tuple[
     return text, candidate
 
 
+@shared_task(name="delete_voucher_files")
+def delete_voucher_files(files: List[Tuple[str, str]]) -> None:
+    for field, name in files:
+        try:
+            if VoucherImported.objects.filter(**{field: name}).exists():
+                logging.warning("{} still used on {}, not deleting".format(name, field))
+                continue
+            VoucherImported._meta.get_field(field).storage.delete(name)
+            logging.info("{} deleted from {}".format(name, field))
+        except Exception as e:
+            logging.error("Error deleting {} from {}".format(name, field))
+            logging.error(e, exc_info=True)
+    return
+
+
 @shared_task(name="generate_thumbnail")
 def generate_thumbnail(gallery_id: int) -> None:
     try:
         gallery: GalleryImage = GalleryImage.objects.get(pk=gallery_id)
-        image = Image.open(gallery.image)
+        with local_copy(gallery.image.storage, gallery.image.name) as image_path:
+            image = Image.open(image_path)
+            image.load()
         gallery.aspect_ratio = image.size[0] / image.size[1]
         scale_percent = 200 * 100 / image.size[1]
         resized_image = change_image_resolution(image, scale_percent)
@@ -1,4 +1,172 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+import hashlib
+import os
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import boto3
+from boto3.s3.transfer import TransferConfig
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+from moto import mock_aws
+
+from apps.digitalization.utils import ByteBudget, S3File, SessionFolder, stream_to_file, storage_key, transfer_config
+
+BUCKET = "herbarium-test"
+MiB = 1024 * 1024
+
+
+class RecordingBudget(ByteBudget):
+    def __init__(self, capacity: int) -> None:
+        super().__init__(capacity)
+        self.peak = 0
+        self.__peak_lock__ = threading.Lock()
+
+    def acquire(self, size: int) -> int:
+        reserved = super().acquire(size)
+        with self.__peak_lock__:
+            self.peak = max(self.peak, self.in_flight)
+        return reserved
+
+
+class S3TestCase(SimpleTestCase):
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, {
+            "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": "us-east-1",
+        })
+        self.environ.start()
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.folder = tempfile.TemporaryDirectory()
+        self.ranges = list()
+        self.s3.meta.events.register(
+            "provide-client-params.s3.GetObject", lambda params, **kwargs: self.ranges.append(params.get("Range"))
+        )
+
+    def tearDown(self):
+        self.folder.cleanup()
+        self.s3.close()
+        self.mock.stop()
+        self.environ.stop()
+
+    def put(self, key: str, size: int) -> str:
+        body = os.urandom(size)
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        return hashlib.sha256(body).hexdigest()
+
+    def local_digest(self, *path: str) -> str:
+        with open(os.path.join(self.folder.name, *path), "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+
+class S3FileTest(S3TestCase):
+    @override_settings(S3_TRANSFER={"multipart_threshold": 5 * MiB, "multipart_chunksize": 5 * MiB, "max_concurrency": 4})
+    def test_multipart_download(self):
+        digest = self.put("digitalization/input/CONC/session/IMG_0001.CR3", 12 * MiB)
+        config = transfer_config()
+        self.assertEqual(config.multipart_threshold, 5 * MiB)
+        self.assertEqual(config.max_request_concurrency, 4)
+        file = S3File(
+            "digitalization/input/CONC/session/IMG_0001.CR3", "digitalization/input/CONC/session",
+            self.folder.name, size=12 * MiB
+        )
+        file.download(self.s3, BUCKET, config=config)
+        self.assertEqual(self.local_digest("IMG_0001.CR3"), digest)
+        self.assertEqual(len([byte_range for byte_range in self.ranges if byte_range is not None]), 3)
+
+    def test_small_download_single_request(self):
+        digest = self.put("digitalization/input/CONC/session/IMG_0002.CR3", MiB)
+        file = S3File(
+            "digitalization/input/CONC/session/IMG_0002.CR3", "digitalization/input/CONC/session",
+            self.folder.name, size=MiB
+        )
+        file.download(self.s3, BUCKET, config=TransferConfig(multipart_threshold=5 * MiB))
+        self.assertEqual(self.local_digest("IMG_0002.CR3"), digest)
+        self.assertEqual(len(self.ranges), 1)
+
+
+class SessionFolderTest(S3TestCase):
+    def session(self, sizes):
+        session = SessionFolder("CONC", "session", self.folder.name, "digitalization/input/")
+        digests = dict()
+        for i, size in enumerate(sizes):
+            key = f"digitalization/input/CONC/session/IMG_{i:04d}.CR3"
+            digests[f"IMG_{i:04d}.CR3"] = self.put(key, size)
+        self.put("digitalization/input/CONC/session/notes.txt", 10)
+        session.add_files(
+            [f"digitalization/input/CONC/session/IMG_{i:04d}.CR3" for i in range(len(sizes))]
+            + ["digitalization/input/CONC/session/notes.txt"],
+            sizes={f"digitalization/input/CONC/session/IMG_{i:04d}.CR3": size for i, size in enumerate(sizes)}
+        )
+        return session, digests
+
+    def test_concurrent_download(self):
+        session, digests = self.session([MiB, 2 * MiB, 3 * MiB, MiB, 2 * MiB])
+        self.assertEqual(len(session), 5)
+        session.download(self.s3, BUCKET, workers=3, config=TransferConfig(multipart_threshold=5 * MiB))
+        self.assertEqual(sorted(os.listdir(self.folder.name)), sorted(digests.keys()))
+        for filename, digest in digests.items():
+            self.assertEqual(self.local_digest(filename), digest)
+
+    def test_budget_limits_bytes_in_flight(self):
+        session, digests = self.session([3 * MiB] * 6)
+        budget = RecordingBudget(4 * MiB)
+        session.download(
+            self.s3, BUCKET, workers=6, config=TransferConfig(multipart_threshold=5 * MiB), budget=budget
+        )
+        self.assertLessEqual(budget.peak, 4 * MiB)
+        self.assertEqual(budget.in_flight, 0)
+        for filename, digest in digests.items():
+            self.assertEqual(self.local_digest(filename), digest)
+
+
+class ByteBudgetTest(SimpleTestCase):
+    def test_oversized_transfer_is_clamped(self):
+        budget = ByteBudget(10)
+        reserved = budget.acquire(25)
+        self.assertEqual(reserved, 10)
+        self.assertEqual(budget.in_flight, 10)
+        budget.release(reserved)
+        self.assertEqual(budget.in_flight, 0)
+
+    def test_acquire_waits_for_release(self):
+        budget = ByteBudget(10)
+        first = budget.acquire(8)
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (budget.acquire(5), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        budget.release(first)
+        self.assertTrue(acquired.wait(2))
+        thread.join()
+        self.assertEqual(budget.in_flight, 5)
+
+
+class StreamToFileTest(S3TestCase):
+    def test_storage_with_bucket(self):
+        digest = self.put("private/vouchers/IMG_0001.CR3", 2 * MiB)
+        storage = mock.Mock(spec=["bucket_name", "location"], bucket_name=BUCKET, location="private/")
+        path = stream_to_file(storage, "vouchers/IMG_0001.CR3", os.path.join(self.folder.name, "raw.CR3"), s3=self.s3)
+        self.assertEqual(self.local_digest("raw.CR3"), digest)
+        self.assertEqual(path, os.path.join(self.folder.name, "raw.CR3"))
+
+    @override_settings(STORAGE_STREAM_BUFFER=1024)
+    def test_storage_without_bucket(self):
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemStorage(location=location)
+            body = os.urandom(MiB + 7)
+            name = storage.save("vouchers/IMG_0001.CR3", ContentFile(body))
+            stream_to_file(storage, name, os.path.join(self.folder.name, "raw.CR3"))
+        self.assertEqual(self.local_digest("raw.CR3"), hashlib.sha256(body).hexdigest())
+        self.assertEqual(self.ranges, list())
+
+
+class StorageKeyTest(SimpleTestCase):
+    def test_join(self):
+        self.assertEqual(storage_key(mock.Mock(location="private"), "a/b.CR3"), "private/a/b.CR3")
+        self.assertEqual(storage_key(mock.Mock(location="private/"), "/a/b.CR3"), "private/a/b.CR3")
+        self.assertEqual(storage_key(mock.Mock(location=""), "a/b.CR3"), "a/b.CR3")
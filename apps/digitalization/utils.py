@@ -1,25 +1,37 @@
 import glob
 import glob
 import logging
+import math
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from io import BytesIO
-from typing import Set, Union, List
+from typing import Any, BinaryIO, Dict, Iterator, Set, Tuple, Union, List
 
 import boto3
 import cv2
 import numpy as np
+import PIL.Image
+from PIL import ImageDraw, ImageFont
 from PIL.Image import Image
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import GEOSGeometry
+from django.core.files.storage import Storage
 from django.template.loader import get_template
 from pyzbar.pyzbar import decode, ZBarSymbol  # Para la decodificación de códigos QR
 from xhtml2pdf import pisa
 
-from apps.digitalization.models import TemporalArea
+from apps.digitalization.models import TemporalArea, LabelPosition, LABEL_GRID
 
 
 def log_stdout_stderr(out: bytes, err: bytes, logger: logging.Logger, log_cache: Set[str] = None) -> None:
@@ -58,14 +70,182 @@ def log_stdout_stderr(out: bytes, err: bytes, logger: logging.Logger, log_cache:
     return
 
 
+def transfer_config() -> TransferConfig:
+    """
+    Configuration of the S3 transfer manager, downloads bigger than the
+    threshold are split in ranged requests executed concurrently
+
+    Returns
+    -------
+    TransferConfig
+        Transfer configuration based on settings
+    """
+    return TransferConfig(
+        multipart_threshold=settings.S3_TRANSFER["multipart_threshold"],
+        multipart_chunksize=settings.S3_TRANSFER["multipart_chunksize"],
+        max_concurrency=settings.S3_TRANSFER["max_concurrency"],
+        use_threads=True,
+    )
+
+
+def storage_key(storage: Storage, name: str) -> str:
+    """
+    Key of a stored file on the bucket of its storage, joining the
+    location of the storage and the name of the file
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage of the file
+    name : str
+        Name of the file on the storage
+
+    Returns
+    -------
+    str
+        Key of the object on the bucket
+    """
+    location = (getattr(storage, "location", "") or "").strip("/")
+    name = name.lstrip("/")
+    return f"{location}/{name}" if location != "" else name
+
+
+def stream_to_file(storage: Storage, name: str, path: str, s3: boto3.client = None) -> str:
+    """
+    Copies a stored file to a local path reading it in chunks of
+    `STORAGE_STREAM_BUFFER` bytes, so the whole file is never in memory
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage of the file
+    name : str
+        Name of the file on the storage
+    path : str
+        Local path where to write the file
+    s3 : boto3.client, optional
+        S3 client to use on S3 storages, a new one by default
+
+    Returns
+    -------
+    str
+        Local path of the file
+    """
+    buffer_size = settings.STORAGE_STREAM_BUFFER
+    with open(path, "wb") as local_file:
+        if hasattr(storage, "bucket_name"):
+            s3 = s3 if s3 is not None else boto3.client('s3')
+            response = s3.get_object(Bucket=storage.bucket_name, Key=storage_key(storage, name))
+            for chunk in response["Body"].iter_chunks(chunk_size=buffer_size):
+                local_file.write(chunk)
+        else:
+            with storage.open(name, "rb") as stored_file:
+                shutil.copyfileobj(stored_file, local_file, buffer_size)
+    return path
+
+
+@contextmanager
+def local_copy(storage: Storage, name: str, s3: boto3.client = None) -> Iterator[str]:
+    """
+    Streams a stored file to a temporary file, removed when the block ends
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage of the file
+    name : str
+        Name of the file on the storage
+    s3 : boto3.client, optional
+        S3 client to use on S3 storages, a new one by default
+
+    Returns
+    -------
+    Iterator[str]
+        Local path of the temporary copy
+    """
+    descriptor, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+    os.close(descriptor)
+    try:
+        yield stream_to_file(storage, name, path, s3=s3)
+    finally:
+        os.remove(path)
+
+
+class ByteBudget:
+    def __init__(self, capacity: int) -> None:
+        """
+        Caps the number of bytes transferred at the same time
+        across threads
+
+        Parameters
+        ----------
+        capacity : int
+            Maximum number of bytes in flight
+        """
+        assert capacity > 0, "Capacity must be positive"
+        self.__capacity__ = capacity
+        self.__used__ = 0
+        self.__condition__ = threading.Condition()
+        return
+
+    def acquire(self, size: int) -> int:
+        """
+        Blocks until `size` bytes are available. A single transfer bigger
+        than the capacity is allowed, but only when nothing else is in flight
+
+        Parameters
+        ----------
+        size : int
+            Bytes to reserve
+
+        Returns
+        -------
+        int
+            Bytes reserved, to be given back with `release`
+        """
+        size = min(size, self.__capacity__)
+        with self.__condition__:
+            while self.__used__ + size > self.__capacity__:
+                self.__condition__.wait()
+            self.__used__ += size
+        return size
+
+    def release(self, size: int) -> None:
+        with self.__condition__:
+            self.__used__ -= size
+            self.__condition__.notify_all()
+        return
+
+    @property
+    def in_flight(self) -> int:
+        return self.__used__
+
+
 class S3File:
-    def __init__(self, file_path: str, remote_path: str, input_folder: str) -> None:
+    def __init__(self, file_path: str, remote_path: str, input_folder: str, size: int = 0) -> None:
         self.__input_folder__ = input_folder
         self.__remote_path__ = remote_path
         self.__filename__ = file_path.split(remote_path + "/")[1]
+        self.__size__ = size
         return
 
-    def download(self, s3: boto3.client, bucket_name: str, logger: logging.Logger = None) -> None:
+    @property
+    def filename(self) -> str:
+        return self.__filename__
+
+    @property
+    def size(self) -> int:
+        return self.__size__
+
+    @property
+    def stem(self) -> str:
+        return os.path.splitext(self.__filename__)[0]
+
+    def download(
+            self, s3: boto3.client, bucket_name: str,
+            logger: logging.Logger = None, input_folder: str = None,
+            config: TransferConfig = None, budget: ByteBudget = None
+    ) -> None:
         """
         Downloads image on path
 
@@ -77,6 +257,12 @@ class S3File:
             Bucket name
         logger : Logger
             Object to manage logs
+        input_folder : str, optional
+            Folder where to put the file, defaults to the folder of the session
+        config : TransferConfig, optional
+            Configuration of the transfer manager (multipart ranges and concurrency)
+        budget : ByteBudget, optional
+            Shared cap of bytes in flight
 
         Returns
         -------
@@ -84,12 +270,20 @@ class S3File:
         """
         if logger is None:
             logger = logging.getLogger(__name__)
+        if input_folder is None:
+            input_folder = self.__input_folder__
         remote_path = f"{self.__remote_path__}/{self.__filename__}"
-        logger.debug("Downloading {}".format(remote_path))
-        s3.download_file(
-            bucket_name, remote_path,
-            os.path.join(self.__input_folder__, self.__filename__)
-        )
+        reserved = budget.acquire(self.__size__) if budget is not None else 0
+        try:
+            logger.debug("Downloading {}".format(remote_path))
+            s3.download_file(
+                bucket_name, remote_path,
+                os.path.join(input_folder, self.__filename__),
+                Config=config
+            )
+        finally:
+            if budget is not None:
+                budget.release(reserved)
         return
 
     def __unicode__(self) -> str:
@@ -140,7 +334,13 @@ class SessionFolder:
     def get_institution(self) -> str:
         return self.__institution__
 
-    def add_files(self, files: List[str]) -> None:
+    def get_session(self) -> str:
+        return self.__session__
+
+    def get_files(self) -> List[S3File]:
+        return sorted(self.__files__, key=lambda file: file.filename)
+
+    def add_files(self, files: List[str], sizes: Dict[str, int] = None) -> None:
         """
         Adds files to Session Folder to be
         processed
@@ -149,17 +349,22 @@ class SessionFolder:
         ----------
         files : List[str]
             List of candidate files
+        sizes : Dict[str, int], optional
+            Size in bytes of each file, used to cap bytes in flight
 
         Returns
         -------
         None
         """
+        if sizes is None:
+            sizes = dict()
         for file in files:
             file_name, file_extension = os.path.splitext(file)
             if file_extension == ".CR3":
                 self.__files__.add(S3File(
                     file, self.__remote_prefix__,
-                    self.__input_folder__
+                    self.__input_folder__,
+                    size=sizes.get(file, 0)
                 ))
         return
 
@@ -173,7 +378,11 @@ class SessionFolder:
         """
         os.makedirs(self.__input_folder__, exist_ok=True)
 
-    def download(self, s3: boto3.client, bucket_name: str, logger: logging.Logger = None) -> None:
+    def download(
+            self, s3: boto3.client, bucket_name: str,
+            logger: logging.Logger = None, workers: int = 1,
+            config: TransferConfig = None, budget: ByteBudget = None
+    ) -> None:
         """
         Downloads all images on path
 
@@ -185,13 +394,24 @@ class SessionFolder:
             Bucket name
         logger : Logger
             Object to manage logs
+        workers : int
+            Number of files downloaded at the same time
+        config : TransferConfig, optional
+            Configuration of the transfer manager (multipart ranges and concurrency)
+        budget : ByteBudget, optional
+            Shared cap of bytes in flight
 
         Returns
         -------
         None
         """
-        for file in self.__files__:
-            file.download(s3, bucket_name, logger=logger)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(file.download, s3, bucket_name, logger=logger, config=config, budget=budget)
+                for file in self.__files__
+            ]
+        for future in futures:
+            future.result()
         return
 
     def close_session(self, s3: boto3.client, bucket_name: str, logger: logging.Logger = None) -> None:
@@ -308,6 +528,57 @@ def cr3_to_dng(
     return
 
 
+RAWTHERAPEE_BATCH_SIZE = 50
+
+
+def rawtherapee_batch(
+        sources: List[str], file_path_out: str, profile: str,
+        logger: logging.Logger, log_cache: Set[str] = None
+) -> Dict[str, Union[str, None]]:
+    """
+    Converts many images to JPEG with a single rawtherapee-cli invocation
+    for every `RAWTHERAPEE_BATCH_SIZE` files
+
+    Parameters
+    ----------
+    sources : List[str]
+        Files to convert (.dng or .CR3)
+    file_path_out : str
+        File path where to put files converted
+    profile : str
+        Processing profile (.pp3) to apply
+    logger : Logger
+        Object Logger
+    log_cache : Set[str]
+        Current log
+
+    Returns
+    -------
+    Dict[str, Union[str, None]]
+        For every source, the JPEG converted or None if the conversion failed
+    """
+    os.makedirs(file_path_out, exist_ok=True)
+    outputs = dict()
+    for i in range(0, len(sources), RAWTHERAPEE_BATCH_SIZE):
+        batch = sources[i:i + RAWTHERAPEE_BATCH_SIZE]
+        start = time.time()
+        command = [
+            'rawtherapee-cli', '-o', file_path_out,
+            '-d', '-j100', '-js3', '-Y',
+            '-p', profile, '-c'
+        ] + batch
+        logger.info("Executing rawtherapee-cli on {} files with {}".format(len(batch), profile))
+        __subprocess__(command, logger, log_cache)
+        for source in batch:
+            expected_output = os.path.join(file_path_out, os.path.splitext(os.path.basename(source))[0] + ".jpg")
+            if os.path.exists(expected_output) and os.path.getmtime(expected_output) >= start - 1:
+                outputs[source] = expected_output
+            else:
+                logger.error("Error converting {} to .jpg".format(source))
+                outputs[source] = None
+    return outputs
+
+
 def dng_to_jpeg(
         file_path_in: str, file_path_out: str,
         herbarium: str, logger: logging.Logger,
@@ -335,19 +606,16 @@ def dng_to_jpeg(
     """
     logger.info("Transforming to JPEG...")
     os.makedirs(file_path_out, exist_ok=True)
+    sources = list()
     for filename in glob.glob(file_path_in + '/*.dng', recursive=True):
         if os.path.exists(filename.replace(".dng", ".jpg")):
             logger.warning("{} already converted, skipping".format(filename))
             continue
-        processing_profile_file = "assets/processing_profiles/herbarium_{}.pp3".format(herbarium)
-        command = [
-            'rawtherapee-cli', '-o', file_path_out,
-            '-d', '-j100', '-js3', '-Y',
-            '-p', processing_profile_file,
-            '-c', filename
-        ]
-        logger.info("Executing: {}".format(" ".join(command)))
-        __subprocess__(command, logger, log_cache)
+        sources.append(filename)
+    if len(sources) == 0:
+        return
+    processing_profile_file = "assets/processing_profiles/herbarium_{}.pp3".format(herbarium)
+    rawtherapee_batch(sources, file_path_out, processing_profile_file, logger, log_cache)
     return
 
 
@@ -364,35 +632,304 @@ def dng_to_jpeg_color_profile(
     with open(rawtherapee_profile, "w") as file:
         file.write(prev_content.format(color_profile))
     os.makedirs(file_path_out, exist_ok=True)
-    for filename in glob.glob(file_path_in + '/*.dng', recursive=True):
-        previous_file = False
-        expected_output = filename.replace(".dng", ".jpg")
+    sources = glob.glob(file_path_in + '/*.dng', recursive=True)
+    previous_files = set()
+    for filename in sources:
+        expected_output = os.path.join(file_path_out, os.path.basename(filename).replace(".dng", ".jpg"))
         if os.path.exists(expected_output):
-            previous_file = True
+            previous_files.add(expected_output)
             os.rename(expected_output, expected_output + "_(old)")
-        command = [
-            'rawtherapee-cli', '-o', file_path_out,
-            '-d', '-j100', '-js3', '-Y',
-            '-p', rawtherapee_profile, '-c', filename
-        ]
-        logger.info("Executing: {}".format(" ".join(command)))
-        __subprocess__(command, logger, log_cache)
-        if previous_file:
-            if os.path.exists(expected_output):
-                os.remove(expected_output + "_(old)")
-            else:
-                logging.warning("Error converting {} with color profile".format(expected_output))
-                os.rename(expected_output + "_(old)", expected_output)
+    outputs = rawtherapee_batch(sources, file_path_out, rawtherapee_profile, logger, log_cache)
+    for filename, output in outputs.items():
+        expected_output = os.path.join(file_path_out, os.path.basename(filename).replace(".dng", ".jpg"))
+        if expected_output not in previous_files:
+            continue
+        if output is not None:
+            os.remove(expected_output + "_(old)")
+        else:
+            logging.warning("Error converting {} with color profile".format(expected_output))
+            os.rename(expected_output + "_(old)", expected_output)
     with open(rawtherapee_profile, "w") as file:
         file.write(prev_content)
     return
 
 
-def read_qr(filename: str, logger: logging.Logger) -> Union[None, str]:
+QR_DETECTION_SIZE = 1000
+QR_ROI_MARGIN = 0.25
+QR_PRIOR_ATTEMPTS = 2
+QR_FILTERS = ["resize", "no_filter", "median"]
+
+
+def __top_right__(height: int, width: int) -> Tuple[int, int, int, int]:
+    return width // 2, 0, width, height // 2
+
+
+def __top_left__(height: int, width: int) -> Tuple[int, int, int, int]:
+    return 0, 0, width // 2, height // 2
+
+
+def __bottom_left__(height: int, width: int) -> Tuple[int, int, int, int]:
+    return 0, height // 2, width // 2, height
+
+
+def __bottom_right__(height: int, width: int) -> Tuple[int, int, int, int]:
+    return width // 2, height // 2, width, height
+
+
+QR_CORNERS = {
+    "top right": __top_right__,
+    "top left": __top_left__,
+    "bottom left": __bottom_left__,
+    "bottom right": __bottom_right__,
+}
+
+
+class LabelPositionPrior:
+    def __init__(self, herbarium_id: int, persist: bool = True) -> None:
+        """
+        Histogram of positions where the QR was found on the images of
+        a herbarium, loaded once from the database and updated on every QR found
+
+        Parameters
+        ----------
+        herbarium_id : int
+            Herbarium of the images
+        persist : bool
+            Whether the QR found are also recorded on the database
+        """
+        self.__herbarium_id__ = herbarium_id
+        self.__persist__ = persist
+        self.__lock__ = threading.Lock()
+        self.__cells__: Dict[Tuple[int, int], List[float]] = dict()
+        for position in LabelPosition.objects.filter(herbarium_id=herbarium_id):
+            self.__cells__[(position.row, position.column)] = [
+                position.count, position.center_x, position.center_y, position.width, position.height
+            ]
+        return
+
+    def regions(self, height: int, width: int, limit: int = QR_PRIOR_ATTEMPTS) -> List[Tuple[int, int, int, int]]:
+        """
+        Regions where the QR is most likely, sized as the QR observed on them plus a margin
+
+        Parameters
+        ----------
+        height : int
+            Height of the image
+        width : int
+            Width of the image
+        limit : int
+            Maximum number of regions
+
+        Returns
+        -------
+        List[Tuple[int, int, int, int]]
+            Bounding boxes (x_0, y_0, x_1, y_1) sorted from most to least likely
+        """
+        with self.__lock__:
+            cells = sorted(self.__cells__.values(), key=lambda cell: -cell[0])[:limit]
+        regions = list()
+        for count, center_x, center_y, qr_width, qr_height in cells:
+            half_width = qr_width * width * (1 + 2 * QR_ROI_MARGIN) / 2
+            half_height = qr_height * height * (1 + 2 * QR_ROI_MARGIN) / 2
+            regions.append((
+                max(int(center_x * width - half_width), 0), max(int(center_y * height - half_height), 0),
+                min(int(center_x * width + half_width), width), min(int(center_y * height + half_height), height)
+            ))
+        return regions
+
+    def corners(self) -> List[str]:
+        """
+        Corners sorted by number of QR found on them, ties keep
+        the default order (top right, top left, bottom left, bottom right)
+
+        Returns
+        -------
+        List[str]
+            Corners names
+        """
+        counts = dict()
+        with self.__lock__:
+            cells = list(self.__cells__.values())
+        for count, center_x, center_y, _, _ in cells:
+            corner = "{} {}".format("top" if center_y < 0.5 else "bottom", "left" if center_x < 0.5 else "right")
+            counts[corner] = counts.get(corner, 0) + count
+        return sorted(QR_CORNERS.keys(), key=lambda corner: -counts.get(corner, 0))
+
+    def record(self, box: Tuple[int, int, int, int], height: int, width: int) -> None:
+        """
+        Adds a QR found on an image to the histogram
+
+        Parameters
+        ----------
+        box : Tuple[int, int, int, int]
+            Bounding box (x_0, y_0, x_1, y_1) of the QR
+        height : int
+            Height of the image
+        width : int
+            Width of the image
+
+        Returns
+        -------
+        None
+        """
+        x_0, y_0, x_1, y_1 = box
+        center_x = (x_0 + x_1) / 2 / width
+        center_y = (y_0 + y_1) / 2 / height
+        qr_width = (x_1 - x_0) / width
+        qr_height = (y_1 - y_0) / height
+        cell = (min(int(center_y * LABEL_GRID), LABEL_GRID - 1), min(int(center_x * LABEL_GRID), LABEL_GRID - 1))
+        with self.__lock__:
+            count, *means = self.__cells__.get(cell, [0, 0.0, 0.0, 0.0, 0.0])
+            self.__cells__[cell] = [count + 1] + [
+                (mean * count + value) / (count + 1)
+                for mean, value in zip(means, [center_x, center_y, qr_width, qr_height])
+            ]
+            if self.__persist__:
+                LabelPosition.record(self.__herbarium_id__, center_x, center_y, qr_width, qr_height)
+        return
+
+
+def __corner_at__(box: Tuple[int, int, int, int], height: int, width: int) -> str:
+    x_0, y_0, x_1, y_1 = box
+    vertical = "top" if (y_0 + y_1) / 2 < height / 2 else "bottom"
+    horizontal = "left" if (x_0 + x_1) / 2 < width / 2 else "right"
+    return f"{vertical} {horizontal}"
+
+
+def __locate_qr__(image: np.ndarray) -> Union[None, Tuple[int, int, int, int]]:
+    """
+    Locates a QR on a downscaled copy of the image
+
+    Parameters
+    ----------
+    image : ND-Array
+        Array of N=2 dimension coding an image
+
+    Returns
+    -------
+    Tuple[int, int, int, int]
+        In case of found, bounding box (x_0, y_0, x_1, y_1) of the QR with a margin,
+        in coordinates of the original image. Otherwise None.
+    """
+    height, width = image.shape
+    scale = min(1.0, QR_DETECTION_SIZE / max(height, width))
+    if scale < 1.0:
+        small_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        small_image = image
+    found, points = cv2.QRCodeDetector().detect(small_image)
+    if not found or points is None:
+        return None
+    points = points.reshape(-1, 2) / scale
+    x_0, y_0 = points.min(axis=0)
+    x_1, y_1 = points.max(axis=0)
+    margin = int(max(x_1 - x_0, y_1 - y_0) * QR_ROI_MARGIN)
+    return (
+        max(int(x_0) - margin, 0), max(int(y_0) - margin, 0),
+        min(int(x_1) + margin, width), min(int(y_1) + margin, height)
+    )
+
+
+def __read_qr_in__(
+        p: re.Pattern, image: np.ndarray, box: Tuple[int, int, int, int],
+        found_message: str, logger: logging.Logger, filter: str
+) -> Tuple[Union[str, None], Union[Tuple[int, int, int, int], None]]:
+    x_0, y_0, x_1, y_1 = box
+    qr_code, qr_box = __decode_qr_at__(p, image[y_0:y_1, x_0:x_1], found_message, logger, filter)
+    if qr_code is None:
+        return None, None
+    return qr_code, (qr_box[0] + x_0, qr_box[1] + y_0, qr_box[2] + x_0, qr_box[3] + y_0)
+
+
+def __qr_candidates__(
+        image: np.ndarray, positions: Union[LabelPositionPrior, None], logger: logging.Logger
+) -> Iterator[Tuple[Tuple[int, int, int, int], str]]:
+    """
+    Regions where to search the QR, in order, computed only when
+    the previous ones failed
+
+    Parameters
+    ----------
+    image : ND-Array
+        Array of N=2 dimension coding an image
+    positions : LabelPositionPrior
+        Histogram of QR positions of the herbarium
+    logger : Logger
+        Object Logger
+
+    Returns
+    -------
+    Iterator[Tuple[Tuple[int, int, int, int], str]]
+        Bounding box (x_0, y_0, x_1, y_1) of the region and filter to apply
+    """
+    height, width = image.shape
+    if positions is not None:
+        for region in positions.regions(height, width):
+            yield region, "no_filter"
+    box = __locate_qr__(image)
+    if box is not None:
+        yield box, "no_filter"
+    else:
+        logger.debug("QR not located with detector")
+    corners = positions.corners() if positions is not None else list(QR_CORNERS.keys())
+    for qr_filter in QR_FILTERS:
+        for corner in corners:
+            yield QR_CORNERS[corner](height, width), qr_filter
+
+
+def read_qr(
+        filename: str, logger: logging.Logger, positions: LabelPositionPrior = None
+) -> Union[None, str]:
+    """
+    Given the name of the file that contains an image, the QR is searched first
+    on the regions where it was usually found on the herbarium, at the size it was
+    observed. Otherwise, the QR is located once on a downscaled copy of the image
+    and decoded only on that region at full resolution. If it cannot be located,
+    the 4 zones of the image are searched starting by the corner where the QR is
+    usually found on the herbarium.
+
+    Parameters
+    ----------
+    filename : str
+        File path to image to process
+    logger : Logger
+        Object Logger
+    positions : LabelPositionPrior, optional
+        Histogram of QR positions of the herbarium, updated when the QR is found
+
+    Returns
+    -------
+    str
+        In case of found, the code on QR at the image. Otherwise None.
+    """
+    logging.info("Reading QR of {}...".format(filename))
+    p = re.compile('(?<!\\\\)\'')
+    image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        logging.error("Image {} cannot be read".format(filename))
+        return None
+    height, width = image.shape
+    try:
+        for region, qr_filter in __qr_candidates__(image, positions, logger):
+            corner = __corner_at__(region, height, width)
+            qr_code, qr_box = __read_qr_in__(p, image, region, f"{corner} corner", logger, qr_filter)
+            if qr_code:
+                if positions is not None:
+                    positions.record(qr_box, height, width)
+                return qr_code
+        logging.error("QR code on {} not detected".format(filename))
+        return None
+    except Exception as e:
+        logging.error("QR code reading error:\n{}".format(e))
+        return None
+
+
+def read_qr_legacy(filename: str, logger: logging.Logger) -> Union[None, str]:
     """
     Given the name of the file that contains an image, the image is read and 
     then divided into 4 zones. A QR is searched in each of them sequentially 
-    using different image preprocessing methods.
+    using different image preprocessing methods. Previous implementation
+    of `read_qr`, kept to benchmark against it.
 
     Parameters
     ----------
@@ -466,6 +1003,24 @@ def __read_qr_at__(
         In case of found, the code on the QR. otherwise None.
     """
     
+    return __decode_qr_at__(p, cropped_image, found_message, logger, filter)[0]
+
+
+def __decode_qr_at__(
+        p: re.Pattern, cropped_image: np.ndarray,
+        found_message: str, logger: logging.Logger,
+        filter: str
+) -> Tuple[Union[str, None], Union[Tuple[int, int, int, int], None]]:
+    """
+    Same as `__read_qr_at__`, but it also returns where the QR was found
+
+    Returns
+    -------
+    Tuple[str, Tuple[int, int, int, int]]
+        In case of found, the code on the QR and its bounding box (x_0, y_0, x_1, y_1)
+        on the cropped image at full resolution. Otherwise None, None.
+    """
+    scale = 0.5 if filter == 'resize' else 1.0
     image_to_process = None 
     
     if filter == 'no_filter':
@@ -490,9 +1045,14 @@ def __read_qr_at__(
         decoded_text = code[0].data.decode('utf8')
         logger.debug("Decoded Text '{}'".format(decoded_text))
         logger.info("QR found in {}".format(found_message))
-        return p.sub('\"', decoded_text)
+        rect = code[0].rect
+        box = (
+            int(rect.left / scale), int(rect.top / scale),
+            int((rect.left + rect.width) / scale), int((rect.top + rect.height) / scale)
+        )
+        return p.sub('\"', decoded_text), box
     else:
-        return None
+        return None, None
 
 
 def read_qr_at_top_right(
@@ -612,6 +1172,67 @@ def read_qr_at_bottom_right(
 
 
 
+@lru_cache(maxsize=None)
+def label_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Font used on labels, loaded once per worker
+
+    Parameters
+    ----------
+    path : str
+        Path of the TrueType font
+    size : int
+        Size of the font
+
+    Returns
+    -------
+    FreeTypeFont
+        Font loaded
+    """
+    return ImageFont.truetype(path, size)
+
+
+def render_label(
+        rectangle: Tuple[Tuple[int, int], Tuple[int, int]], texts: List[Tuple[Tuple[int, int], str, Dict[str, Any]]]
+) -> Tuple[Image, Tuple[int, int]]:
+    """
+    Renders a label on a transparent tile as big as the label and its
+    texts, to be pasted on the voucher image
+
+    Parameters
+    ----------
+    rectangle : Tuple[Tuple[int, int], Tuple[int, int]]
+        Corners of the label on the voucher image
+    texts : List[Tuple[Tuple[int, int], str, Dict[str, Any]]]
+        Position on the voucher image, text and arguments of `ImageDraw.text` of every text
+
+    Returns
+    -------
+    Tuple[Image, Tuple[int, int]]
+        Tile (RGBA) and position of its upper left corner on the voucher image
+    """
+    (left, top), (right, bottom) = rectangle
+    measure = ImageDraw.Draw(PIL.Image.new("RGBA", (1, 1)))
+    for position, text, arguments in texts:
+        box = measure.textbbox(
+            position, text, font=arguments.get("font"), anchor=arguments.get("anchor"),
+            stroke_width=arguments.get("stroke_width", 0)
+        )
+        left, top = min(left, box[0]), min(top, box[1])
+        right, bottom = max(right, box[2]), max(bottom, box[3])
+    left, top = int(math.floor(left)), int(math.floor(top))
+    right, bottom = int(math.ceil(right)) + 1, int(math.ceil(bottom)) + 1
+    tile = PIL.Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    tile_editable = ImageDraw.Draw(tile)
+    (x0, y0), (x1, y1) = rectangle
+    tile_editable.rectangle(
+        ((x0 - left, y0 - top), (x1 - left, y1 - top)), fill='#d7d6e0', outline="black", width=4
+    )
+    for (x, y), text, arguments in texts:
+        tile_editable.text((x - left, y - top), text, (0, 0, 0), **arguments)
+    return tile, (left, top)
+
+
 def change_image_resolution(image: Image, scale_percent) -> BytesIO:
     width = int(image.size[0] * scale_percent / 100)
     height = int(image.size[1] * scale_percent / 100)
@@ -622,6 +1243,72 @@ def change_image_resolution(image: Image, scale_percent) -> BytesIO:
     return resized_image_content
 
 
+def derivative_scales(collection_code: str = None) -> Dict[int, float]:
+    """
+    Scales of the derivatives of a voucher image for a herbarium
+
+    Parameters
+    ----------
+    collection_code : str, optional
+        Collection code of the herbarium
+
+    Returns
+    -------
+    Dict[int, float]
+        Percent of the original size of every variant (`image_resized_<variant>`)
+    """
+    scales = settings.IMAGE_DERIVATIVE_SCALES
+    return scales.get(collection_code, scales["default"])
+
+
+def __encode_jpeg__(image: Image) -> BytesIO:
+    content = BytesIO()
+    image.save(content, format='JPEG')
+    content.seek(0)
+    return content
+
+
+def image_derivatives(
+        image: Union[str, BinaryIO, Image], scales: Dict[int, float], workers: int = None
+) -> Dict[int, BytesIO]:
+    """
+    Generates the scaled copies of an image decoding it once. If the image is a
+    JPEG file, it is decoded at the smallest size the biggest copy allows (draft mode).
+    Every copy is resized from the previous, bigger, one and all of them
+    are encoded in parallel.
+
+    Parameters
+    ----------
+    image : Union[str, BinaryIO, Image]
+        Path or file of the image, or image already decoded
+    scales : Dict[int, float]
+        Percent of the original size of every variant
+    workers : int, optional
+        Threads encoding the copies, defaults to one per copy
+
+    Returns
+    -------
+    Dict[int, BytesIO]
+        JPEG content of every variant, with the same size `change_image_resolution` gives
+    """
+    if not isinstance(image, Image):
+        image = PIL.Image.open(image)
+        width, height = image.size
+        biggest = max(scales.values())
+        image.draft(image.mode, (int(width * biggest / 100), int(height * biggest / 100)))
+    else:
+        width, height = image.size
+    levels = dict()
+    level = image
+    for variant, scale_percent in sorted(scales.items(), key=lambda item: -item[1]):
+        size = (int(width * scale_percent / 100), int(height * scale_percent / 100))
+        level = level.resize(size, reducing_gap=3.0)
+        levels[variant] = level
+    with ThreadPoolExecutor(max_workers=workers or len(levels)) as executor:
+        contents = dict(zip(levels.keys(), executor.map(__encode_jpeg__, levels.values())))
+    return contents
+
+
 def empty_folder(folder_path: str) -> None:
     for content in os.listdir(folder_path):
         content_path = os.path.join(folder_path, content)
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:05
+
+import apps.digitalization.storage_backends
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0004_darwincorearchivefile'),
+        ('metadata', '0004_licence_alter_emldataset_licensed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DarwinCoreArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_file', models.CharField(max_length=100, verbose_name='Data File')),
+                ('key', models.CharField(max_length=100, verbose_name='Key')),
+                ('fingerprint', models.CharField(max_length=64, verbose_name='Fingerprint')),
+                ('rows', models.IntegerField(default=0, verbose_name='Rows')),
+                ('file', models.FileField(storage=apps.digitalization.storage_backends.PrivateMediaStorage(), upload_to='darwin_core_archive/segments', verbose_name='File')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated at')),
+                ('metadata', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='metadata.eml', verbose_name='Metadata File')),
+            ],
+            options={
+                'verbose_name': 'Darwin Core Archive Segment',
+                'verbose_name_plural': 'Darwin Core Archive Segments',
+                'constraints': [models.UniqueConstraint(fields=('metadata', 'data_file', 'key'), name='unique_archive_segment')],
+            },
+        ),
+    ]
@@ -43,3 +43,23 @@ class DarwinCoreArchiveFile(models.Model):
     metadata = models.ForeignKey(EML, primary_key=True, on_delete=models.PROTECT, verbose_name=_("Metadata File"))
     file = models.FileField(verbose_name=_("File"), upload_to="darwin_core_archive", storage=PrivateMediaStorage())
     created_at = models.DateTimeField(verbose_name=_("Created at"), auto_now_add=True)
+
+
+class DarwinCoreArchiveSegment(models.Model):
+    metadata = models.ForeignKey(EML, on_delete=models.CASCADE, verbose_name=_("Metadata File"))
+    data_file = models.CharField(verbose_name=_("Data File"), max_length=100)
+    key = models.CharField(verbose_name=_("Key"), max_length=100)
+    fingerprint = models.CharField(verbose_name=_("Fingerprint"), max_length=64)
+    rows = models.IntegerField(verbose_name=_("Rows"), default=0)
+    file = models.FileField(verbose_name=_("File"), upload_to="darwin_core_archive/segments", storage=PrivateMediaStorage())
+    updated_at = models.DateTimeField(verbose_name=_("Updated at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Darwin Core Archive Segment')
+        verbose_name_plural = _('Darwin Core Archive Segments')
+        constraints = [
+            models.UniqueConstraint(fields=["metadata", "data_file", "key"], name="unique_archive_segment"),
+        ]
+
+    def __str__(self):
+        return f"{self.metadata_id}/{self.data_file}/{self.key}"
@@ -1,24 +1,32 @@
 import logging
 import os
 import shutil
+import zipfile
+from functools import partial
+from typing import List, Tuple
 
+import boto3
 import pandas as pd
 from celery import shared_task
 from celery.exceptions import Ignore
-from celery.result import AsyncResult
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db.models import Count, Max, Sum
 from dwca import DarwinCoreArchive
-from dwca.classes import Taxon, Occurrence, Distribution, DataFileType
+from dwca.classes import Taxon, Occurrence, Distribution, DataFile, DataFileType
 import dwca.terms as dwc
 from xml_common.utils import Language as EMLLanguage
 
 from apps.catalog.models import Kingdom, Division, ClassName, Order, Family, Genus, Species, Synonymy, \
-    CATALOG_DWC_FIELDS, VernacularName, CommonName, Region, Reference
-from apps.digitalization.models import HERBARIUM_DWC_FIELDS, VoucherImported
+    CATALOG_DWC_FIELDS, VernacularName, CommonName, Region, Reference, References, Binnacle
+from apps.digitalization.models import HERBARIUM_DWC_FIELDS, VoucherImported, Herbarium
 from apps.digitalization.storage_backends import PrivateMediaStorage
-from apps.home.models import DarwinCoreArchiveFile
+from apps.digitalization.utils import storage_key
+from apps.home.models import DarwinCoreArchiveFile, DarwinCoreArchiveSegment
+from apps.home.utils import S3MultipartWriter, Segment, fingerprint, range_fingerprints, range_segments, \
+    write_archive_metadata, write_segments
 from apps.metadata.models import EML
-from intranet.utils import HtmlLogger, close_process, TaskProcessLogger, GroupLogger
+from intranet.utils import HtmlLogger, close_process, TaskProcessLogger, GroupLogger, ProgressReporter
 
 TAXA_MODELS = [
     Kingdom, Division, ClassName,
@@ -27,6 +35,226 @@ TAXA_MODELS = [
 ]
 
 
+HIGHER_RANKS = [
+    Kingdom, Division, ClassName,
+    Order, Family, Genus,
+]
+
+
+def __taxonomy_states__() -> List[Tuple]:
+    """
+    State of each rank above species, with the last entry of the binnacle
+    on that rank or above, as renames propagate to every lower row
+    """
+    states = list()
+    for i, model in enumerate(HIGHER_RANKS):
+        binnacle_models = [
+            Binnacle.TAXONOMIC_MODEL_NAME[rank.__name__] for rank in HIGHER_RANKS[:i + 1]
+            if rank.__name__ in Binnacle.TAXONOMIC_MODEL_NAME
+        ]
+        states.append((
+            model.objects.aggregate(total=Count("pk"), updated=Max("updated_at")),
+            Binnacle.objects.filter(model__in=binnacle_models).aggregate(last=Max("pk"))["last"],
+        ))
+    return states
+
+
+def __catalog_segments__(
+        darwin_core_archive: DarwinCoreArchive, eml: EML, logger: logging.Logger
+) -> List[Tuple[DataFile, List[Segment]]]:
+    chunk_size = settings.DWC_EXPORT_CHUNK_SIZE
+    size = settings.DWC_SEGMENT_SIZE
+    core = Taxon(
+        0, "taxon.tsv", CATALOG_DWC_FIELDS,
+        fields_terminated_by="\t", ignore_header_lines=1
+    )
+    darwin_core_archive.core = core
+    vernacular_extension = VernacularName(
+        0, "vernacular.tsv", [dwc.DWCLanguage(1, two_letter_coding=True), dwc.VernacularName(2)]
+    )
+    distribution_extension = Distribution(
+        0, "distribution.tsv", [dwc.OccurrenceStatus(1), dwc.DWCLocalityTerm(2), dwc.Country(3), dwc.CountryCode(4)],
+        data_file_type=DataFileType.EXTENSION, fields_terminated_by="\t"
+    )
+    reference_extension = Reference(0, "reference.tsv", [dwc.DWCBibliographicCitation(1)])
+    darwin_core_archive.extensions.append(vernacular_extension)
+    darwin_core_archive.extensions.append(distribution_extension)
+    darwin_core_archive.extensions.append(reference_extension)
+    logger.info("Computing fingerprints of the catalog")
+    context = fingerprint(eml.package_id, eml.dataset.title)
+    states = __taxonomy_states__()
+    core_segments = [
+        Segment(model._meta.model_name, fingerprint(context, states[:i + 1]), partial(model.iter_dwc_data, logger=logger))
+        for i, model in enumerate(HIGHER_RANKS)
+    ]
+    taxonomy = fingerprint(context, states)
+    species_ranges = range_fingerprints(
+        Species.objects.all(), "pk", size, total=Count("pk"), updated=Max("updated_at")
+    )
+    core_segments += range_segments(
+        "species", size, taxonomy,
+        lambda pk_range: Species.iter_dwc_data(logger=logger, pk_range=pk_range),
+        species_ranges
+    )
+    core_segments += range_segments(
+        "synonymy", size, taxonomy,
+        lambda pk_range: Synonymy.iter_dwc_data(logger=logger, pk_range=pk_range),
+        range_fingerprints(
+            Synonymy.objects.all(), "pk", size,
+            total=Count("pk"), updated=Max("updated_at"), species=Max("species__updated_at")
+        )
+    )
+    common_names = Species.common_names.through.objects.all()
+    vernacular_segments = range_segments(
+        "species", size,
+        fingerprint(CommonName.objects.aggregate(total=Count("pk"), updated=Max("updated_at"))),
+        lambda pk_range: (
+            [taxon_id, EMLLanguage.SPA, name]
+            for taxon_id, name in common_names.filter(
+                species_id__gte=pk_range[0], species_id__lt=pk_range[1]
+            ).values_list("species__taxon_id", "commonname__name").iterator(chunk_size=chunk_size)
+        ),
+        range_fingerprints(common_names, "species_id", size, total=Count("pk"), ids=Sum("pk")),
+        species_ranges
+    )
+    regions = Species.region.through.objects.all()
+    distribution_segments = range_segments(
+        "species", size,
+        fingerprint(Region.objects.aggregate(total=Count("pk"), updated=Max("updated_at"))),
+        lambda pk_range: (
+            [taxon_id, dwc.OccurrenceStatus.DefaultStatus.PRESENT, region, "Chile", "CL"]
+            for taxon_id, region in regions.filter(
+                species_id__gte=pk_range[0], species_id__lt=pk_range[1]
+            ).values_list("species__taxon_id", "region__name_es").iterator(chunk_size=chunk_size)
+        ),
+        range_fingerprints(regions, "species_id", size, total=Count("pk"), ids=Sum("pk")),
+        species_ranges
+    )
+    citations = {
+        reference.pk: reference.cite() for reference in References.objects.prefetch_related("author")
+    }
+    reference_segments = list()
+    for model in TAXA_MODELS:
+        model_name = model._meta.model_name
+        taxa_references = model.references.through.objects.all()
+        reference_segments += range_segments(
+            model_name, size, fingerprint(sorted(citations.items())),
+            partial(
+                lambda pk_range, references, name: (
+                    [taxon_id, citations[reference_id]]
+                    for taxon_id, reference_id in references.filter(**{
+                        f"{name}_id__gte": pk_range[0], f"{name}_id__lt": pk_range[1]
+                    }).values_list(f"{name}__taxon_id", "references_id").iterator(chunk_size=chunk_size)
+                ),
+                references=taxa_references, name=model_name
+            ),
+            range_fingerprints(taxa_references, f"{model_name}_id", size, total=Count("pk"), ids=Sum("pk")),
+            range_fingerprints(model.objects.all(), "pk", size, updated=Max("updated_at"))
+        )
+    return [
+        (core, core_segments),
+        (vernacular_extension, vernacular_segments),
+        (distribution_extension, distribution_segments),
+        (reference_extension, reference_segments),
+    ]
+
+
+def __occurrence_segments__(
+        darwin_core_archive: DarwinCoreArchive, option: int, logger: logging.Logger
+) -> List[Tuple[DataFile, List[Segment]]]:
+    size = settings.DWC_SEGMENT_SIZE
+    core = Occurrence(
+        0, "occurrence.tsv", HERBARIUM_DWC_FIELDS,
+        fields_terminated_by="\t", ignore_header_lines=1
+    )
+    darwin_core_archive.core = core
+    logger.info("Computing fingerprints of the vouchers")
+    herbaria = [
+        (herbarium.pk, herbarium.name, herbarium.institution_code, herbarium.collection_code,
+         herbarium.metadata.dataset.licensed.first().link)
+        for herbarium in Herbarium.objects.filter(metadata_id=option).select_related("metadata__dataset")
+    ]
+    herbarium_vouchers = VoucherImported.objects.filter(herbarium__metadata_id=option)
+    return [(core, range_segments(
+        "vouchers", size,
+        fingerprint(settings.HERBARIUM_FRONTEND, herbaria, __taxonomy_states__()),
+        lambda pk_range: herbarium_vouchers.filter(
+            pk__gte=pk_range[0], pk__lt=pk_range[1]
+        ).iter_dwc_data(logger=logger),
+        range_fingerprints(
+            herbarium_vouchers, "pk", size,
+            total=Count("pk", distinct=True), updated=Max("updated_at"),
+            species=Max("scientific_name__updated_at"),
+            types=Count("typestatus", distinct=True), type_sum=Sum("typestatus__type")
+        )
+    ))]
+
+
+def stream_archive(
+        darwin_core_archive: DarwinCoreArchive, eml: EML, option: int, zip_filename: str,
+        logger: logging.Logger, progress: ProgressReporter
+) -> str:
+    """
+    Writes the archive into a zip streamed to the private storage through a
+    multipart upload. Data files are spliced from cached segments, only the
+    segments whose rows changed since the last run are rebuilt
+
+    Parameters
+    ----------
+    darwin_core_archive : DarwinCoreArchive
+        Archive with its metadata set
+    eml : EML
+        Metadata of the archive
+    option : int
+        Metadata of the archive, 1 for the catalog and herbaria otherwise
+    zip_filename : str
+        Name of the archive on the storage
+    logger : Logger
+        Object to manage logs
+    progress : ProgressReporter
+        Progress of the task
+
+    Returns
+    -------
+    str
+        Name of the stored archive
+    """
+    if option == 1:
+        data_files = __catalog_segments__(darwin_core_archive, eml, logger)
+    else:
+        data_files = __occurrence_segments__(darwin_core_archive, option, logger)
+    cache = dict()
+    for segment in DarwinCoreArchiveSegment.objects.filter(metadata=eml):
+        cache.setdefault(segment.data_file, dict())[segment.key] = segment
+    storage = PrivateMediaStorage()
+    zip_filename = storage.get_available_name(zip_filename)
+    writer = S3MultipartWriter(
+        boto3.client('s3'), storage.bucket_name, storage_key(storage, zip_filename),
+        ContentType="application/zip", **storage.object_parameters
+    )
+    try:
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zip_file:
+            write_archive_metadata(zip_file, darwin_core_archive)
+            for data_file, segments in data_files:
+                logger.info(f"Writing {data_file.filename}")
+                rebuilt = write_segments(
+                    zip_file, data_file, segments, cache.get(data_file.filename, dict()), eml, progress=progress
+                )
+                logger.info(f"{data_file.filename}: {rebuilt} of {len(segments)} segments rebuilt")
+        logger.info("Completing upload")
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        raise e
+    for data_file, segments in data_files:
+        for segment in segments:
+            cache.get(data_file.filename, dict()).pop(segment.key, None)
+    for stale in cache.values():
+        for segment in stale.values():
+            segment.file.delete(save=False)
+            segment.delete()
+    return zip_filename
+
 
 @shared_task(name='generate_dwc_archive', bind=True)
 def generate_dwc_archive(self, option: int):
@@ -37,105 +265,113 @@ def generate_dwc_archive(self, option: int):
         os.makedirs(temp_folder, exist_ok=True)
         process_logger = TaskProcessLogger("DWC Archive", temp_folder)
         logger = GroupLogger("DWC Archive", html_logger, process_logger)
+        progress = ProgressReporter(self, html_logger)
         try:
             eml = EML.objects.get(pk=option)
             logger.info(f"Generating EML file for {eml}")
-            self.update_state(state="PROGRESS", meta={"step": 0, "total": 1, "logs": logger[0].get_logs()})
+            progress.flush()
             darwin_core_archive = DarwinCoreArchive(eml.package_id)
             darwin_core_archive.__meta__.__metadata__ = "eml.xml"
             darwin_core_archive.__metadata__ = eml.eml_object
-            if option == 1:
-                logger.info(f"Generating Core Data File")
-                self.update_state(state="PROGRESS", meta={"step": 0, "total": 1, "logs": logger[0].get_logs()})
-                core = Taxon(
-                    0, "taxon.tsv", CATALOG_DWC_FIELDS,
-                    fields_terminated_by="\t", ignore_header_lines=1
+            if settings.DWC_STREAMING_ARCHIVE:
+                zip_filename = stream_archive(
+                    darwin_core_archive, eml, option,
+                    "catalog.zip" if option == 1 else f"{eml.package_id}.zip",
+                    logger, progress
                 )
-                taxa_data = list()
-                for model in TAXA_MODELS:
-                    taxa_data.append(
-                        model.get_dwc_data(logger=logger, task=self)
+            else:
+                if option == 1:
+                    logger.info(f"Generating Core Data File")
+                    progress.flush()
+                    core = Taxon(
+                        0, "taxon.tsv", CATALOG_DWC_FIELDS,
+                        fields_terminated_by="\t", ignore_header_lines=1
                     )
-                results = pd.concat(taxa_data)
-                logger.info("Adding core to archive")
-                darwin_core_archive.core = core
-                darwin_core_archive.core.pandas = results
-                async_result = AsyncResult(self.request.id)
-                current_total = async_result.info['total']
-                # Extensions
-                logger.info(f"Retrieving vernacular names")
-                vernacular_extension = VernacularName(
-                    0, "vernacular.tsv", [dwc.DWCLanguage(1, two_letter_coding=True), dwc.VernacularName(2)]
-                )
-                common_names_result = list()
-                common_objects = CommonName.objects.all()
-                for i, common_name in enumerate(common_objects):
-                    self.update_state(state="PROGRESS", meta={"step": i + current_total, "total": current_total + common_objects.count(), "logs": logger[0].get_logs()})
-                    for spp in common_name.species_set.all():
-                        common_names_result.append([
-                            spp.taxon_id, EMLLanguage.SPA, common_name.name_es
-                        ])
-                darwin_core_archive.extensions.append(vernacular_extension)
-                darwin_core_archive.extensions[0].as_pandas(_no_interaction=True)
-                darwin_core_archive.extensions[0].pandas = pd.DataFrame(common_names_result, columns=[fields.name for fields in vernacular_extension.__fields__])
-                distribution_extension = Distribution(
-                    0, "distribution.tsv", [dwc.OccurrenceStatus(1), dwc.DWCLocalityTerm(2), dwc.Country(3), dwc.CountryCode(4)],
-                    data_file_type=DataFileType.EXTENSION, fields_terminated_by="\t"
-                )
-                distribution_results = list()
-                regions = Region.objects.all()
-                logger.info(f"Retrieving regions")
-                for i, region in enumerate(regions):
-                    self.update_state(state="PROGRESS", meta={"step": i + current_total, "total": current_total + regions.count(), "logs": logger[0].get_logs()})
-                    for spp in region.species_set.all():
-                        distribution_results.append([
-                            spp.taxon_id, dwc.OccurrenceStatus.DefaultStatus.PRESENT, region.name_es, "Chile", "CL"
-                        ])
-                current_total += regions.count()
-                darwin_core_archive.extensions.append(distribution_extension)
-                darwin_core_archive.extensions[1].as_pandas(_no_interaction=True)
-                darwin_core_archive.extensions[1].pandas = pd.DataFrame(distribution_results, columns=[fields.name for fields in distribution_extension.__fields__])
-                reference_result = list()
-                logger.info("Retrieving reference")
-                for model in TAXA_MODELS:
-                    total_taxa = model.objects.all()
-                    for i, taxa in enumerate(total_taxa):
-                        self.update_state(state="PROGRESS", meta={"step": i + current_total, "total": current_total + total_taxa.count(), "logs": logger[0].get_logs()})
-                        for ref in taxa.references.all():
-                            reference_result.append([
-                                taxa.taxon_id, ref.cite()
+                    taxa_data = list()
+                    for model in TAXA_MODELS:
+                        taxa_data.append(
+                            model.get_dwc_data(logger=logger, progress=progress)
+                        )
+                    results = pd.concat(taxa_data)
+                    logger.info("Adding core to archive")
+                    darwin_core_archive.core = core
+                    darwin_core_archive.core.pandas = results
+                    # Extensions
+                    logger.info(f"Retrieving vernacular names")
+                    vernacular_extension = VernacularName(
+                        0, "vernacular.tsv", [dwc.DWCLanguage(1, two_letter_coding=True), dwc.VernacularName(2)]
+                    )
+                    common_names_result = list()
+                    common_objects = CommonName.objects.all()
+                    current_total = progress.extend(common_objects.count())
+                    for i, common_name in enumerate(common_objects):
+                        progress.update(i + current_total)
+                        for spp in common_name.species_set.all():
+                            common_names_result.append([
+                                spp.taxon_id, EMLLanguage.SPA, common_name.name
                             ])
-                    current_total += total_taxa.count()
-                reference_extension = Reference(0, "reference.tsv", [dwc.DWCBibliographicCitation(1)])
-                darwin_core_archive.extensions.append(reference_extension)
-                darwin_core_archive.extensions[2].as_pandas(_no_interaction=True)
-                darwin_core_archive.extensions[2].pandas = pd.DataFrame(reference_result, columns=[fields.name for fields in reference_extension.__fields__])
-                # TODO: Species profile
-                logger.info("Zipping archive")
-                zip_filename = "catalog.zip"
-                darwin_core_archive.to_file(zip_filename)
-            else:
-                logger.info(f"Generating Core Data File")
-                self.update_state(state="PROGRESS", meta={"step": 0, "total": 1, "logs": logger[0].get_logs()})
-                core = Occurrence(
-                    0, "occurrence.tsv", HERBARIUM_DWC_FIELDS,
-                    fields_terminated_by="\t", ignore_header_lines=1
-                )
-                herbarium_vouchers = VoucherImported.objects.filter(herbarium__metadata_id=option)
-                results = herbarium_vouchers.get_dwc_data(logger=logger, task=self)
-                logger.info("Adding core to archive")
-                darwin_core_archive.core = core
-                darwin_core_archive.core.pandas = results
-                logger.info("Zipping archive")
-                zip_filename = f"{eml.package_id}.zip"
-                darwin_core_archive.to_file(zip_filename)
+                    darwin_core_archive.extensions.append(vernacular_extension)
+                    darwin_core_archive.extensions[0].as_pandas(_no_interaction=True)
+                    darwin_core_archive.extensions[0].pandas = pd.DataFrame(common_names_result, columns=[fields.name for fields in vernacular_extension.__fields__])
+                    distribution_extension = Distribution(
+                        0, "distribution.tsv", [dwc.OccurrenceStatus(1), dwc.DWCLocalityTerm(2), dwc.Country(3), dwc.CountryCode(4)],
+                        data_file_type=DataFileType.EXTENSION, fields_terminated_by="\t"
+                    )
+                    distribution_results = list()
+                    regions = Region.objects.all()
+                    logger.info(f"Retrieving regions")
+                    current_total = progress.extend(regions.count())
+                    for i, region in enumerate(regions):
+                        progress.update(i + current_total)
+                        for spp in region.species_set.all():
+                            distribution_results.append([
+                                spp.taxon_id, dwc.OccurrenceStatus.DefaultStatus.PRESENT, region.name_es, "Chile", "CL"
+                            ])
+                    darwin_core_archive.extensions.append(distribution_extension)
+                    darwin_core_archive.extensions[1].as_pandas(_no_interaction=True)
+                    darwin_core_archive.extensions[1].pandas = pd.DataFrame(distribution_results, columns=[fields.name for fields in distribution_extension.__fields__])
+                    reference_result = list()
+                    logger.info("Retrieving reference")
+                    for model in TAXA_MODELS:
+                        total_taxa = model.objects.all()
+                        current_total = progress.extend(total_taxa.count())
+                        for i, taxa in enumerate(total_taxa):
+                            progress.update(i + current_total)
+                            for ref in taxa.references.all():
+                                reference_result.append([
+                                    taxa.taxon_id, ref.cite()
+                                ])
+                    reference_extension = Reference(0, "reference.tsv", [dwc.DWCBibliographicCitation(1)])
+                    darwin_core_archive.extensions.append(reference_extension)
+                    darwin_core_archive.extensions[2].as_pandas(_no_interaction=True)
+                    darwin_core_archive.extensions[2].pandas = pd.DataFrame(reference_result, columns=[fields.name for fields in reference_extension.__fields__])
+                    # TODO: Species profile
+                    logger.info("Zipping archive")
+                    zip_filename = "catalog.zip"
+                    darwin_core_archive.to_file(zip_filename)
+                else:
+                    logger.info(f"Generating Core Data File")
+                    progress.flush()
+                    core = Occurrence(
+                        0, "occurrence.tsv", HERBARIUM_DWC_FIELDS,
+                        fields_terminated_by="\t", ignore_header_lines=1
+                    )
+                    herbarium_vouchers = VoucherImported.objects.filter(herbarium__metadata_id=option)
+                    results = herbarium_vouchers.get_dwc_data(logger=logger, progress=progress)
+                    logger.info("Adding core to archive")
+                    darwin_core_archive.core = core
+                    darwin_core_archive.core.pandas = results
+                    logger.info("Zipping archive")
+                    zip_filename = f"{eml.package_id}.zip"
+                    darwin_core_archive.to_file(zip_filename)
+                with open(zip_filename, "rb") as zip_file:
+                    file_field = PrivateMediaStorage().save(zip_filename, ContentFile(zip_file.read()))
+                os.remove(zip_filename)
+                zip_filename = file_field
             file_object = DarwinCoreArchiveFile.objects.get_or_create(metadata=eml)[0]
             file_object.file.delete()
-            with open(zip_filename, "rb") as zip_file:
-                file_field = PrivateMediaStorage().save(zip_filename, ContentFile(zip_file.read()))
-            file_object.file = file_field
+            file_object.file = zip_filename
             file_object.save()
-            os.remove(zip_filename)
         except Exception as e:
             error = {
                 "type": str(type(e)),
@@ -145,7 +381,7 @@ def generate_dwc_archive(self, option: int):
             logger.error(e, exc_info=True)
             raise e
         finally:
-            self.update_state(state='PROGRESS', meta={"step": 1, "total": 1, "logs": logger[0].get_logs()})
+            progress.update(progress.total, force=True)
         logger[1].close()
         logger[1].save_file(PrivateMediaStorage(), temp_folder + ".log")
         close_process(logger[0], self, meta={"step": 1, "total": 1, }, error=error)
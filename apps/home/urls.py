@@ -8,6 +8,7 @@ urlpatterns = [
     re_path(r'^preference/$', views.preference, name='preference'),
     re_path(r'^get_progress/(?P<task_id>[\w-]+)/$', views.get_progress, name='get_progress'),
     re_path(r'^get_task_log/(?P<task_id>[\w-]+)/$', views.get_task_log, name='get_task_log'),
+    re_path(r'^get_task_lines/(?P<task_id>[\w-]+)/$', views.get_task_lines, name='get_task_lines'),
     re_path(r'^test/$', views.test_view, name='test_view'),
     re_path(r'^generate_dwc_catalog/$', views.generate_dwc_catalog, name='generate_dwc_catalog'),
     re_path(r'^generate_dwc_herbarium/(?P<herbarium_id>[\w-]+)/$', views.generate_dwc_herbarium, name='generate_dwc_herbarium'),
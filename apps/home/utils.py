@@ -0,0 +1,341 @@
+import hashlib
+import io
+import shutil
+import tempfile
+import zipfile
+from functools import partial
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Sequence, Tuple
+
+import boto3
+from django.conf import settings
+from django.core.files import File
+from django.db.models import Aggregate, F, QuerySet
+from dwca import DarwinCoreArchive
+from dwca.classes import DataFile
+from dwca.terms import Field
+
+from apps.home.models import DarwinCoreArchiveSegment
+from apps.metadata.models import EML
+from intranet.utils import ProgressReporter
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Non seekable file that uploads what is written to an S3 object
+    through a multipart upload, keeping at most one part in memory
+    """
+
+    def __init__(
+            self, s3: boto3.client, bucket_name: str, key: str,
+            part_size: int = None, **parameters: Any
+    ) -> None:
+        """
+        Starts the multipart upload
+
+        Parameters
+        ----------
+        s3 : boto3.client
+            S3 client to execute the upload
+        bucket_name : str
+            Bucket name
+        key : str
+            Key of the uploaded object
+        part_size : int, optional
+            Bytes of each part, `DWC_UPLOAD_PART_SIZE` by default (S3 needs at least 5 MiB)
+        parameters : Any
+            Extra parameters of the object, as its `StorageClass`
+        """
+        super().__init__()
+        self.__s3__ = s3
+        self.__bucket_name__ = bucket_name
+        self.__key__ = key
+        self.__part_size__ = part_size if part_size is not None else settings.DWC_UPLOAD_PART_SIZE
+        self.__buffer__ = bytearray()
+        self.__parts__ = list()
+        self.__upload_id__ = s3.create_multipart_upload(
+            Bucket=bucket_name, Key=key, **parameters
+        )["UploadId"]
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.__buffer__ += data
+        while len(self.__buffer__) >= self.__part_size__:
+            self.__upload_part__(bytes(self.__buffer__[:self.__part_size__]))
+            del self.__buffer__[:self.__part_size__]
+        return len(data)
+
+    def __upload_part__(self, body: bytes) -> None:
+        part_number = len(self.__parts__) + 1
+        response = self.__s3__.upload_part(
+            Bucket=self.__bucket_name__, Key=self.__key__, UploadId=self.__upload_id__,
+            PartNumber=part_number, Body=body
+        )
+        self.__parts__.append({"ETag": response["ETag"], "PartNumber": part_number})
+        return
+
+    def close(self) -> None:
+        """
+        Uploads the remaining bytes as the last part and completes the upload
+        """
+        if not self.closed:
+            if len(self.__buffer__) > 0 or len(self.__parts__) == 0:
+                self.__upload_part__(bytes(self.__buffer__))
+                self.__buffer__.clear()
+            self.__s3__.complete_multipart_upload(
+                Bucket=self.__bucket_name__, Key=self.__key__, UploadId=self.__upload_id__,
+                MultipartUpload={"Parts": self.__parts__}
+            )
+        super().close()
+        return
+
+    def abort(self) -> None:
+        """
+        Aborts the upload, discarding the uploaded parts
+        """
+        if not self.closed:
+            self.__s3__.abort_multipart_upload(
+                Bucket=self.__bucket_name__, Key=self.__key__, UploadId=self.__upload_id__
+            )
+            self.__buffer__.clear()
+        super().close()
+        return
+
+
+def unformat_row(fields: List[Field], row: Sequence[Any]) -> List[str]:
+    line = list()
+    for field, value in zip(fields, row):
+        try:
+            line.append(field.unformat(value))
+        except AssertionError:
+            line.append(field.unformat(field.TYPE(value)))
+    return line
+
+
+def write_archive_metadata(zip_file: zipfile.ZipFile, archive: DarwinCoreArchive, encoding: str = "utf-8") -> None:
+    """
+    Writes `meta.xml` and the EML of the archive, as `DarwinCoreArchive.to_file` does
+
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        Zip being written
+    archive : DarwinCoreArchive
+        Archive with its core and extensions set, without data
+    encoding : str
+        Encoding of the files
+
+    Returns
+    -------
+    None
+    """
+    zip_file.writestr("meta.xml", archive.__meta__.to_xml().encode(encoding))
+    if archive.metadata is not None:
+        zip_file.writestr(archive.__meta__.__metadata__, archive.__metadata__.to_xml().encode(encoding))
+    return
+
+
+class Segment:
+    """
+    Slice of the rows of a data file of an archive, reused from the cache
+    while its fingerprint does not change
+    """
+
+    def __init__(self, key: str, fingerprint: str, rows: Callable[[], Iterable[Sequence[Any]]]) -> None:
+        """
+        Parameters
+        ----------
+        key : str
+            Identifier of the segment on its data file
+        fingerprint : str
+            Digest of the state of the rows of the segment
+        rows : Callable[[], Iterable[Sequence[Any]]]
+            Function generating the rows of the segment, only called when
+            the segment must be rebuilt
+        """
+        self.__key__ = key
+        self.__fingerprint__ = fingerprint
+        self.__rows__ = rows
+
+    @property
+    def key(self) -> str:
+        return self.__key__
+
+    @property
+    def fingerprint(self) -> str:
+        return self.__fingerprint__
+
+    def rows(self) -> Iterable[Sequence[Any]]:
+        return self.__rows__()
+
+
+def fingerprint(*values: Any) -> str:
+    return hashlib.sha256(repr(values).encode("utf-8")).hexdigest()
+
+
+def range_fingerprints(queryset: QuerySet, field: str, size: int, **aggregates: Aggregate) -> Dict[int, Tuple]:
+    """
+    Aggregates the rows of a queryset by ranges of `size` values of `field`
+    on a single query
+
+    Parameters
+    ----------
+    queryset : QuerySet
+        Rows to aggregate
+    field : str
+        Integer field splitting the rows in ranges, usually the primary key
+    size : int
+        Values of `field` on each range
+    aggregates : Aggregate
+        Aggregates describing the state of the rows of a range
+
+    Returns
+    -------
+    Dict[int, Tuple]
+        Values of the aggregates by number of range
+    """
+    names = sorted(aggregates.keys())
+    return {
+        row["segment"]: tuple([row[name] for name in names])
+        for row in queryset.order_by().annotate(
+            segment=F(field) / size
+        ).values("segment").annotate(**aggregates)
+    }
+
+
+def range_segments(
+        prefix: str, size: int, context: str,
+        rows: Callable[[Tuple[int, int]], Iterable[Sequence[Any]]],
+        ranges: Dict[int, Tuple], *dependencies: Dict[int, Tuple]
+) -> List[Segment]:
+    """
+    Builds a segment for each range with rows
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix of the keys of the segments
+    size : int
+        Values of the field on each range, as given to `range_fingerprints`
+    context : str
+        Fingerprint of the data shared by every segment
+    rows : Callable[[Tuple[int, int]], Iterable[Sequence[Any]]]
+        Function generating the rows between the first (inclusive) and last
+        (exclusive) value of a range
+    ranges : Dict[int, Tuple]
+        State of the rows of the data file by range
+    dependencies : Dict[int, Tuple]
+        State by range of other rows that change the content of the data file
+
+    Returns
+    -------
+    List[Segment]
+        Segments ordered by range
+    """
+    return [
+        Segment(
+            f"{prefix}-{number}",
+            fingerprint(context, ranges[number], *[dependency.get(number) for dependency in dependencies]),
+            partial(rows, (number * size, (number + 1) * size))
+        )
+        for number in sorted(ranges.keys())
+    ]
+
+
+def render_header(data_file: DataFile) -> bytes:
+    header = ""
+    if data_file.__ignore_header_lines__ > 0:
+        header += f"###{data_file.__lines_end__}" * (data_file.__ignore_header_lines__ - 1)
+        header += data_file.__fields_end__.join([field.name for field in data_file.__fields__])
+        header += data_file.__lines_end__
+    return header.encode(data_file.__encoding__)
+
+
+def render_rows(data_file: DataFile, rows: Iterable[Sequence[Any]], output: BinaryIO) -> int:
+    """
+    Writes rows of a data file of the archive one at a time, formatted as
+    `DataFile.write_file` does
+
+    Parameters
+    ----------
+    data_file : DataFile
+        Core or extension of the archive
+    rows : Iterable[Sequence[Any]]
+        Values of each row, in the order of the fields of `data_file`
+    output : BinaryIO
+        File where to write the encoded rows
+
+    Returns
+    -------
+    int
+        Number of written rows
+    """
+    written = 0
+    for row in rows:
+        line = data_file.__fields_end__.join(unformat_row(data_file.__fields__, row)) + data_file.__lines_end__
+        output.write(line.encode(data_file.__encoding__))
+        written += 1
+    return written
+
+
+def write_segments(
+        zip_file: zipfile.ZipFile, data_file: DataFile, segments: List[Segment],
+        cache: Dict[str, DarwinCoreArchiveSegment], metadata: EML, progress: ProgressReporter = None
+) -> int:
+    """
+    Writes a data file of the archive into its zip entry, copying the cached
+    segments still valid and rebuilding and caching the rest
+
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        Zip being written
+    data_file : DataFile
+        Core or extension of the archive
+    segments : List[Segment]
+        Segments of the data file, in order
+    cache : Dict[str, DarwinCoreArchiveSegment]
+        Cached segments of the data file by key
+    metadata : EML
+        Metadata of the archive
+    progress : ProgressReporter, optional
+        Progress of the task
+
+    Returns
+    -------
+    int
+        Number of rebuilt segments
+    """
+    buffer_size = settings.STORAGE_STREAM_BUFFER
+    start = progress.extend(len(segments)) if progress is not None else 0
+    rebuilt = 0
+    with zip_file.open(data_file.filename, "w", force_zip64=True) as entry:
+        entry.write(render_header(data_file))
+        for i, segment in enumerate(segments):
+            cached = cache.get(segment.key)
+            if cached is not None and cached.fingerprint == segment.fingerprint and cached.file \
+                    and cached.file.storage.exists(cached.file.name):
+                with cached.file.open("rb") as cached_file:
+                    shutil.copyfileobj(cached_file, entry, buffer_size)
+            else:
+                with tempfile.TemporaryFile() as segment_file:
+                    rows = render_rows(data_file, segment.rows(), segment_file)
+                    segment_file.seek(0)
+                    shutil.copyfileobj(segment_file, entry, buffer_size)
+                    segment_file.seek(0)
+                    if cached is None:
+                        cached = DarwinCoreArchiveSegment(
+                            metadata=metadata, data_file=data_file.filename, key=segment.key
+                        )
+                    elif cached.file:
+                        cached.file.delete(save=False)
+                    cached.fingerprint = segment.fingerprint
+                    cached.rows = rows
+                    cached.file.save(
+                        f"{metadata.pk}-{data_file.filename}-{segment.key}", File(segment_file), save=True
+                    )
+                rebuilt += 1
+            if progress is not None:
+                progress.update(start + i + 1)
+    return rebuilt
@@ -8,7 +8,7 @@ from django.contrib.auth.models import User
 from django.db.models import Count
 from django.db.models import Q
 from django.db.models.functions import ExtractDay, ExtractMonth, ExtractYear
-from django.http import HttpResponse, FileResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, JsonResponse
 from django.shortcuts import render, redirect
 from django.utils import translation
 from django.views.decorators.http import require_GET
@@ -19,6 +19,7 @@ from apps.home.forms import ProfileForm, UserForm
 from apps.home.models import Profile, DarwinCoreArchiveFile
 from apps.home.tasks import generate_dwc_archive
 from apps.metadata.models import EML
+from intranet.utils import log_lines_after
 
 
 @login_required
@@ -103,12 +104,28 @@ def preference(request):
 @login_required
 def get_progress(request, task_id: str):
     result = AsyncResult(task_id)
+    details = result.info
+    if isinstance(details, dict):
+        details = {key: value for key, value in details.items() if key != "lines"}
     return HttpResponse(json.dumps({
         'state': result.state,
-        'details': result.info,
+        'details': details,
     }), content_type="application/json")
 
 
+@require_GET
+@login_required
+def get_task_lines(request, task_id: str):
+    try:
+        cursor = max(0, int(request.GET.get("cursor", 0)))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    result = AsyncResult(task_id)
+    response = log_lines_after(result.info, cursor)
+    response["state"] = result.state
+    return JsonResponse(response)
+
+
 @require_GET
 @login_required
 def get_task_log(request, task_id: str):
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from django.utils.translation import gettext_lazy as _
 from celery.schedules import crontab
@@ -212,6 +213,62 @@ CELERY_TASK_TIME_LIMIT = 24 * 60 * 60
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND")
 CELERY_TIMEZONE = TIME_ZONE
+TASK_PROGRESS_INTERVAL = float(os.environ.get("TASK_PROGRESS_INTERVAL", 1.0))
+TASK_PROGRESS_LOG_TAIL = int(os.environ.get("TASK_PROGRESS_LOG_TAIL", 200))
+TASK_LOG_CAPACITY = int(os.environ.get("TASK_LOG_CAPACITY", 5000))
+
+# Percent of the original size of every derivative of a voucher image, by collection code.
+# It can be overridden with a JSON, e.g. IMAGE_DERIVATIVE_SCALES='{"CONC": {"10": 8, "60": 50}}'
+IMAGE_DERIVATIVE_SCALES = {
+    "default": {10: 10, 60: 60},
+}
+IMAGE_DERIVATIVE_SCALES.update({
+    collection_code: {int(variant): float(scale) for variant, scale in scales.items()}
+    for collection_code, scales in json.loads(os.environ.get("IMAGE_DERIVATIVE_SCALES", "{}")).items()
+})
+
+POSTPROCESSING_WORKERS = {
+    "download": int(os.environ.get("POSTPROCESSING_DOWNLOAD_WORKERS", 2)),
+    "convert": int(os.environ.get("POSTPROCESSING_CONVERT_WORKERS", 2)),
+    "qr": int(os.environ.get("POSTPROCESSING_QR_WORKERS", 2)),
+    "profile": int(os.environ.get("POSTPROCESSING_PROFILE_WORKERS", 2)),
+    "upload": int(os.environ.get("POSTPROCESSING_UPLOAD_WORKERS", 2)),
+}
+POSTPROCESSING_CONVERTER = os.environ.get("POSTPROCESSING_CONVERTER", "cli")
+POSTPROCESSING_BATCH_SIZE = int(os.environ.get("POSTPROCESSING_BATCH_SIZE", 4))
+POSTPROCESSING_QUEUE_SIZE = int(os.environ.get("POSTPROCESSING_QUEUE_SIZE", 4))
+POSTPROCESSING_PREFETCH = int(os.environ.get("POSTPROCESSING_PREFETCH", 4))
+POSTPROCESSING_MAX_BYTES_IN_FLIGHT = int(os.environ.get("POSTPROCESSING_MAX_BYTES_IN_FLIGHT", 256 * 1024 * 1024))
+
+S3_TRANSFER = {
+    "multipart_threshold": int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * 1024 * 1024)),
+    "multipart_chunksize": int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)),
+    "max_concurrency": int(os.environ.get("S3_MAX_CONCURRENCY", 8)),
+}
+
+PENDING_CHUNK_SIZE = int(os.environ.get("PENDING_CHUNK_SIZE", 10))
+RELABEL_WORKERS = int(os.environ.get("RELABEL_WORKERS", 4))
+RELABEL_CHUNK_SIZE = int(os.environ.get("RELABEL_CHUNK_SIZE", 50))
+# Darwin Core Archives are streamed row by row to a multipart upload
+DWC_STREAMING_ARCHIVE = os.environ.get("DWC_STREAMING_ARCHIVE", 'true') == 'true'
+DWC_EXPORT_CHUNK_SIZE = int(os.environ.get("DWC_EXPORT_CHUNK_SIZE", 5000))
+DWC_UPLOAD_PART_SIZE = int(os.environ.get("DWC_UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+# Rows are cached on segments by ranges of this many primary keys, rebuilt only when they change
+DWC_SEGMENT_SIZE = int(os.environ.get("DWC_SEGMENT_SIZE", 5000))
+# Bytes read at once when copying stored files to local files
+STORAGE_STREAM_BUFFER = int(os.environ.get("STORAGE_STREAM_BUFFER", 1024 * 1024))
+
+# Restore of raw images archived in Glacier Deep Archive
+RESTORE_WORKERS = int(os.environ.get("RESTORE_WORKERS", 16))
+RESTORE_BATCH_SIZE = int(os.environ.get("RESTORE_BATCH_SIZE", 5000))
+RESTORE_BASE_BACKOFF = int(os.environ.get("RESTORE_BASE_BACKOFF", 15 * 60))
+RESTORE_MAX_BACKOFF = int(os.environ.get("RESTORE_MAX_BACKOFF", 6 * 60 * 60))
+RESTORE_DAYS = int(os.environ.get("RESTORE_DAYS", 7))
+RESTORE_TIER = os.environ.get("RESTORE_TIER", "Standard")
+# Seconds a voucher must stay pending without changes before its raw image is checked for a restore
+RESTORE_GRACE_PERIOD = int(os.environ.get("RESTORE_GRACE_PERIOD", 60 * 60))
+# Seconds a queued voucher waits to be processed before its restore is checked again
+RESTORE_QUEUED_TIMEOUT = int(os.environ.get("RESTORE_QUEUED_TIMEOUT", 6 * 60 * 60))
 
 CELERY_BEAT_SCHEDULE = {
     'daily_postprocessing': {
@@ -219,6 +276,10 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': crontab(hour="5", minute="0"),
         'args': ('input', 'tmp', 'log')
     },
+    'restore_pending_vouchers': {
+        'task': 'restore_pending_vouchers',
+        'schedule': crontab(minute="*/15"),
+    },
     'weekly_clean_storage': {
         'task': 'clean_storage',
         'schedule': crontab(hour="3", minute="0", day_of_week='sunday'),
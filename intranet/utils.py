@@ -5,16 +5,19 @@ import logging
 import os
 import smtplib
 import tempfile
+import threading
 import time
 import datetime as dt
 import traceback
 from abc import ABC, abstractmethod
+from collections import deque
 from email.header import Header
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formataddr, formatdate, make_msgid
-from typing import Dict, List, Tuple, Any, Sequence
+from itertools import islice
+from typing import Dict, List, Tuple, Any, Sequence, Deque
 from celery.app.task import Task
 from django.conf import settings
 from django.contrib.gis.gdal import DataSource
@@ -67,15 +70,17 @@ class TaskProcessLogger(logging.Logger):
             path_file, dt.datetime.today().strftime("%Y-%m-%d") + ".log"
         )
         self.__log_file__ = open(self.__path__, "a+", encoding="utf-8")
+        self.__lock__ = threading.Lock()
 
     def __message__(self, level: str, message: Any, **kwargs) -> None:
-        self.__log_file__.write("{} [{}]:{}\n".format(
-            dt.datetime.now().strftime("%Y-%m-%d %I:%M:%S"),
-            level,
-            str(message)
-        ))
-        if kwargs.get("exc_info", False):
-            self.__log_file__.write(traceback.format_exc() + "\n")
+        with self.__lock__:
+            self.__log_file__.write("{} [{}]:{}\n".format(
+                dt.datetime.now().strftime("%Y-%m-%d %I:%M:%S"),
+                level,
+                str(message)
+            ))
+            if kwargs.get("exc_info", False):
+                self.__log_file__.write(traceback.format_exc() + "\n")
 
     def debug(self, message: Any, **kwargs) -> None:
         self.__message__("DEBUG", message, **kwargs)
@@ -104,9 +109,28 @@ class TaskProcessLogger(logging.Logger):
 
 
 class HtmlLogger(logging.Logger):
-    def __init__(self, name: str):
+    def __init__(self, name: str, capacity: int = None):
+        """
+        Logger that keeps the last `capacity` lines as html, numbered
+        so they can be fetched incrementally after a cursor
+
+        Parameters
+        ----------
+        name : str
+            Name of the logger
+        capacity : int, optional
+            Lines kept, `TASK_LOG_CAPACITY` by default
+        """
         super().__init__(name)
-        self.__logs__ = ""
+        capacity = capacity if capacity is not None else settings.TASK_LOG_CAPACITY
+        self.__logs__: Deque[str] = deque(maxlen=capacity)
+        self.__cursor__ = 0
+        self.__lock__ = threading.Lock()
+
+    def __append__(self, line: str) -> None:
+        with self.__lock__:
+            self.__logs__.append(line)
+            self.__cursor__ += 1
 
     def __message__(self, level: str, message: Any, **kwargs) -> None:
         escaped_msg = html.escape("{} [{}]:{}".format(
@@ -114,11 +138,11 @@ class HtmlLogger(logging.Logger):
             level,
             str(message)
         ))
-        self.__logs__ += f'<code class="{level.lower()}">{escaped_msg}</code><br>'
+        self.__append__(f'<code class="{level.lower()}">{escaped_msg}</code><br>')
         if kwargs.get("exc_info", False):
             for line in traceback.format_exc().split("\n"):
                 escaped_line = html.escape(line)
-                self.__logs__ += f'<code class="{level.lower()}">{escaped_line}</code><br>'
+                self.__append__(f'<code class="{level.lower()}">{escaped_line}</code><br>')
 
     def debug(self, message: Any, **kwargs) -> None:
         self.__message__("DEBUG", message, **kwargs)
@@ -133,7 +157,36 @@ class HtmlLogger(logging.Logger):
         self.__message__("ERROR", message, **kwargs)
 
     def get_logs(self) -> str:
-        return self.__logs__
+        with self.__lock__:
+            return "".join(self.__logs__)
+
+    def get_entries(self, after: int = 0, limit: int = None) -> Tuple[List[str], int]:
+        """
+        Lines written after a cursor, only the ones still kept
+
+        Parameters
+        ----------
+        after : int
+            Cursor of the last line already read, 0 for all the lines
+        limit : int, optional
+            Maximum number of lines to return, the last ones
+
+        Returns
+        -------
+        Tuple[List[str], int]
+            Html of every line and the cursor of the last line
+        """
+        with self.__lock__:
+            first = self.__cursor__ - len(self.__logs__)
+            lines = list(islice(self.__logs__, max(0, after - first), None))
+            cursor = self.__cursor__
+        if limit is not None:
+            lines = lines[-limit:] if limit > 0 else list()
+        return lines, cursor
+
+    @property
+    def cursor(self) -> int:
+        return self.__cursor__
 
 
 class GroupLogger(logging.Logger, Sequence):
@@ -167,10 +220,150 @@ class GroupLogger(logging.Logger, Sequence):
             logger.error(message, **kwargs)
 
 
-def close_process(logger: HtmlLogger, task: Task, meta: Dict, error: Dict = None) -> None:
-    meta["logs"] = logger.get_logs()
+class ProgressReporter:
+    def __init__(
+            self, task: Task, logger: HtmlLogger = None, total: int = 1,
+            interval: float = None, step_delta: int = None, tail: int = None,
+            task_id: str = None
+    ) -> None:
+        """
+        Reports the progress of a task to the result backend, sending
+        at most one update per `interval` seconds unless the step advanced
+        at least `step_delta` since the last update. Only the last `tail`
+        lines of the logs are sent on each update
+
+        Parameters
+        ----------
+        task : Task
+            Task to update, if None nothing is reported
+        logger : HtmlLogger, optional
+            Logger with the logs of the task, if None only the steps are sent
+        total : int
+            Initial total of steps
+        interval : float, optional
+            Minimum seconds between updates, `TASK_PROGRESS_INTERVAL` by default
+        step_delta : int, optional
+            Steps that force an update, 1% of the total by default
+        tail : int, optional
+            Lines of logs sent, `TASK_PROGRESS_LOG_TAIL` by default
+        task_id : str, optional
+            Id of the task to report on, the current task by default
+        """
+        self.__task__ = task
+        self.__task_id__ = task_id
+        self.__logger__ = logger
+        self.__step__ = 0
+        self.__total__ = total
+        self.__interval__ = interval if interval is not None else settings.TASK_PROGRESS_INTERVAL
+        self.__step_delta__ = step_delta
+        self.__tail__ = tail if tail is not None else settings.TASK_PROGRESS_LOG_TAIL
+        self.__last_time__ = None
+        self.__last_step__ = None
+        self.__last_cursor__ = None
+
+    @property
+    def step(self) -> int:
+        return self.__step__
+
+    @property
+    def total(self) -> int:
+        return self.__total__
+
+    def extend(self, count: int) -> int:
+        """
+        Adds steps to the total, for tasks made of consecutive parts
+
+        Parameters
+        ----------
+        count : int
+            Steps of the new part
+
+        Returns
+        -------
+        int
+            Step where the new part starts
+        """
+        start = self.__total__
+        self.__total__ += count
+        self.update(start, force=True)
+        return start
+
+    def update(self, step: int = None, total: int = None, force: bool = False) -> bool:
+        """
+        Sets the current step and reports it if enough time or steps passed
+        since the last report and there is something new to report
+
+        Parameters
+        ----------
+        step : int, optional
+            Current step, unchanged if None
+        total : int, optional
+            Total of steps, unchanged if None
+        force : bool
+            Report without checking the time or steps passed
+
+        Returns
+        -------
+        bool
+            True if the progress was reported
+        """
+        if step is not None:
+            self.__step__ = step
+        if total is not None:
+            self.__total__ = total
+        if self.__task__ is None:
+            return False
+        now = time.monotonic()
+        if not force and self.__last_time__ is not None:
+            cursor = self.__logger__.cursor if self.__logger__ is not None else None
+            if self.__last_step__ == self.__step__ and self.__last_cursor__ == cursor:
+                return False
+            step_delta = self.__step_delta__ or max(1, self.__total__ // 100)
+            if now - self.__last_time__ < self.__interval__ and \
+                    abs(self.__step__ - self.__last_step__) < step_delta:
+                return False
+        self.__last_time__ = now
+        self.__last_step__ = self.__step__
+        meta = {"step": self.__step__, "total": self.__total__}
+        if self.__logger__ is not None:
+            meta["lines"], meta["cursor"] = self.__logger__.get_entries(limit=self.__tail__)
+            self.__last_cursor__ = meta["cursor"]
+        self.__task__.update_state(task_id=self.__task_id__, state='PROGRESS', meta=meta)
+        return True
+
+    def advance(self, count: int = 1) -> bool:
+        """
+        Moves the current step forward
+
+        Parameters
+        ----------
+        count : int
+            Steps done
+
+        Returns
+        -------
+        bool
+            True if the progress was reported
+        """
+        return self.update(self.__step__ + count)
+
+    def flush(self) -> bool:
+        """
+        Reports the current progress
+
+        Returns
+        -------
+        bool
+            True if the progress was reported
+        """
+        return self.update(force=True)
+
+
+def close_process(logger: HtmlLogger, task: Task, meta: Dict, error: Dict = None, task_id: str = None) -> None:
+    meta["lines"], meta["cursor"] = logger.get_entries()
     if error is None:
         task.update_state(
+            task_id=task_id,
             state='SUCCESS',
             meta=meta,
         )
@@ -178,12 +371,43 @@ def close_process(logger: HtmlLogger, task: Task, meta: Dict, error: Dict = None
     else:
         meta["error"] = error
         task.update_state(
+            task_id=task_id,
             state='ERROR',
             meta=meta
         )
         return
 
 
+def log_lines_after(info: Any, cursor: int) -> Dict[str, Any]:
+    """
+    Lines of the logs sent by a task that are after a cursor
+
+    Parameters
+    ----------
+    info : Any
+        Info of the task on the result backend
+    cursor : int
+        Cursor of the last line already read
+
+    Returns
+    -------
+    Dict[str, Any]
+        New `lines`, the `cursor` of the last one and the number
+        of lines `missing` because they were not sent anymore
+    """
+    if not isinstance(info, dict) or "cursor" not in info:
+        return {"lines": list(), "cursor": cursor, "missing": 0}
+    lines = info.get("lines", list())
+    first = info["cursor"] - len(lines)
+    if cursor > info["cursor"]:
+        cursor = first
+    return {
+        "lines": lines[max(0, cursor - first):],
+        "cursor": info["cursor"],
+        "missing": max(0, first - cursor),
+    }
+
+
 def paginated_table(
         request: HttpRequest,
         entries: QuerySet,
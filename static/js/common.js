@@ -90,9 +90,34 @@ function getStateClass(voucherState){
     }
 }
 
+function fetchLogLines(logDiv, linesUrl, csrfToken) {
+    const cursor = Number(logDiv.dataset.cursor || 0);
+    return $.ajax({
+        url: linesUrl,
+        type: 'GET',
+        data: {cursor: cursor},
+        headers: {'X-CSRFToken': csrfToken},
+        success: function(response) {
+            if (response.lines.length === 0)
+                return;
+            const logContent = logDiv.children[0];
+            if (logDiv.dataset.cursor === undefined)
+                logContent.innerHTML = "";
+            if (response.missing > 0)
+                logContent.insertAdjacentHTML('beforeend', `<code class="warn">... ${response.missing} lines</code><br>`);
+            logContent.insertAdjacentHTML('beforeend', response.lines.join(""));
+            logDiv.dataset.cursor = response.cursor;
+            logDiv.scrollTop = logDiv.scrollHeight;
+        },
+        error: function(error) {
+            console.warn(error);
+        }
+    });
+}
+
 function updateProgress(
     {
-        taskId, progressUrl, urlLog,
+        taskId, progressUrl, linesUrl, urlLog,
         progressDOM, csrfToken, logFileDefault,
         started = false,
         onErrorMessage = (error) => {console.error(error)},
@@ -142,11 +167,10 @@ function updateProgress(
                 progressDiv
                     .getElementsByClassName("progress-bar")[0]
                     .innerText = response.details.step;
-                logDiv.children[0].innerHTML = response.details.logs;
-                logDiv.scrollTop = logDiv.scrollHeight;
-                setTimeout(updateProgress, 500, {
+                fetchLogLines(logDiv, linesUrl, csrfToken).always(() => setTimeout(updateProgress, 500, {
                     taskId: taskId,
                     progressUrl: progressUrl,
+                    linesUrl: linesUrl,
                     urlLog: urlLog,
                     progressDOM: progressDOM,
                     csrfToken: csrfToken,
@@ -155,7 +179,7 @@ function updateProgress(
                     onErrorMessage: onErrorMessage,
                     successCallback: successCallback,
                     errorCallback: errorCallback
-                });
+                }));
             } else if (response.state === "STARTED") {
                 progressDiv.style.display = "";
                 progressDiv
@@ -165,11 +189,13 @@ function updateProgress(
                 progressDiv
                     .getElementsByClassName("progress-bar")[0]
                     .innerText = 0;
-                logDiv.children[0].innerHTML = "Process started...";
+                if (logDiv.dataset.cursor === undefined)
+                    logDiv.children[0].innerHTML = "Process started...";
                 logDiv.scrollTop = logDiv.scrollHeight;
                 setTimeout(updateProgress, 500, {
                     taskId: taskId,
                     progressUrl: progressUrl,
+                    linesUrl: linesUrl,
                     urlLog: urlLog,
                     progressDOM: progressDOM,
                     csrfToken: csrfToken,
@@ -188,11 +214,13 @@ function updateProgress(
                 progressDiv
                     .getElementsByClassName("progress-bar")[0]
                     .innerText = 0;
-                logDiv.children[0].innerHTML = "Sending task, pending response...";
+                if (logDiv.dataset.cursor === undefined)
+                    logDiv.children[0].innerHTML = "Sending task, pending response...";
                 logDiv.scrollTop = logDiv.scrollHeight;
                 setTimeout(updateProgress, 500, {
                     taskId: taskId,
                     progressUrl: progressUrl,
+                    linesUrl: linesUrl,
                     urlLog: urlLog,
                     progressDOM: progressDOM,
                     csrfToken: csrfToken,
@@ -213,22 +241,21 @@ function updateProgress(
                     .getElementsByClassName("progress-bar")[0]
                     .style
                     .width = 0;
-                logDiv.children[0].innerHTML = response.details.logs;
-                logDiv.scrollTop = logDiv.scrollHeight;
+                fetchLogLines(logDiv, linesUrl, csrfToken);
                 ended = true;
             } else if (response.state === "FAILURE") {
                 failure = true;
                 ended = true;
             } else if (response.state === "ERROR") {
                 failure = true;
-                logDiv.children[0].innerHTML = response.details.logs;
-                logDiv.scrollTop = logDiv.scrollHeight;
+                fetchLogLines(logDiv, linesUrl, csrfToken);
                 ended = true;
                 errorData = response.details.error;
             } else {
                 setTimeout(updateProgress, 500, {
                     taskId: taskId,
                     progressUrl: progressUrl,
+                    linesUrl: linesUrl,
                     urlLog: urlLog,
                     progressDOM: progressDOM,
                     csrfToken: csrfToken,